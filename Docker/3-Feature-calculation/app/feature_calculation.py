@@ -0,0 +1,2672 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+import re
+import glob
+
+import csv as csvs
+from datetime import datetime
+
+import sys  
+import argparse
+import gzip 
+import io
+import mmap
+import multiprocessing
+import contextlib
+import cProfile
+import hashlib
+import importlib
+import json
+import pickle
+import resource
+import shutil
+import signal
+import sqlite3
+import time
+import traceback
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+
+import os
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+os.environ["JAX_PLATFORMS"] = "cpu"
+os.environ["XLA_PYTHON_CLIENT_PREALLOCATE"] = "false"  
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+# ms2rescore/psm_utils는 처음 쓰는 함수 안에서 import (ms2rescore import에 TensorFlow 로딩이 포함되어
+# 수 초가 걸리므로, checkpoint가 모두 유효한 재실행이나 --help는 이 비용 없이 끝남)
+# feature generator class는 feature_generator_class()로 가져옴 (module 속성으로 바꿔 끼울 수 있음)
+BasicFeatureGenerator = None
+MS2PIPFeatureGenerator = None
+DeepLCFeatureGenerator = None
+_FEATURE_GENERATOR_MODULES = {
+    "BasicFeatureGenerator": "ms2rescore.feature_generators.basic",
+    "MS2PIPFeatureGenerator": "ms2rescore.feature_generators.ms2pip",
+    "DeepLCFeatureGenerator": "ms2rescore.feature_generators.deeplc",
+}
+
+
+def feature_generator_class(name):
+    cls = globals()[name]
+    if cls is None:
+        cls = getattr(importlib.import_module(_FEATURE_GENERATOR_MODULES[name]), name)
+        globals()[name] = cls
+    return cls
+
+
+_PTM_MAPPINGS = {
+    'M+15.995': 'M[ox]',
+    'C+57.021': 'C',
+    '+42.011':  '[ac]-',
+    '+43.006':  '[ca]-',
+    'N+0.984':  'N[de]',
+    'Q+0.984':  'Q[de]',
+    '-17.027':  '[al]-',
+}
+_PTM_PAT = re.compile('|'.join(re.escape(k) for k in _PTM_MAPPINGS))
+
+
+def _ptm_repl(m):
+    return _PTM_MAPPINGS[m.group(0)]
+
+
+def get_ptm_peptide(peptide):
+    """peptide: str 또는 pandas.Series 모두 지원"""
+    # pandas Series인 경우
+    if isinstance(peptide, pd.Series):
+        return peptide.astype(str).str.replace(_PTM_PAT, _ptm_repl, regex=True)
+
+    # 그 외 (단일 문자열 등)
+    return _PTM_PAT.sub(_ptm_repl, str(peptide))
+
+
+def get_nonnum_peptide(pep):
+    result_pep = pep
+    result_pep = re.sub('[^a-zA-Z]', '',result_pep)
+    return result_pep
+
+
+def combine_columns(col_list,separate):
+    result = col_list[0]
+    for col in col_list[1:]:
+        if not pd.isna(col):
+            result += separate + str(col)
+    return result
+
+
+def combine_series(left, right, separate):
+    """combine_columns([left, right], separate)의 Series 버전 (right가 NaN인 행은 left 그대로)"""
+    result = left.str.cat(right.astype(str), sep=separate)
+    right_na = right.isna()
+    if right_na.any():
+        result[right_na] = left[right_na]
+    return result
+
+
+def map_categories(values, func):
+    """
+    values를 categorical로 바꾼 뒤 func(문자열 Series -> 문자열 Series)를 category에만 적용.
+    행 수가 아니라 고유값 수만큼만 계산하고, 결과도 categorical로 반환 (서로 다른 값이 같은 값으로 바뀌어도 됨).
+    """
+    values = values.astype('category')
+    mapped = pd.Index(func(pd.Series(values.cat.categories.astype(object))))
+    categories = mapped.unique()
+    codes = categories.get_indexer(mapped)
+    old_codes = values.cat.codes.to_numpy()
+    new_codes = np.where(old_codes >= 0, codes[old_codes] if len(codes) else -1, -1)
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories), index=values.index)
+
+
+def run_stem(run):
+    """MGF 파일명 -> 확장자 앞부분 (get_ss의 run.split('.')[0])"""
+    return run.str.split('.').str[0]
+
+def get_run(source_file):
+    tmp = source_file
+    return tmp+'.mgf'
+
+
+def get_pep_len(pep):
+    return len(pep)
+
+
+def get_sourcefile(psmid):
+    tmp = psmid
+    return tmp[0:tmp.rfind('_')]
+
+
+def get_scan(psmid):
+    tmp = psmid
+    return int(tmp[tmp.rfind('_')+1:])
+
+
+def get_casanovo_changed_df(ori_df):
+    """
+    beam별 rank 계산 후 길이/charge 필터.
+    - run, Source File은 categorical (파일 수만큼의 문자열만 보관), spectrum 키는 (Source File, Scan)
+    - SS/ID/IDD/peptide/peptidoform 같은 문자열 조합 컬럼은 만들지 않음 -> composite_id_columns()로 필요한 행에서만 생성
+    """
+    ori_df['run'] = ori_df['run'].astype('category')
+    ori_df['Source File'] = map_categories(ori_df['run'], run_stem)
+    ori_df['Tag length'] = ori_df['Peptide'].str.len()
+    ori_df['z'] = ori_df['z'].astype(np.int64)
+    ori_df['Casanovo score'] = pd.to_numeric(ori_df['Casanovo score'])
+    
+    tmp_df = ori_df[['Source File','Scan','Peptide','Casanovo score','z','m/z','RT','Tag length','run']].copy()
+    print(len(tmp_df))
+    
+    tmp_df['rank_first'] = tmp_df.groupby(['Source File','Scan'], observed=True)['Casanovo score'].rank(method='first', ascending=False)
+
+    # rank는 필터 전 전체 beam 기준이므로 먼저 계산하고, 문자열 컬럼은 필터를 통과한 행에만 생성
+    tmp_df = tmp_df[(tmp_df['Tag length']>=6)&(tmp_df['Tag length']<=60)]
+    tmp_df = tmp_df[tmp_df['z']<=6].copy()
+    
+    tmp_df['Peptide'] = tmp_df['Peptide'].str.replace('I','L',regex=False).str.replace('(','',regex=False).str.replace(')','',regex=False)
+
+    print(len(tmp_df))
+    
+    return tmp_df
+
+
+def composite_id_columns(pd_df, columns=("SS", "ID", "IDD")):
+    """
+    get_casanovo_changed_df 결과의 행에 대해 문자열 조합 컬럼을 필요할 때만 생성 (DataFrame 반환).
+    - SS: <Source File>_<Scan>, ID: <SS>_<peptide>, IDD: <SS>_<Peptide>
+    - peptide: 알파벳 이외 문자 제거, peptidoform: MS2PIP/psm_utils 형식 <PTM peptide>/<charge>
+    """
+    out = pd.DataFrame(index=pd_df.index)
+    ss = None
+    for col in columns:
+        if col in ("SS", "ID", "IDD") and ss is None:
+            ss = combine_series(pd_df['Source File'].astype(object), pd_df['Scan'], '_')
+        if col == "SS":
+            out[col] = ss
+        elif col == "peptide":
+            out[col] = pd_df['Peptide'].str.replace('[^a-zA-Z]', '', regex=True)
+        elif col == "peptidoform":
+            out[col] = combine_series(get_ptm_peptide(pd_df['Peptide']), pd_df['z'], '/')
+        elif col == "ID":
+            out[col] = combine_series(ss, pd_df['Peptide'].str.replace('[^a-zA-Z]', '', regex=True), '_')
+        elif col == "IDD":
+            out[col] = combine_series(ss, pd_df['Peptide'], '_')
+        else:
+            raise ValueError(f"unknown composite id column: {col}")
+    return out
+
+
+
+def get_bins(desired_bin_size, m,max_val,min_val):
+    #min_val = min(m)
+    #max_val = max(m)
+    min_boundary =  -1.0 * (min_val % desired_bin_size - min_val)
+    max_boundary = max_val - max_val % desired_bin_size + desired_bin_size
+    n_bins = int((max_boundary - min_boundary) / desired_bin_size) + 1
+    bins = np.linspace(min_boundary, max_boundary, n_bins)
+    
+    return bins
+
+
+def get_ss(spectrumId,run):
+    tmp  = run
+    return tmp.split('.')[0]+"_"+str(spectrumId)
+
+
+def get_available_process_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        pass
+    except OSError:
+        pass
+    return os.cpu_count() or 1
+
+
+def get_process_count(env_name):
+    raw = os.getenv(env_name)
+    if raw:
+        try:
+            return max(1, int(raw))
+        except ValueError:
+            print(f"WARNING: invalid {env_name}={raw!r}; using all available CPUs")
+    return max(1, get_available_process_count())
+
+
+def split_process_count(env_name, n_jobs):
+    """동시에 실행되는 n_jobs개 작업이 env_name 프로세스 예산을 나눠 쓰도록 작업당 개수 반환"""
+    return max(1, get_process_count(env_name) // n_jobs)
+    
+
+def _gather_feature_column(feats, name):
+    # 모든 PSM에 float feature가 있으면 미리 할당한 배열에 바로 채우고, 그 외 숫자 feature는 numpy 배열로 변환
+    n = len(feats)
+    first = feats[0].get(name) if n else None
+    if isinstance(first, (float, np.floating)):
+        dtype = first.dtype if isinstance(first, np.floating) else np.float64
+        try:
+            return np.fromiter((f[name] for f in feats), dtype=dtype, count=n)
+        except (KeyError, TypeError, ValueError):
+            pass
+    values = [f.get(name, np.nan) for f in feats]
+    arr = np.array(values)
+    return arr if arr.dtype.kind in 'biuf' else values
+
+
+def _peptidoform_strings(psms):
+    # build_psm_list의 PSM들은 peptidoform 객체를 공유하므로 객체별로 한 번만 문자열 변환
+    cache = {}
+    out = []
+    for psm in psms:
+        key = id(psm.peptidoform)
+        text = cache.get(key)
+        if text is None:
+            text = cache[key] = str(psm.peptidoform)
+        out.append(text)
+    return out
+
+
+def psm_list_to_df(psm_list,pd_df,features=None):
+    """
+    PSMList의 rescoring_features를 PSM별 dict record 없이 column 단위로 모아 DataFrame 생성 후
+    rank-1 테이블(pd_df)과 (Source File, Scan) 기준으로 합침.
+    - PSMList는 build_psm_list로 pd_df와 같은 순서로 만들어지므로 키가 행마다 같으면 merge 없이 위치로 맞춤
+    - 순서가 다르면 정수 키 inner merge (결과 행 순서는 pd_df 순서)
+    - 반환 DataFrame의 index는 pd_df의 행 index, SS 문자열은 결과 행에 대해서만 생성
+    - features(lean mode)가 주어지면 rescoring_features 대신 PSM 순서의 {feature 이름: 배열} 사용
+    """
+    psms = psm_list.psm_list
+    columns = {
+        "spectrum_id": [psm.spectrum_id for psm in psms],
+        "run": pd.Categorical([psm.run for psm in psms]),
+        "peptidoform": _peptidoform_strings(psms),
+    }
+    if features is None:
+        feats = [psm.rescoring_features or {} for psm in psms]
+        for name in dict.fromkeys(chain.from_iterable(feats)):
+            if name not in columns:
+                columns[name] = _gather_feature_column(feats, name)
+    else:
+        columns.update(features)
+
+    sources = pd_df['Source File'].cat.categories
+    psm_source = pd.Categorical(map_categories(pd.Series(columns["run"]), run_stem), categories=sources).codes
+    psm_scan = np.fromiter(map(int, columns["spectrum_id"]), dtype=np.int64, count=len(psms))
+    row_source = pd_df['Source File'].cat.codes.to_numpy()
+    row_scan = pd_df['Scan'].to_numpy(np.int64)
+
+    left = {
+        'Peptide': pd_df['Peptide'].to_numpy(),
+        'Casanovo score': pd_df['Casanovo score'].to_numpy(),
+        'z': pd_df['z'].to_numpy(),
+        'pep_len': pd_df['Tag length'].to_numpy(),
+        'm/z': pd_df['m/z'].to_numpy(),
+    }
+    if len(psms) == len(pd_df) and np.array_equal(psm_source, row_source) and np.array_equal(psm_scan, row_scan):
+        complete_df = pd.DataFrame({**left, **columns}, index=pd_df.index)
+        rows = pd_df
+    else:
+        psm_df = pd.DataFrame({'_source': psm_source, '_scan': psm_scan, **columns})
+        pd_tmp = pd.DataFrame({'_row': pd_df.index, '_source': row_source, '_scan': row_scan, **left})
+        complete_df = pd.merge(pd_tmp,psm_df,on=['_source','_scan'],how='inner')
+        complete_df.index = pd.Index(complete_df.pop('_row').to_numpy())
+        complete_df = complete_df.drop(columns=['_source','_scan'])
+        rows = pd_df.loc[complete_df.index]
+
+    complete_df.insert(0, 'SS', composite_id_columns(rows, ["SS"])['SS'])
+    complete_df["SA"] = 1 - (2/np.pi) * np.arccos(np.clip(complete_df["cos"], -1, 1))
+    
+    return complete_df
+
+
+def build_psm_list(pd_rank1_df):
+    """
+    rank-1 DataFrame -> PSMList (iterrows 없이 column 배열에서 한 번에 생성).
+    - peptidoform은 고유 문자열당 한 번만 parse 하고, PTM 이름 변경/fixed modification 적용 후
+      같은 peptidoform의 PSM들이 그 객체를 공유
+    - 값은 이미 변환된 상태이므로 PSM은 pydantic 검증 없이 model_construct로 생성
+    """
+    from psm_utils import PSM, PSMList
+
+    peptidoforms = composite_id_columns(pd_rank1_df, ["peptidoform"])['peptidoform'].tolist()
+    unique = list(dict.fromkeys(peptidoforms))
+    template = PSMList(psm_list=[PSM(peptidoform=pep, spectrum_id="") for pep in unique])
+    template.rename_modifications(PSM_MODIFICATION_RENAME)
+    template.add_fixed_modifications(PSM_FIXED_MODIFICATIONS)
+    template.apply_fixed_modifications()
+    pep_obj = {pep: psm.peptidoform for pep, psm in zip(unique, template)}
+
+    psms = [
+        PSM.model_construct(
+            spectrum_id=spectrum_id,
+            run=run,
+            peptidoform=pep_obj[pep],
+            score=score,
+            retention_time=rt,
+            is_decoy=False,
+            precursor_mz=mz,
+            protein_list=None,
+            rank=1,
+        )
+        for spectrum_id, run, pep, score, rt, mz in zip(
+            pd_rank1_df['Scan'].astype(str).tolist(),
+            pd_rank1_df['run'].astype(str).tolist(),
+            peptidoforms,
+            pd_rank1_df['Casanovo score'].astype(np.float64).tolist(),
+            pd_rank1_df['RT'].astype(np.float64).tolist(),
+            pd_rank1_df['m/z'].astype(np.float64).tolist(),
+        )
+    ]
+    return PSMList(psm_list=psms)
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+MZTAB_PSM_COLUMNS = [
+    'sequence',
+    'spectra_ref',
+    'search_engine_score[1]',
+    'charge',
+    'exp_mass_to_charge',
+]
+
+# PSM 숫자 컬럼은 chunk 단위로 바로 숫자 dtype으로 변환 (m/z는 ppm 계산 정밀도 때문에 float64 유지)
+MZTAB_PSM_DTYPES = {
+    'search_engine_score[1]': np.float32,
+    'charge': np.int8,
+    'exp_mass_to_charge': np.float64,
+}
+
+_MSRUN_LOCATION_PAT = re.compile(r"ms_run\[(\d+)\]-location")
+
+
+def _parse_mztab_psm_chunk(lines, headers, usecols):
+    # index_col=False: PSH보다 짧은 PSM 라인은 빈 문자열로 채우고, 긴 라인은 뒤쪽 필드를 버림
+    # (라인 단위 pad/truncate와 동일하게, 필드 수가 어긋난 라인이 있어도 chunk 전체가 실패하지 않음)
+    chunk = pd.read_csv(
+        io.StringIO("".join(lines)),
+        sep="\t",
+        header=None,
+        names=["PSM"] + headers,
+        usecols=usecols,
+        index_col=False,
+        dtype=str,
+        na_filter=False,
+        quoting=csvs.QUOTE_NONE,
+        engine="c",
+    )
+    chunk = chunk[usecols]
+    for col, dtype in MZTAB_PSM_DTYPES.items():
+        if col not in chunk.columns:
+            continue
+        values = pd.to_numeric(chunk[col], errors='coerce')
+        if np.issubdtype(dtype, np.integer) and values.isna().any():
+            dtype = np.float32  # 정수 컬럼에 결측값이 있으면 float로 유지
+        chunk[col] = values.astype(dtype)
+    return chunk
+
+
+def iter_mztab_psm(path: str, columns=None, chunksize: int = 200_000, msrun_to_path=None):
+    """
+    mzTab PSM 라인을 chunksize 행씩 DataFrame으로 yield (gzip 지원).
+    - columns: 읽을 PSH 컬럼 목록 (None이면 전체). 파일에 없는 컬럼은 무시
+    - 숫자 컬럼은 MZTAB_PSM_DTYPES 타입으로 변환, 나머지는 문자열
+    - msrun_to_path: dict를 넘기면 같은 pass에서 MTD ms_run[N]-location을 {N: location}으로 채움
+      (MTD는 PSM보다 앞에 있으므로 첫 chunk가 yield될 때 이미 완성되어 있음)
+    """
+    headers = None
+    usecols = None
+    lines = []
+    n_rows = 0
+    with _open_text(path) as fh:
+        for line in fh:
+            if line.startswith("PSM\t"):
+                if headers is None:
+                    raise ValueError("mzTab 파일에 PSH(PSM 헤더) 라인이 없습니다.")
+                lines.append(line)
+                if len(lines) >= chunksize:
+                    n_rows += len(lines)
+                    yield _parse_mztab_psm_chunk(lines, headers, usecols)
+                    lines = []
+            elif line.startswith("PSH\t"):
+                # 첫 칼럼 'PSH'를 제외한 나머지가 컬럼명
+                headers = line.rstrip("\r\n").split("\t")[1:]
+                usecols = headers if columns is None else [c for c in columns if c in headers]
+            elif line.startswith("MTD\t") and msrun_to_path is not None:
+                parts = line.rstrip("\r\n").split("\t")
+                if len(parts) < 3:
+                    continue
+                # key 예: ms_run[1]-location
+                m = _MSRUN_LOCATION_PAT.search(parts[1])
+                if m:
+                    msrun_to_path[int(m.group(1))] = parts[2]
+            # 다른 섹션(PRH/PRT/PEH/PEP/SMH/SML 등)은 무시
+
+    if lines:
+        n_rows += len(lines)
+        yield _parse_mztab_psm_chunk(lines, headers, usecols)
+    if n_rows == 0:
+        raise ValueError("PSM 레코드를 찾지 못했습니다. 파일이 올바른 mzTab(PSM)인지 확인하세요.")
+
+
+def read_mztab(path: str, columns=None, chunksize: int = 200_000):
+    """
+    mzTab을 한 번만 읽어서 (PSM DataFrame, {ms_run_id: location}) 반환.
+    """
+    msrun_to_path = {}
+    chunks = list(iter_mztab_psm(path, columns, chunksize, msrun_to_path))
+    psm_df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, ignore_index=True)
+    return psm_df, msrun_to_path
+
+
+def read_mztab_psm(path: str, columns=None) -> pd.DataFrame:
+    return read_mztab(path, columns)[0]
+
+
+# BEGIN IONS 라인 (offset 인덱스) + LC run 식별용 header 라인(TITLE/SCANS/RTINSECONDS, mgf_run_identity)을 한 pass로 찾음
+_MGF_INDEX_PAT = re.compile(rb'^[ \t]*(?:BEGIN IONS|(?:TITLE|SCANS?|RTINSEC(?:ONDS)?)=[^\r\n]*)', re.MULTILINE)
+_MGF_END = b'END IONS'
+
+
+def _mgf_index_path(mgf_path):
+    return mgf_path + '.offsets.npz'
+
+
+def _scan_mgf(mgf_path):
+    """
+    MGF를 한 번 훑어서 (BEGIN IONS offset 배열(int64), LC run identity) 반환 (peak 라인은 파싱하지 않음).
+    - identity: 파일 순서대로 TITLE/SCANS/RTINSECONDS 라인의 sha256 (mgf_run_identity 참고)
+    """
+    offsets = []
+    h = hashlib.sha256(b"mgf-run\n")
+    with open(mgf_path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for m in _MGF_INDEX_PAT.finditer(mm):
+                    line = m.group().strip()
+                    if line == b'BEGIN IONS':
+                        offsets.append(m.start())
+                        h.update(b"\n")
+                    else:
+                        h.update(line + b"\t")
+    return np.asarray(offsets, dtype=np.int64), h.hexdigest()
+
+
+def build_mgf_index(mgf_path):
+    """
+    MGF 파일을 한 번 훑어서 각 'BEGIN IONS' 라인의 byte offset 배열(int64)을 반환.
+    - 배열의 i번째 값이 mzTab spectra_ref의 index=i 스펙트럼 시작 위치
+    - peak 라인은 파싱하지 않음
+    """
+    return _scan_mgf(mgf_path)[0]
+
+
+def _load_mgf_sidecar(mgf_path):
+    """
+    sidecar 파일(<mgf>.offsets.npz)에서 (offset 인덱스, LC run identity)를 읽고, 없거나 MGF가 바뀌었으면 새로 생성.
+    - MGF 크기/mtime이 sidecar에 기록된 값과 다르면 재생성 (identity가 없는 이전 형식 sidecar도 재생성)
+    - sidecar를 쓸 수 없는 경우(read-only mount 등) 메모리에만 유지
+    """
+    st = os.stat(mgf_path)
+    idx_path = _mgf_index_path(mgf_path)
+    if os.path.exists(idx_path):
+        try:
+            with np.load(idx_path) as z:
+                if int(z['size']) == st.st_size and int(z['mtime_ns']) == st.st_mtime_ns \
+                        and 'run_identity' in z.files:
+                    return z['offsets'], str(z['run_identity'])
+        except Exception as e:
+            print(f"WARNING: ignoring unreadable MGF index '{idx_path}': {e}")
+
+    offsets, identity = _scan_mgf(mgf_path)
+    try:
+        with open(idx_path, 'wb') as out:
+            np.savez(out, offsets=offsets, size=st.st_size, mtime_ns=st.st_mtime_ns,
+                     run_identity=np.str_(identity))
+    except OSError as e:
+        print(f"WARNING: could not write MGF index '{idx_path}': {e}")
+    return offsets, identity
+
+
+def load_mgf_index(mgf_path):
+    """
+    sidecar 파일(<mgf>.offsets.npz)에서 offset 인덱스를 읽고, 없거나 MGF가 바뀌었으면 새로 생성 (_load_mgf_sidecar).
+    """
+    return _load_mgf_sidecar(mgf_path)[0]
+
+
+def mgf_run_identity(mgf_path):
+    """
+    MGF가 담고 있는 LC run의 식별 hash: 파일 순서대로 TITLE/SCANS/RTINSECONDS 라인만 sha256.
+    - PrecursorSwap decoy MGF는 PEPMASS/CHARGE와 peak만 바뀌고 이 라인들은 target MGF와 같으므로 target/decoy가 같은 값
+      (이름/위치와도 무관하므로 같은 MGF를 다른 디렉토리에 둬도 같은 값)
+    - offset 인덱스와 같은 pass에서 계산해서 sidecar에 저장하므로, 재실행에서는 MGF를 다시 읽지 않음
+    """
+    return _load_mgf_sidecar(mgf_path)[1]
+
+
+_SCAN_PAT_TITLE = re.compile(r'(?:\bscan=(\d+))|(?:\bSCAN=(\d+))|(?:\bscans?=(\d+))')
+_INDEX_PAT_TITLE = re.compile(r'\bindex=(\d+)', re.IGNORECASE)
+_MGF_META_KEYS = {'TITLE', 'SCANS', 'SCAN', 'RTINSECONDS', 'RTINSEC'}
+
+
+def _extract_scan(scan, title):
+    # 1) SCANS/SCAN 값 우선
+    if scan is not None:
+        try:
+            return int(scan.strip())
+        except ValueError:
+            pass
+    # 2) TITLE에서 fallback
+    if title:
+        m = _SCAN_PAT_TITLE.search(title)
+        if m:
+            for g in m.groups():
+                if g is not None:
+                    return int(g)
+        m2 = _INDEX_PAT_TITLE.search(title)  # scan이 없으면 index라도
+        if m2:
+            return int(m2.group(1))
+    return None
+
+
+def _extract_rt_seconds(rt):
+    if rt is None:
+        return None
+    try:
+        return float(rt.strip())
+    except ValueError:
+        return None
+
+
+def _read_mgf_params(mm, pos):
+    """
+    pos(BEGIN IONS 라인 또는 파일 헤더 시작)부터 첫 peak 라인/END IONS 직전까지의
+    KEY=VALUE 중 메타데이터 키만 {KEY(대문자): value(str)} 로 반환. peak 라인은 읽지 않음.
+    """
+    params = {}
+    size = len(mm)
+    while pos < size:
+        nl = mm.find(b'\n', pos)
+        if nl == -1:
+            nl = size
+        line = mm[pos:nl].strip()
+        pos = nl + 1
+        if not line or line[:1] in b'#;!/' or line.startswith(b'BEGIN IONS'):
+            continue
+        if b'=' not in line or line.startswith(_MGF_END):
+            break
+        key, _, val = line.partition(b'=')
+        key = key.strip().upper().decode('ascii', errors='replace')
+        if key in _MGF_META_KEYS:
+            params[key] = val.decode('utf-8', errors='replace').strip()
+    return params
+
+
+def read_mgf_metadata(need: dict, spectral_store=None) -> pd.DataFrame:
+    """
+    MGF를 header 라인만 읽어서 스펙트럼 메타데이터 테이블 생성 (peak 배열은 파싱하지 않음).
+    - need: {mgf_fullpath: index 집합}  (index는 mzTab index=N, 0-based)
+    - 반환 컬럼: mgf_fullpath(category), mgf_index, scan, rt_seconds, title
+    - MGF 앞부분의 global 파라미터는 스펙트럼에 값이 없을 때 기본값으로 사용
+    - spectral_store(디렉토리)가 주어지면 MGF 텍스트 대신 binary spectral store의 메타데이터 테이블을 읽음
+      (open_spectral_store 참고, 같은 store를 MS2PIP 관측 스펙트럼에도 사용)
+    """
+    paths, indices, scans, rts, titles = [], [], [], [], []
+    for full, idx_set in need.items():
+        if spectral_store:
+            store = open_spectral_store(full, spectral_store)
+            idx = np.asarray(sorted(i for i in idx_set if 0 <= i < len(store)), dtype=np.int64)
+            meta = store.meta[idx]
+            paths.extend([full] * len(idx))
+            indices.extend(idx.tolist())
+            scans.extend(s if has else None for s, has in zip(meta['scan'].tolist(), meta['has_scan'].tolist()))
+            rts.extend(meta['rt_seconds'].tolist())
+            titles.extend(store.title(i) for i in idx)
+            continue
+        offsets = load_mgf_index(full)
+        if len(offsets) == 0:
+            continue
+        with open(full, 'rb') as fh, \
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = _read_mgf_params(mm[:int(offsets[0])], 0)
+            for i in sorted(idx_set):
+                if i < 0 or i >= len(offsets):
+                    continue
+                params = _read_mgf_params(mm, int(offsets[i]))
+                if header:
+                    params = {**header, **params}
+                title = params.get('TITLE')
+                scan = params.get('SCANS', params.get('SCAN'))
+                rt = params.get('RTINSECONDS', params.get('RTINSEC'))
+                paths.append(full)
+                indices.append(i)
+                scans.append(_extract_scan(scan, title))
+                rts.append(_extract_rt_seconds(rt))
+                titles.append(title)
+
+    return pd.DataFrame({
+        'mgf_fullpath': pd.Categorical(paths),
+        'mgf_index': np.asarray(indices, dtype=np.int64),
+        'scan': pd.array(scans, dtype='Int64'),
+        'rt_seconds': np.asarray([np.nan if v is None else v for v in rts], dtype=np.float64),
+        'title': pd.Series(titles, dtype=object),
+    })
+
+
+def attach_mgf_metadata(psm_df: pd.DataFrame,
+                        mgf_meta: pd.DataFrame,
+                        msrun_to_full: dict,
+                        *,
+                        inplace: bool = False) -> pd.DataFrame:
+    """
+    psm_df에 MGF 메타데이터(파일명, 전체경로, scan, RT)를 부착.
+    - psm_df: 'ms_run_id', 'mgf_index' 컬럼을 포함해야 함 (int 또는 NaN)
+    - mgf_meta: read_mgf_metadata() 결과 테이블 (mgf_fullpath, mgf_index, scan, rt_seconds)
+    - msrun_to_full: {ms_run_id(int): mgf_fullpath(str)}
+    - inplace: True면 원본 psm_df에 바로 컬럼 추가, False면 복사본 반환
+    """
+    df = psm_df if inplace else psm_df.copy()
+
+    rid = pd.to_numeric(df['ms_run_id'], errors='coerce')
+    idx = pd.to_numeric(df['mgf_index'], errors='coerce')
+    valid = rid.notna() & idx.notna()
+
+    full = pd.Series(None, index=df.index, dtype=object)
+    full[valid] = rid[valid].astype(np.int64).map(msrun_to_full)
+    full = full.where(full.notna(), None)
+
+    meta_index = pd.MultiIndex.from_arrays([mgf_meta['mgf_fullpath'].astype(object),
+                                            mgf_meta['mgf_index'].to_numpy()])
+    keys = pd.MultiIndex.from_arrays([full.to_numpy(),
+                                      idx.fillna(-1).astype(np.int64).to_numpy()])
+    pos = meta_index.get_indexer(keys)
+    found = pos >= 0
+
+    scan = pd.array([pd.NA] * len(df), dtype='Int64')
+    scan[found] = mgf_meta['scan'].array[pos[found]]
+    rt = np.full(len(df), np.nan)
+    rt[found] = mgf_meta['rt_seconds'].to_numpy()[pos[found]]
+
+    df['mgf_file'] = full.map(os.path.basename, na_action='ignore')
+    df['mgf_fullpath'] = full
+    df['scan'] = scan.astype(np.int64) if not scan.isna().any() else scan
+    df['rt_seconds'] = rt
+    df['rt_minutes'] = rt / 60.0
+    return df
+
+
+SPECTRAL_STORE_VERSION = 1
+_SPECTRAL_META_DTYPE = np.dtype([('scan', '<i8'), ('rt_seconds', '<f8'), ('pepmass', '<f8'), ('charge', '<i4'),
+                                 ('has_scan', 'u1'), ('has_title', 'u1')])
+_SPECTRAL_STORE_KEYS = _MGF_META_KEYS | {'PEPMASS', 'CHARGE'}
+_CHARGE_PAT = re.compile(r'\s*(\d+)')
+
+
+def _parse_mgf_block(block):
+    """
+    MGF 스펙트럼 블록(BEGIN IONS ~ END IONS) 또는 파일 헤더 bytes -> ({KEY(대문자): value(str)}, peak 라인 목록).
+    KEY=VALUE는 _read_mgf_params와 같이 첫 peak 라인 전까지만 사용
+    """
+    params, peaks = {}, []
+    for line in block.split(b'\n'):
+        line = line.strip()
+        if not line or line[:1] in b'#;!/' or line.startswith(b'BEGIN IONS'):
+            continue
+        if line.startswith(_MGF_END):
+            break
+        if b'=' in line:
+            if not peaks:
+                key, _, val = line.partition(b'=')
+                key = key.strip().upper().decode('ascii', errors='replace')
+                if key in _SPECTRAL_STORE_KEYS:
+                    params[key] = val.decode('utf-8', errors='replace').strip()
+            continue
+        peaks.append(line)
+    return params, peaks
+
+
+def _peak_arrays(peaks):
+    """
+    peak 라인 목록 -> m/z 오름차순 (m/z, intensity) float32 배열 (ms2pip가 MGF를 읽을 때와 같은 순서).
+    세 번째 이후 컬럼(fragment charge 등)은 무시
+    """
+    tokens = b' '.join(peaks).split()
+    if len(tokens) != 2 * len(peaks):
+        rows = [line.split()[:2] for line in peaks]
+        tokens = [t for row in rows if len(row) == 2 for t in row]
+    values = np.asarray(tokens, dtype=np.float64).reshape(-1, 2).astype(np.float32)
+    values = values[np.argsort(values[:, 0], kind='stable')]
+    return values[:, 0], values[:, 1]
+
+
+def _extract_pepmass(pepmass):
+    try:
+        return float(pepmass.split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return 0.0
+
+
+def _extract_charge(charge):
+    m = _CHARGE_PAT.match(charge) if charge else None
+    return int(m.group(1)) if m else 0
+
+
+def spectral_store_path(root, mgf_path):
+    """root 아래 mgf_path의 store 디렉토리 (<MGF 이름>.<절대 경로 hash>.spectra)"""
+    full = os.path.abspath(mgf_path)
+    return os.path.join(root, f"{os.path.basename(full)}.{hashlib.sha1(full.encode()).hexdigest()[:12]}.spectra")
+
+
+def build_spectral_store(mgf_path, store_path):
+    """
+    MGF를 한 번 파싱해서 store_path에 binary spectral store 작성 (SpectralStore 참고).
+    - 스펙트럼 순서는 load_mgf_index의 BEGIN IONS 순서 (= mzTab index=N)
+    - peak는 스펙트럼 단위로 파일에 이어 쓰므로 MGF 전체를 메모리에 올리지 않음
+    - 임시 디렉토리에 쓴 뒤 rename (동시에 변환한 다른 프로세스가 먼저 끝냈으면 그 결과 사용)
+    """
+    st = os.stat(mgf_path)
+    offsets = load_mgf_index(mgf_path)
+    n = len(offsets)
+    meta = np.zeros(n, dtype=_SPECTRAL_META_DTYPE)
+    peak_offsets = np.zeros(n + 1, dtype=np.int64)
+    title_offsets = np.zeros(n + 1, dtype=np.int64)
+
+    tmp_path = f"{store_path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(mgf_path, 'rb') as fh, \
+            open(os.path.join(tmp_path, 'mz.f32'), 'wb') as mz_out, \
+            open(os.path.join(tmp_path, 'intensity.f32'), 'wb') as intensity_out, \
+            open(os.path.join(tmp_path, 'titles.bin'), 'wb') as title_out:
+        if n:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                header = _parse_mgf_block(mm[:int(offsets[0])])[0]
+                ends = offsets[1:].tolist() + [len(mm)]
+                for i, (start, end) in enumerate(zip(offsets.tolist(), ends)):
+                    params, peaks = _parse_mgf_block(mm[start:end])
+                    if header:
+                        params = {**header, **params}
+                    mz, intensity = _peak_arrays(peaks)
+                    mz_out.write(mz.tobytes())
+                    intensity_out.write(intensity.tobytes())
+                    peak_offsets[i + 1] = peak_offsets[i] + len(mz)
+
+                    title = params.get('TITLE')
+                    title_bytes = title.encode('utf-8') if title else b''
+                    title_out.write(title_bytes)
+                    title_offsets[i + 1] = title_offsets[i] + len(title_bytes)
+
+                    scan = _extract_scan(params.get('SCANS', params.get('SCAN')), title)
+                    rt = _extract_rt_seconds(params.get('RTINSECONDS', params.get('RTINSEC')))
+                    meta[i] = (scan or 0, np.nan if rt is None else rt, _extract_pepmass(params.get('PEPMASS')),
+                               _extract_charge(params.get('CHARGE')), scan is not None, title is not None)
+
+    np.save(os.path.join(tmp_path, 'peak_offsets.npy'), peak_offsets)
+    np.save(os.path.join(tmp_path, 'title_offsets.npy'), title_offsets)
+    np.save(os.path.join(tmp_path, 'meta.npy'), meta)
+    # store.json은 마지막에 써서, 중간에 끊긴 store는 유효하지 않은 것으로 처리
+    with open(os.path.join(tmp_path, 'store.json'), 'w') as out:
+        json.dump({"version": SPECTRAL_STORE_VERSION, "mgf": os.path.abspath(mgf_path), "size": st.st_size,
+                   "mtime_ns": st.st_mtime_ns, "spectra": n, "peaks": int(peak_offsets[-1])}, out)
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    try:
+        os.replace(tmp_path, store_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _spectral_store_stamp(store_path):
+    """store.json의 (MGF 크기, mtime) (없거나 버전이 다르면 None)"""
+    info_path = os.path.join(store_path, 'store.json')
+    if not os.path.exists(info_path):
+        return None
+    try:
+        with open(info_path) as fh:
+            info = json.load(fh)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: ignoring unreadable spectral store '{store_path}': {e}")
+        return None
+    if info.get("version") != SPECTRAL_STORE_VERSION:
+        return None
+    return info.get("size"), info.get("mtime_ns")
+
+
+class SpectralStore:
+    """
+    build_spectral_store로 변환한 MGF 하나의 binary spectral store. 모든 배열은 numpy.memmap으로 읽음 (zero-copy).
+    - mz.f32 / intensity.f32: 모든 스펙트럼의 peak를 이어 붙인 float32 배열
+    - peak_offsets.npy: 스펙트럼 i의 peak 범위 [peak_offsets[i], peak_offsets[i + 1])
+    - meta.npy: 스펙트럼별 scan, rt_seconds, pepmass, charge (+ has_scan, has_title)
+    - titles.bin / title_offsets.npy: 스펙트럼별 TITLE (utf-8)
+    - store.json: 원본 MGF 크기/mtime (open_spectral_store에서 MGF가 바뀌었는지 확인)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mz = self._memmap('mz.f32', np.float32)
+        self.intensity = self._memmap('intensity.f32', np.float32)
+        self.titles = self._memmap('titles.bin', np.uint8)
+        self.peak_offsets = np.load(os.path.join(path, 'peak_offsets.npy'), mmap_mode='r')
+        self.title_offsets = np.load(os.path.join(path, 'title_offsets.npy'), mmap_mode='r')
+        self.meta = np.load(os.path.join(path, 'meta.npy'), mmap_mode='r')
+        self._spectrum_ids = {}
+
+    def _memmap(self, name, dtype):
+        file = os.path.join(self.path, name)
+        if os.path.getsize(file) == 0:
+            # 빈 파일은 mmap 할 수 없음
+            return np.empty(0, dtype=dtype)
+        return np.memmap(file, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return len(self.meta)
+
+    def title(self, i):
+        if not self.meta['has_title'][i]:
+            return None
+        return bytes(self.titles[self.title_offsets[i]:self.title_offsets[i + 1]]).decode('utf-8')
+
+    def spectrum(self, i):
+        """스펙트럼 i -> ms2rescore_rs.MS2Spectrum (MGF를 ms2pip로 읽은 것과 같은 값, RT는 분 단위)"""
+        from ms2rescore_rs import MS2Spectrum, Precursor
+
+        start, end = int(self.peak_offsets[i]), int(self.peak_offsets[i + 1])
+        meta = self.meta[i]
+        rt = float(meta['rt_seconds'])
+        precursor = Precursor(mz=float(meta['pepmass']), rt=0.0 if np.isnan(rt) else rt / 60.0,
+                              charge=int(meta['charge']))
+        return MS2Spectrum(identifier=self.title(i) or "", mz=self.mz[start:end],
+                           intensity=self.intensity[start:end], precursor=precursor)
+
+    def spectrum_ids(self, pattern):
+        """
+        {spectrum_id: 스펙트럼 index}. ms2pip와 같이 TITLE에 pattern을 적용한 첫 group이 spectrum_id.
+        - TITLE이 없거나 peak가 없는 스펙트럼은 ms2pip와 같이 제외
+        - 같은 spectrum_id가 여러 번 나오면 마지막 스펙트럼 (ms2pip에서 나중 결과가 앞 결과를 덮어쓰는 것과 같음)
+        """
+        ids = self._spectrum_ids.get(pattern)
+        if ids is not None:
+            return ids
+        regex = re.compile(pattern or r"(.*)")
+        ids = {}
+        n_peaks = np.diff(self.peak_offsets)
+        for i in np.flatnonzero(self.meta['has_title'] & (n_peaks > 0)).tolist():
+            title = self.title(i)
+            if not title:
+                continue
+            match = regex.search(title)
+            try:
+                ids[match[1]] = i
+            except (TypeError, IndexError):
+                from ms2pip.exceptions import TitlePatternError
+                raise TitlePatternError(
+                    f"Spectrum title pattern `{pattern}` could not be matched to spectrum ID `{title}`. "
+                    " Are you sure that the regex contains a capturing group?"
+                )
+        self._spectrum_ids[pattern] = ids
+        return ids
+
+    def attach(self, psm_list, pattern):
+        """
+        psm_list의 PSM마다 spectrum_id가 같은 스펙트럼을 psm.spectrum에 붙임 (같은 스펙트럼 객체는 공유).
+        반환: 스펙트럼을 붙인 PSM의 psm_list 내 위치 배열
+        """
+        ids = self.spectrum_ids(pattern)
+        spectra, positions = {}, []
+        for pos, psm in enumerate(psm_list):
+            i = ids.get(str(psm.spectrum_id))
+            if i is None:
+                continue
+            spectrum = spectra.get(i)
+            if spectrum is None:
+                spectrum = spectra[i] = self.spectrum(i)
+            psm.spectrum = spectrum
+            positions.append(pos)
+        return np.asarray(positions, dtype=np.int64)
+
+
+_SPECTRAL_STORES = {}
+
+
+def open_spectral_store(mgf_path, root):
+    """
+    mgf_path의 SpectralStore (root 디렉토리 아래). 없거나 MGF 크기/mtime이 바뀌었으면 한 번 변환해서 만듦.
+    - 같은 프로세스에서는 열어둔 store를 재사용 (metadata attach와 MS2PIP 사이, worker mode의 job 사이)
+    """
+    st = os.stat(mgf_path)
+    stamp = (st.st_size, st.st_mtime_ns)
+    path = spectral_store_path(root, mgf_path)
+    cached = _SPECTRAL_STORES.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    if _spectral_store_stamp(path) != stamp:
+        t0 = time.perf_counter()
+        os.makedirs(root, exist_ok=True)
+        build_spectral_store(mgf_path, path)
+        print(f"spectral store: converted {os.path.basename(mgf_path)} -> {path} ({time.perf_counter() - t0:.1f} s)")
+    store = SpectralStore(path)
+    _SPECTRAL_STORES[path] = (stamp, store)
+    return store
+
+
+class PredictionCache:
+    """
+    MS2PIP 예측 intensity와 DeepLC 예측 RT(calibration 전)를 저장하는 SQLite cache.
+    - MS2PIP: (peptidoform, charge, model) -> b/y 예측 intensity 배열
+    - DeepLC: (peptidoform, model) -> 예측 RT  (charge는 0으로 저장)
+    - 파일 크기가 max_mb를 넘으면 가장 오래 사용되지 않은 항목부터 삭제 (LRU)
+    - target/decoy를 --parallel로 돌려도 같은 파일을 공유할 수 있도록 WAL 모드 사용
+    """
+
+    def __init__(self, path, max_mb=4096):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._conn = sqlite3.connect(path, timeout=600)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                peptidoform TEXT NOT NULL,
+                charge INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                value BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                UNIQUE (kind, model, peptidoform, charge)
+            );
+            CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used);
+        """)
+
+    def close(self):
+        self._conn.close()
+
+    def _lookup(self, kind, model, keys):
+        found = {}
+        peptidoforms = list({pep for pep, _ in keys})
+        wanted = set(keys)
+        for start in range(0, len(peptidoforms), 900):
+            part = peptidoforms[start:start + 900]
+            rows = self._conn.execute(
+                f"SELECT peptidoform, charge, dtype, value FROM predictions "
+                f"WHERE kind=? AND model=? AND peptidoform IN ({','.join('?' * len(part))})",
+                [kind, model, *part],
+            )
+            for pep, charge, dtype, value in rows:
+                if (pep, charge) in wanted:
+                    found[(pep, charge)] = np.frombuffer(value, dtype=dtype)
+        if found:
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE predictions SET last_used=? "
+                    "WHERE kind=? AND model=? AND peptidoform=? AND charge=?",
+                    [(now, kind, model, pep, charge) for pep, charge in found],
+                )
+        return found
+
+    def _store(self, kind, model, values):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO predictions "
+                "(kind, model, peptidoform, charge, dtype, value, last_used) VALUES (?,?,?,?,?,?,?)",
+                [(kind, model, pep, charge, arr.dtype.str, arr.tobytes(), now)
+                 for (pep, charge), arr in values.items()],
+            )
+        self._evict()
+
+    def _evict(self):
+        def live_bytes():
+            page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+            page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+            free = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return (page_count - free) * page_size
+
+        while live_bytes() > self.max_bytes:
+            n_rows = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+            if n_rows == 0:
+                break
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM predictions WHERE id IN "
+                    "(SELECT id FROM predictions ORDER BY last_used LIMIT ?)",
+                    (max(1, n_rows // 10),),
+                )
+
+    def get_or_predict(self, kind, model, keys, predict):
+        """
+        keys(중복 허용)에 대한 예측값 dict 반환. cache에 없는 key만 predict(missing_keys)로 예측.
+        - predict: missing key 목록 -> {key: np.ndarray} (예측 실패한 key는 빠져도 됨)
+        """
+        unique = list(dict.fromkeys(keys))
+        found = self._lookup(kind, model, unique)
+        missing = [k for k in unique if k not in found]
+        if missing:
+            predicted = predict(missing)
+            if predicted:
+                self._store(kind, model, predicted)
+                found.update(predicted)
+        n = len(unique)
+        hits = n - len(missing)
+        print(f"{kind} prediction cache: {hits}/{n} hits ({hits / n if n else 0:.1%}), model={model}")
+        return found
+
+
+def open_prediction_cache(path):
+    if not path:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    max_mb = float(os.getenv("NOVOCERT_PREDICTION_CACHE_MB", "4096"))
+    return PredictionCache(path, max_mb=max_mb)
+
+
+def _peptidoform_key(psm):
+    # charge를 제외한 proforma (fixed modification 적용 후)
+    return psm.peptidoform.proforma.split('/')[0]
+
+
+def add_ms2pip_features(ms2pip_fgen, psm_list, cache=None, spectral_store=None):
+    """
+    MS2PIPFeatureGenerator.add_features와 같은 feature를 추가.
+    cache가 있으면 관측 스펙트럼 annotation만 매번 수행하고, 예측 intensity는
+    cache에 없는 (peptidoform, charge)만 MS2PIP으로 예측.
+    spectral_store가 있으면 관측 스펙트럼을 MGF 대신 binary spectral store에서 읽음.
+    """
+    if cache is None and not spectral_store:
+        ms2pip_fgen.add_features(psm_list)
+        return
+
+    from ms2rescore.utils import infer_spectrum_path
+    from psm_utils import PSMList
+
+    psm_dict = psm_list.get_psm_dict()
+    for runs in psm_dict.values():
+        for run, psms in runs.items():
+            psm_list_run = PSMList(psm_list=list(chain.from_iterable(psms.values())))
+            spectrum_filename = infer_spectrum_path(ms2pip_fgen.spectrum_path, run)
+            spectra = open_spectral_store(spectrum_filename, spectral_store) if spectral_store else None
+            results = ms2pip_run_results(ms2pip_fgen, psm_list_run, spectrum_filename, cache, spectra)
+            ms2pip_fgen._calculate_features(psm_list_run, results)
+
+
+def _store_run_results(ms2pip_fgen, psm_list_run, spectra, cache=None):
+    """
+    SpectralStore의 스펙트럼을 PSM에 붙여서 ms2pip에 넘김 (ms2pip가 MGF를 다시 파싱하지 않음).
+    ms2pip는 모든 PSM에 스펙트럼이 있어야 하므로 매칭된 PSM만 넘기고, psm_index는 psm_list_run 기준으로 되돌림
+    """
+    from ms2pip.exceptions import NoMatchingSpectraFound
+
+    positions = spectra.attach(psm_list_run, ms2pip_fgen.spectrum_id_pattern)
+    try:
+        if len(positions) == 0:
+            raise NoMatchingSpectraFound("No spectra matching spectrum IDs from PSM list could be found.")
+        results = ms2pip_run_results(ms2pip_fgen, _run_psm_list(psm_list_run, positions), None, cache)
+    finally:
+        # checkpoint/feature 계산 worker로 넘길 때 스펙트럼까지 pickle 하지 않도록 떼어냄
+        for pos in positions.tolist():
+            psm_list_run.psm_list[pos].spectrum = None
+    for r in results:
+        r.psm_index = int(positions[r.psm_index])
+    return results
+
+
+def ms2pip_run_results(ms2pip_fgen, psm_list_run, spectrum_filename, cache=None, spectra=None):
+    """
+    run 하나의 MS2PIP ProcessingResult 목록 (b/y ion별 관측/예측 log2 intensity).
+    - cache가 없으면 ms2pip.correlate (MS2PIPFeatureGenerator.add_features와 같은 호출)
+    - cache가 있으면 관측 스펙트럼 annotation 후, cache에 없는 (peptidoform, charge)만 예측
+    - spectra(SpectralStore)가 있으면 spectrum_filename 대신 store의 스펙트럼 사용
+    """
+    from ms2pip import annotate_spectra, correlate, predict_batch, __version__ as ms2pip_version
+    from ms2pip.constants import MODELS
+    from psm_utils import PSMList
+
+    if spectra is not None:
+        return _store_run_results(ms2pip_fgen, psm_list_run, spectra, cache)
+    spectrum_file = None if spectrum_filename is None else str(spectrum_filename)
+
+    if cache is None:
+        return correlate(
+            psms=psm_list_run,
+            spectrum_file=spectrum_file,
+            spectrum_id_pattern=ms2pip_fgen.spectrum_id_pattern,
+            model=ms2pip_fgen.model,
+            ms2_tolerance=ms2pip_fgen.ms2_tolerance,
+            compute_correlations=False,
+            model_dir=ms2pip_fgen.model_dir,
+            processes=ms2pip_fgen.processes,
+        )
+
+    results = annotate_spectra(
+        psm_list_run,
+        spectrum_file=spectrum_file,
+        spectrum_id_pattern=ms2pip_fgen.spectrum_id_pattern,
+        model=ms2pip_fgen.model,
+        ms2_tolerance=ms2pip_fgen.ms2_tolerance,
+        processes=ms2pip_fgen.processes,
+    )
+
+    model_key = f"{ms2pip_fgen.model}|ms2pip-{ms2pip_version}"
+    # ion type별 예측 배열을 (ion type 수, ion 수) 형태로 쌓아서 저장
+    ion_types = [it.lower() for it in MODELS[ms2pip_fgen.model]["ion_types"]]
+    keys = [(_peptidoform_key(psm), int(psm.peptidoform.precursor_charge)) for psm in psm_list_run]
+    first_psm = {}
+    for key, psm in zip(keys, psm_list_run):
+        first_psm.setdefault(key, psm)
+
+    def predict(missing):
+        preds = predict_batch(
+            PSMList(psm_list=[first_psm[k] for k in missing]),
+            model=ms2pip_fgen.model,
+            model_dir=ms2pip_fgen.model_dir,
+            processes=ms2pip_fgen.processes,
+        )
+        return {
+            missing[r.psm_index]: np.stack([r.predicted_intensity[it] for it in ion_types]).ravel()
+            for r in preds if r.predicted_intensity is not None
+        }
+
+    predicted = cache.get_or_predict("ms2pip", model_key, keys, predict)
+    for r in results:
+        arr = predicted.get(keys[r.psm_index])
+        if arr is None:
+            r.observed_intensity = None
+            continue
+        r.predicted_intensity = dict(zip(ion_types, arr.reshape(len(ion_types), -1)))
+    return results
+
+
+def _deeplc_models(predictor):
+    if isinstance(predictor.model, dict):
+        return list(predictor.model.values())
+    if isinstance(predictor.model, list):
+        return list(predictor.model)
+    return [predictor.model]
+
+
+def predict_deeplc_rt(predictor, psm_list, cache):
+    """
+    calibration이 끝난 DeepLC predictor로 RT 예측 (predictor.make_preds와 동일 결과).
+    calibration 전 예측값을 (peptidoform, model) 단위로 cache하고, calibration은 매번 적용.
+    """
+    from deeplc import __version__ as deeplc_version
+    from psm_utils import PSMList
+
+    keys = [(_peptidoform_key(psm), 0) for psm in psm_list]
+    first_psm = {}
+    for key, psm in zip(keys, psm_list):
+        first_psm.setdefault(key, psm)
+
+    per_model = []
+    for m in _deeplc_models(predictor):
+        def predict(missing, m=m):
+            preds = predictor.make_preds(
+                psm_list=PSMList(psm_list=[first_psm[k] for k in missing]),
+                calibrate=False,
+                mod_name=m,
+            )
+            return {k: np.asarray([v], dtype=np.float32) for k, v in zip(missing, preds)}
+
+        model_key = f"{os.path.basename(str(m))}|deeplc-{deeplc_version}"
+        uncal = cache.get_or_predict("deeplc", model_key, keys, predict)
+        uncal = np.concatenate([uncal[k] for k in keys])
+        try:
+            cal = predictor.calibration_core(uncal, predictor.calibrate_dict[m],
+                                             predictor.calibrate_min[m], predictor.calibrate_max[m])
+        except (KeyError, TypeError, IndexError):
+            cal = predictor.calibration_core(uncal, predictor.calibrate_dict,
+                                             predictor.calibrate_min, predictor.calibrate_max)
+        per_model.append(cal)
+    return np.array([sum(a) / len(a) for a in zip(*per_model)])
+
+
+def _run_mgf_path(mgf_dir, run):
+    # PSM의 run은 MGF 파일 이름 (attach_mgf_stage의 mgf_file)
+    path = os.path.join(mgf_dir, str(run)) if mgf_dir else None
+    return path if path and os.path.isfile(path) else None
+
+
+class DeepLCCalibrationStore:
+    """
+    LC run별 DeepLC calibration(선택된 모델 포함) 저장소: <root>/<mgf_run_identity>.pkl
+    - 같은 LC run(TITLE/SCANS/RTINSECONDS가 같은 MGF)은 calibration을 다시 fitting하지 않고 재사용
+      (target run에서 fitting한 calibration을 같은 LC run의 decoy MGF와 이후 재실행에서 사용)
+    - target에서 fitting한 calibration은 target/decoy 모두, decoy에서 fitting한 것은 decoy만 재사용
+    - DeepLC 버전, DEEPLC_PARAMS, 모델 설정이 저장 당시와 다르거나 모델 파일이 없으면 stale로 보고 다시 fitting,
+      force=True(--recalibrate)이면 이번 실행 전에 저장된 calibration은 쓰지 않고 다시 fitting해서 덮어씀
+      (이번 실행에서 target이 새로 fitting한 calibration은 decoy가 재사용)
+    - spawn된 프로세스(--parallel, shard)로 넘길 수 있도록 경로와 설정만 가짐
+    """
+
+    def __init__(self, root, label="target", force=False):
+        self.root = root
+        self.label = label
+        self.force = force
+        self.created = time.time()
+
+    def checkpoint_key(self):
+        # calibration 재사용/강제 refit 여부가 바뀌면 deeplc stage checkpoint도 다시 계산
+        return ("deeplc-calibration-store", self.force)
+
+    def _path(self, mgf_path):
+        return os.path.join(self.root, mgf_run_identity(mgf_path) + ".pkl")
+
+    @staticmethod
+    def _signature(deeplc_fgen):
+        return (_package_version("deeplc"), repr(sorted(DEEPLC_PARAMS.items())), repr(deeplc_fgen.user_model))
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as fh:
+                return pickle.load(fh)
+        except Exception as e:
+            print(f"WARNING: ignore unreadable DeepLC calibration {path}: {e}")
+            return None
+
+    def load(self, deeplc_fgen, mgf_path):
+        """mgf_path에 대해 재사용할 수 있는 calibration record (없거나 stale이면 None)"""
+        if not mgf_path:
+            return None
+        path = self._path(mgf_path)
+        record = self._read(path) if os.path.exists(path) else None
+        if record is None or record["fitted_on"] not in ("target", self.label):
+            return None
+        if self.force and record["fitted_at"] < self.created:
+            return None
+        if record["signature"] != self._signature(deeplc_fgen):
+            print(f"DeepLC calibration {path} is stale (DeepLC version or parameters changed), recalibrate")
+            return None
+        if not all(os.path.exists(str(m)) for m in record["model"]):
+            print(f"DeepLC calibration {path} is stale (model files not found), recalibrate")
+            return None
+        return record
+
+    def save(self, deeplc_fgen, mgf_path, predictor):
+        if not mgf_path:
+            return
+        path = self._path(mgf_path)
+        if self.label != "target" and os.path.exists(path):
+            # --parallel에서 target이 먼저 저장한 유효한 calibration은 decoy calibration으로 덮어쓰지 않음
+            record = self._read(path)
+            if record is not None and record["fitted_on"] == "target" \
+                    and record["signature"] == self._signature(deeplc_fgen):
+                return
+        os.makedirs(self.root, exist_ok=True)
+        record = {
+            "fitted_on": self.label,
+            "signature": self._signature(deeplc_fgen),
+            "mgf": os.path.abspath(mgf_path),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "fitted_at": time.time(),
+            "model": predictor.model,
+            "calibrate_dict": predictor.calibrate_dict,
+            "calibrate_min": predictor.calibrate_min,
+            "calibrate_max": predictor.calibrate_max,
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as fh:
+            pickle.dump(record, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+def calibrate_deeplc(deeplc_fgen, psm_list_run, calibrations=None, mgf_path=None):
+    """
+    run 하나의 상위 score PSM으로 calibration한 DeepLC predictor 반환.
+    첫 run에서 선택된 모델을 이후 run에도 사용 (calibration은 run마다 수행)
+    calibrations(DeepLCCalibrationStore)가 주어지면 같은 LC run의 저장된 calibration을 재사용하고,
+    새로 fitting한 calibration은 저장.
+    """
+    record = calibrations.load(deeplc_fgen, mgf_path) if calibrations is not None else None
+    if record is not None and deeplc_fgen.selected_model \
+            and sorted(map(str, record["model"])) != sorted(map(str, deeplc_fgen.selected_model)):
+        # 이 sample의 첫 run에서 고른 모델과 다르면 run 사이 모델을 맞추기 위해 다시 fitting
+        record = None
+    if record is not None:
+        print(f"DeepLC calibration: reuse {record['fitted_on']} calibration of {os.path.basename(record['mgf'])} "
+              f"({record['created']})")
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        if record is not None:
+            predictor = deeplc_fgen.DeepLC(
+                n_jobs=deeplc_fgen.processes,
+                verbose=deeplc_fgen._verbose,
+                path_model=list(record["model"]),
+                **deeplc_fgen.deeplc_kwargs,
+            )
+            predictor.model = record["model"]
+            predictor.calibrate_dict = record["calibrate_dict"]
+            predictor.calibrate_min = record["calibrate_min"]
+            predictor.calibrate_max = record["calibrate_max"]
+        else:
+            psm_list_calibration = deeplc_fgen._get_calibration_psms(psm_list_run)
+            predictor = deeplc_fgen.DeepLC(
+                n_jobs=deeplc_fgen.processes,
+                verbose=deeplc_fgen._verbose,
+                path_model=deeplc_fgen.selected_model or deeplc_fgen.user_model,
+                **deeplc_fgen.deeplc_kwargs,
+            )
+            predictor.calibrate_preds(psm_list_calibration)
+        if not deeplc_fgen.selected_model:
+            deeplc_fgen.selected_model = list(predictor.model.keys())
+            deeplc_fgen.deeplc_kwargs["deeplc_retrain"] = False
+    if record is None and calibrations is not None:
+        calibrations.save(deeplc_fgen, mgf_path, predictor)
+    return predictor
+
+
+def add_deeplc_features(deeplc_fgen, psm_list, cache=None, calibrations=None, mgf_dir=None):
+    """
+    DeepLCFeatureGenerator.add_features와 같은 feature를 추가.
+    cache가 있으면 run별 calibration은 그대로 수행하고, 예측은 predict_deeplc_rt로 cache 재사용.
+    calibrations가 있으면 run(MGF)별 calibration을 저장/재사용 (calibrate_deeplc 참고).
+    """
+    if cache is None and calibrations is None:
+        deeplc_fgen.add_features(psm_list)
+        return
+
+    from psm_utils import PSMList
+
+    psm_dict = psm_list.get_psm_dict()
+    for runs in psm_dict.values():
+        deeplc_fgen.selected_model = None
+        for run, psms in runs.items():
+            print(f"Running DeepLC for PSMs from run `{run}`...")
+            psm_list_run = PSMList(psm_list=list(chain.from_iterable(psms.values())))
+            predictor = calibrate_deeplc(deeplc_fgen, psm_list_run, calibrations, _run_mgf_path(mgf_dir, run))
+            if cache is None:
+                with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+                    predictions = np.array(predictor.make_preds(psm_list_run))
+            else:
+                predictions = predict_deeplc_rt(predictor, psm_list_run, cache)
+
+            observations = psm_list_run["retention_time"]
+            rt_diffs_run = np.abs(predictions - observations)
+
+            best = {}
+            peptides = [psm.peptidoform.proforma.split("\\")[0] for psm in psm_list_run]
+            for i, psm in enumerate(psm_list_run):
+                psm["rescoring_features"].update({
+                    "observed_retention_time": observations[i],
+                    "predicted_retention_time": predictions[i],
+                    "rt_diff": rt_diffs_run[i],
+                })
+                if peptides[i] not in best or best[peptides[i]]["rt_diff_best"] > rt_diffs_run[i]:
+                    best[peptides[i]] = {
+                        "observed_retention_time_best": observations[i],
+                        "predicted_retention_time_best": predictions[i],
+                        "rt_diff_best": rt_diffs_run[i],
+                    }
+            for i, psm in enumerate(psm_list_run):
+                psm["rescoring_features"].update(best[peptides[i]])
+
+
+# lean mode: PIN에 들어가는 feature(SA <- cos, absdRT <- rt_diff, absdMppm <- abs_ms1_error_ppm)만
+# PSM별 feature dict 없이 배열로 계산
+_LOADED_MODELS = {}
+
+
+def _memoized_loader(load, key):
+    def loader(*args, **kwargs):
+        k = key(*args, **kwargs)
+        if k not in _LOADED_MODELS:
+            _LOADED_MODELS[k] = load(*args, **kwargs)
+        return _LOADED_MODELS[k]
+    loader.__wrapped__ = load
+    return loader
+
+
+def keep_models_loaded():
+    """
+    MS2PIP XGBoost 모델과 DeepLC Keras 모델을 프로세스 안에서 한 번만 load해서 재사용 (worker mode).
+    ms2pip(correlate/predict_batch)와 DeepLC(make_preds/calibrate_preds)는 호출할 때마다 모델 파일을
+    다시 읽으므로, 두 패키지의 loader를 모델 파일 기준으로 memo하는 함수로 바꿈 (예측값은 같음).
+    """
+    from ms2pip._utils import xgb_models
+    import deeplc.deeplc as deeplc_core
+
+    if not hasattr(xgb_models.load_xgb_models, "__wrapped__"):
+        xgb_models.load_xgb_models = _memoized_loader(
+            xgb_models.load_xgb_models,
+            lambda model_params, model_dir, processes=None: (
+                "ms2pip", tuple(sorted(model_params["xgboost_model_files"].items())), str(model_dir), processes))
+    if not hasattr(deeplc_core.load_model, "__wrapped__"):
+        deeplc_core.load_model = _memoized_loader(deeplc_core.load_model,
+                                                  lambda path, *args, **kwargs: ("deeplc", str(path)))
+
+
+FEATURE_MODES = ("lean", "full")
+
+
+def _run_positions(psm_list):
+    """[(run, PSMList 내 위치 배열)] (get_psm_dict와 같이 run이 처음 나온 순서)"""
+    codes, runs = pd.factorize(np.asarray(psm_list["run"], dtype=object))
+    order = np.argsort(codes, kind="stable")
+    bounds = np.cumsum(np.bincount(codes, minlength=len(runs)))[:-1]
+    return list(zip(runs, np.split(order, bounds)))
+
+
+def _run_psm_list(psm_list, positions):
+    from psm_utils import PSMList
+    return PSMList(psm_list=[psm_list.psm_list[i] for i in positions])
+
+
+def ms1_error_ppm(psm_list):
+    """
+    BasicFeatureGenerator의 abs_ms1_error_ppm과 같은 값 (|precursor m/z - theoretical m/z| ppm).
+    build_psm_list의 PSM들은 peptidoform 객체를 공유하므로 theoretical m/z는 객체별로 한 번만 계산
+    """
+    theo = {}
+    theo_mz = np.empty(len(psm_list))
+    for i, psm in enumerate(psm_list.psm_list):
+        key = id(psm.peptidoform)
+        mz = theo.get(key)
+        if mz is None:
+            mz = theo[key] = psm.peptidoform.theoretical_mz
+        theo_mz[i] = mz
+    precursor_mzs = np.asarray(psm_list["precursor_mz"], dtype=np.float64)
+    return np.abs((precursor_mzs - theo_mz) / theo_mz * 10**6)
+
+
+def spectral_cosine(results, n):
+    """
+    MS2PIP 결과 목록 -> PSM별 b/y ion 전체 cosine similarity (ms2rescore 'cos' feature와 같은 정의:
+    log2 intensity를 log2(0.001)에서 clip하고 2**x - 0.001로 되돌린 관측/예측 intensity의 cosine).
+    모든 PSM의 ion 배열을 하나로 이어 붙여 segment 합으로 한 번에 계산.
+    - 반환: 길이 n 배열 (psm_index 위치), 결과가 없는 PSM은 NaN, norm이 0이면 0
+    """
+    cos = np.full(n, np.nan)
+    done = [r for r in results if r.observed_intensity is not None and r.predicted_intensity is not None]
+    if not done:
+        return cos
+
+    floor = np.log2(0.001)
+
+    def unlog(attr):
+        arr = np.concatenate([x for r in done for x in (getattr(r, attr)["b"], getattr(r, attr)["y"])])
+        return (2 ** arr.clip(floor) - 0.001).astype(np.float64)
+
+    predicted = unlog("predicted_intensity")
+    observed = unlog("observed_intensity")
+    lengths = np.fromiter((len(r.predicted_intensity["b"]) + len(r.predicted_intensity["y"]) for r in done),
+                          dtype=np.int64, count=len(done))
+    segment = np.repeat(np.arange(len(done)), lengths)
+
+    def segment_sum(values):
+        return np.bincount(segment, weights=values, minlength=len(done))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = segment_sum(predicted * observed) / (
+            np.sqrt(segment_sum(predicted * predicted)) * np.sqrt(segment_sum(observed * observed)))
+    positions = np.fromiter((r.psm_index for r in done), dtype=np.int64, count=len(done))
+    cos[positions] = np.where(np.isnan(value), 0.0, value)
+    return cos
+
+
+def ms2pip_cosine(ms2pip_fgen, psm_list, cache=None, spectral_store=None):
+    """run별 MS2PIP 관측/예측 intensity에서 cos만 계산 (PSMList 순서 배열)"""
+    from ms2rescore.utils import infer_spectrum_path
+
+    cos = np.full(len(psm_list), np.nan)
+    for run, positions in _run_positions(psm_list):
+        print(f"Running MS2PIP for PSMs from run `{run}`...")
+        spectrum_filename = infer_spectrum_path(ms2pip_fgen.spectrum_path, run)
+        spectra = open_spectral_store(spectrum_filename, spectral_store) if spectral_store else None
+        results = ms2pip_run_results(ms2pip_fgen, _run_psm_list(psm_list, positions), spectrum_filename, cache,
+                                     spectra)
+        cos[positions] = spectral_cosine(results, len(positions))
+    n_missing = int(np.isnan(cos).sum())
+    if n_missing:
+        print(f"WARNING: MS2PIP cos is missing for {n_missing} PSMs (no matching spectrum or prediction)")
+    return cos
+
+
+def deeplc_rt_diff(deeplc_fgen, psm_list, cache=None, calibrations=None, mgf_dir=None):
+    """run별 DeepLC calibration 후 |예측 RT - 관측 RT|만 계산 (PSMList 순서 배열)"""
+    rt_diff = np.full(len(psm_list), np.nan)
+    deeplc_fgen.selected_model = None
+    for run, positions in _run_positions(psm_list):
+        print(f"Running DeepLC for PSMs from run `{run}`...")
+        psm_list_run = _run_psm_list(psm_list, positions)
+        predictor = calibrate_deeplc(deeplc_fgen, psm_list_run, calibrations, _run_mgf_path(mgf_dir, run))
+        if cache is None:
+            with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+                predictions = np.array(predictor.make_preds(psm_list_run))
+        else:
+            predictions = predict_deeplc_rt(predictor, psm_list_run, cache)
+        rt_diff[positions] = np.abs(predictions - psm_list_run["retention_time"])
+    return rt_diff
+
+
+def _cpu_seconds():
+    # user + system, wait()가 끝난 자식 프로세스(MS2PIP/DeepLC pool) 포함
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Linux ru_maxrss 단위는 KB
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def _row_count(out):
+    if isinstance(out, tuple) and out:
+        out = out[0]
+    try:
+        return len(out)
+    except TypeError:
+        return None
+
+
+class StageProfiler:
+    """
+    sub-stage별 wall time, CPU time, peak RSS, row 수를 기록하고 log로 출력.
+    - stage가 중첩되면 (lazy stage 호출) 안쪽 stage 시간은 바깥 stage에서 빼서 해당 stage 시간만 기록
+    - profile_dir가 주어지면 stage마다 cProfile 결과를 <profile_dir>/<stage>.prof 로 저장
+    - 별도 프로세스(--parallel, shard)의 기록은 _profiled_call()로 부모 프로세스에 전달
+    """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.records = []
+        self._scope = []
+        self._stack = []
+
+    @property
+    def current_scope(self):
+        return tuple(self._scope)
+
+    @contextlib.contextmanager
+    def scope(self, *names):
+        """stage 이름 앞에 붙일 prefix (예: target/run1/ms2pip)"""
+        self._scope.extend(names)
+        try:
+            yield
+        finally:
+            del self._scope[len(self._scope) - len(names):]
+
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        """with PROFILER.stage(name) as rec: ...; rec["rows"] = n"""
+        rec = {"stage": "/".join(self._scope + [name]), "rows": rows, "status": "ok"}
+        frame = {"child_wall": 0.0, "child_cpu": 0.0,
+                 "prof": cProfile.Profile() if self.profile_dir else None}
+        if self._stack and self._stack[-1]["prof"] is not None:
+            self._stack[-1]["prof"].disable()
+        self._stack.append(frame)
+        wall0, cpu0 = time.perf_counter(), _cpu_seconds()
+        if frame["prof"] is not None:
+            frame["prof"].enable()
+        try:
+            yield rec
+        except BaseException:
+            rec["status"] = "error"
+            raise
+        finally:
+            if frame["prof"] is not None:
+                frame["prof"].disable()
+            wall, cpu = time.perf_counter() - wall0, _cpu_seconds() - cpu0
+            self._stack.pop()
+            if self._stack:
+                parent = self._stack[-1]
+                parent["child_wall"] += wall
+                parent["child_cpu"] += cpu
+            rec.update(wall_s=round(wall - frame["child_wall"], 3),
+                       cpu_s=round(cpu - frame["child_cpu"], 3),
+                       peak_rss_mb=round(_peak_rss_mb(), 1),
+                       children_peak_rss_mb=round(_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+                       pid=os.getpid())
+            if frame["prof"] is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                rec["profile"] = os.path.join(self.profile_dir, rec["stage"].replace("/", ".") + ".prof")
+                frame["prof"].dump_stats(rec["profile"])
+            if self._stack and self._stack[-1]["prof"] is not None:
+                self._stack[-1]["prof"].enable()
+            self.records.append(rec)
+            rows = f", rows {rec['rows']}" if rec["rows"] is not None else ""
+            print(f"[metrics] {rec['stage']}: wall {rec['wall_s']:.2f} s, cpu {rec['cpu_s']:.2f} s, "
+                  f"peak RSS {rec['peak_rss_mb']:.0f} MB{rows}")
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def write_metrics(self, path, wall_s, command=None, cpu_start=0.0):
+        """stage 기록을 metrics.json으로 저장 (worker mode에서는 job 옵션과 job 시작 이후 CPU time)"""
+        metrics = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "command": command or sys.argv,
+            "wall_s": round(wall_s, 3),
+            "cpu_s": round(_cpu_seconds() - cpu_start, 3),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "children_peak_rss_mb": round(_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            "stages": self.records,
+        }
+        with open(path + ".tmp", "w") as fh:
+            json.dump(metrics, fh, indent=2)
+        os.replace(path + ".tmp", path)
+        return path
+
+
+# spawn된 worker 프로세스도 같은 설정을 쓰도록 profile 경로는 환경변수로 전달
+PROFILER = StageProfiler(os.getenv("NOVOCERT_PROFILE_DIR"))
+METRICS_FILE_NAME = "metrics.json"
+
+
+def _profiled_call(scope, func, *args):
+    """별도 프로세스에서 func 실행 후 (결과, 그 프로세스의 stage 기록) 반환"""
+    with PROFILER.scope(*scope):
+        out = func(*args)
+    return out, PROFILER.drain()
+
+
+CHECKPOINT_VERSION = 3
+FEATURE_STAGES = ("mztab", "mgf_meta", "rank1", "basic", "ms2pip", "deeplc")
+
+MS2PIP_PARAMS = {"model": "HCD", "ms2_tolerance": 0.02}
+DEEPLC_PARAMS = {"lower_score_is_better": False, "calibration_set_size": 0.15, "deeplc_retrain": False}
+PSM_MODIFICATION_RENAME = {
+    "gl": "Gln->pyro-Glu",
+    "ox": "Oxidation",
+    "ac": "Acetylation",
+    "de": "Deamidation",
+    "ca": "Carbamylation",
+    "al": "Ammonia-loss"
+}
+PSM_FIXED_MODIFICATIONS = [("U:Carbamidomethyl", ["C"])]
+
+
+def file_fingerprint(path, sample_bytes=1 << 20):
+    """
+    파일 크기 + mtime + 앞/뒤 sample_bytes 내용의 sha256.
+    (수십 GB MGF 전체를 매번 hash하지 않도록 load_mgf_index와 같은 크기/mtime 기준 사용)
+    - 한계: 크기와 mtime이 그대로인 채 파일 중간만 바뀐 경우(cp -p / rsync -t로 같은 크기 파일을 덮어쓴 경우 등)는
+      감지하지 못함. 이런 식으로 MGF를 교체했다면 checkpoint 디렉토리를 지우고 다시 실행할 것
+    """
+    st = os.stat(path)
+    h = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        h.update(fh.read(sample_bytes))
+        if st.st_size > 2 * sample_bytes:
+            fh.seek(-sample_bytes, os.SEEK_END)
+            h.update(fh.read(sample_bytes))
+    return f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}:{h.hexdigest()}"
+
+
+def _package_version(name):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def _stage_key(prev_key, *parts):
+    h = hashlib.sha256(f"v{CHECKPOINT_VERSION}".encode())
+    h.update((prev_key or "").encode())
+    for part in parts:
+        h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+def _mgf_fingerprints(mgf_dir):
+    mgf_files = sorted(glob.glob(os.path.join(mgf_dir, "*.mgf")) + glob.glob(os.path.join(mgf_dir, "*.MGF")))
+    return [file_fingerprint(p) for p in mgf_files]
+
+
+def _feature_keys_after_mztab(mztab_key, mgf_fingerprints, pattern, feature_mode="lean", deeplc_calibration=None):
+    keys = {}
+    keys["mgf_meta"] = _stage_key(mztab_key, mgf_fingerprints)
+    keys["rank1"] = _stage_key(keys["mgf_meta"], PSM_MODIFICATION_RENAME, PSM_FIXED_MODIFICATIONS,
+                               _package_version("psm_utils"))
+    keys["basic"] = _stage_key(keys["rank1"], _package_version("ms2rescore"), feature_mode)
+    keys["ms2pip"] = _stage_key(keys["basic"], MS2PIP_PARAMS, pattern, _package_version("ms2pip"))
+    keys["deeplc"] = _stage_key(keys["ms2pip"], DEEPLC_PARAMS, _package_version("deeplc"),
+                                *([deeplc_calibration.checkpoint_key()] if deeplc_calibration else []))
+    return keys
+
+
+def _mztab_stage_key(result_file, streaming_rank1=False):
+    return _stage_key(None, file_fingerprint(result_file), MZTAB_PSM_COLUMNS,
+                      "best-beam" if streaming_rank1 else "all-beams")
+
+
+def feature_stage_keys(result_file, mgf_dir, pattern, streaming_rank1=False, feature_mode="lean",
+                       deeplc_calibration=None):
+    """
+    sub-stage별 checkpoint key 계산. 각 key는 이전 stage key에 이어서 hash 하므로
+    앞 stage 입력/파라미터가 바뀌면 그 뒤 stage들도 모두 무효가 됨.
+    """
+    keys = {"mztab": _mztab_stage_key(result_file, streaming_rank1)}
+    keys.update(_feature_keys_after_mztab(keys["mztab"], _mgf_fingerprints(mgf_dir), pattern, feature_mode,
+                                          deeplc_calibration))
+    return keys
+
+
+class StageCheckpoint:
+    """
+    sub-stage 결과를 <root>/<stage>.pkl 로 저장하고 입력 hash를 <stage>.key 에 기록.
+    - key 파일이 현재 key와 같을 때만 유효 (pkl 저장이 끝난 뒤에 key를 기록)
+    - 파일은 임시 파일에 쓴 후 os.replace 하므로 중간에 죽어도 깨진 checkpoint가 남지 않음
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _paths(self, stage):
+        return os.path.join(self.root, f"{stage}.pkl"), os.path.join(self.root, f"{stage}.key")
+
+    def is_valid(self, stage, key):
+        data_path, key_path = self._paths(stage)
+        if not (os.path.exists(data_path) and os.path.exists(key_path)):
+            return False
+        with open(key_path) as fh:
+            return fh.read().strip() == key
+
+    def load(self, stage):
+        data_path, _ = self._paths(stage)
+        with open(data_path, 'rb') as fh:
+            return pickle.load(fh)
+
+    def save(self, stage, key, obj):
+        data_path, key_path = self._paths(stage)
+        if os.path.exists(key_path):
+            os.remove(key_path)
+        if obj is not None:
+            with open(data_path + '.tmp', 'wb') as fh:
+                pickle.dump(obj, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(data_path + '.tmp', data_path)
+        else:
+            open(data_path, 'wb').close()
+        with open(key_path + '.tmp', 'w') as fh:
+            fh.write(key)
+        os.replace(key_path + '.tmp', key_path)
+
+
+def add_spectra_ref_columns(psm_df):
+    """spectra_ref (ms_run[N]:index=M) -> ms_run_id, mgf_index 컬럼 (없으면 NaN)"""
+    if 'spectra_ref' in psm_df.columns:
+        ref = psm_df['spectra_ref'].astype(str)
+        psm_df['ms_run_id'] = pd.to_numeric(ref.str.extract(r'ms_run\[(\d+)\]', expand=False))
+        psm_df['mgf_index'] = pd.to_numeric(ref.str.extract(r'index=(\d+)', expand=False))
+    else:
+        psm_df['ms_run_id'] = pd.NA
+        psm_df['mgf_index'] = pd.NA
+    return psm_df
+
+
+def best_beam_per_spectrum(psm_df):
+    """
+    spectrum(ms_run_id, mgf_index)별로 score가 가장 높은 beam 한 행만 남김 (행 순서 유지).
+    - score가 같으면 앞 행 (groupby rank(method='first')와 같은 기준), score가 NaN인 행은 마지막
+    - ms_run_id/mgf_index가 없는 행은 MGF scan을 붙일 수 없어 rank-1이 될 수 없으므로 제외
+    """
+    psm_df = psm_df[psm_df['ms_run_id'].notna() & psm_df['mgf_index'].notna()]
+    rid = psm_df['ms_run_id'].to_numpy(np.float64)
+    idx = psm_df['mgf_index'].to_numpy(np.float64)
+    neg_score = -psm_df['search_engine_score[1]'].to_numpy(np.float64)
+    neg_score[np.isnan(neg_score)] = np.inf
+    order = np.lexsort((np.arange(len(psm_df)), neg_score, idx, rid))
+    rid, idx = rid[order], idx[order]
+    first = np.r_[True, (rid[1:] != rid[:-1]) | (idx[1:] != idx[:-1])] if len(order) else np.empty(0, dtype=bool)
+    return psm_df.iloc[np.sort(order[first])]
+
+
+def read_mztab_rank1_candidates(path, columns=None, chunksize: int = 200_000):
+    """
+    mzTab을 chunk 단위로 읽으면서 spectrum별 최고 score beam만 남김 (streaming rank-1 선택).
+    - Casanovo는 한 spectrum의 beam들을 연속으로 쓰므로 chunk마다 줄이고, chunk 경계에 걸친
+      spectrum은 마지막에 한 번 더 줄임 -> 메모리는 spectrum 수에 비례 (beam 수와 무관)
+    - 반환 DataFrame의 index는 mzTab PSM 행 번호
+    - 최종 rank-1 선택/길이, charge 필터는 그대로 get_casanovo_changed_df에서 하므로 결과는 전체를 읽을 때와 동일
+      ((file, scan) 단위 rank는 spectrum 단위 최고 beam들 중에서 정해짐)
+    """
+    msrun_to_path = {}
+    kept = []
+    n_rows = 0
+    for chunk in iter_mztab_psm(path, columns, chunksize, msrun_to_path):
+        chunk.index = pd.RangeIndex(n_rows, n_rows + len(chunk))
+        n_rows += len(chunk)
+        kept.append(best_beam_per_spectrum(add_spectra_ref_columns(chunk)))
+    psm_df = best_beam_per_spectrum(pd.concat(kept) if len(kept) > 1 else kept[0])
+    print(f"mzTab PSM rows: {n_rows}, best beam per spectrum: {len(psm_df)}")
+    return psm_df, msrun_to_path
+
+
+def load_mztab_stage(result_file, streaming_rank1=False):
+    if streaming_rank1:
+        return read_mztab_rank1_candidates(result_file, columns=MZTAB_PSM_COLUMNS)
+
+    # PSM 컬럼과 ms_run location을 한 번의 pass로 읽음
+    psm_df, msrun_to_path = read_mztab(result_file, columns=MZTAB_PSM_COLUMNS)
+    return add_spectra_ref_columns(psm_df), msrun_to_path
+
+
+def msrun_location_name(loc):
+    """mzTab ms_run[N]-location -> MGF 파일 이름"""
+    return os.path.basename(loc.replace("file://",""))
+
+
+def resolve_msrun_mgf_paths(msrun_to_path, mgf_dir, warn=True):
+    """
+    {ms_run_id: mzTab location} -> {ms_run_id: mgf_dir 안의 MGF 절대 경로 또는 None}.
+    location 파일 이름으로 찾고, mgf_dir에 MGF가 하나뿐이면 그 파일 사용
+    """
+    mgf_files = glob.glob(os.path.join(mgf_dir, "*.mgf")) + glob.glob(os.path.join(mgf_dir, "*.MGF"))
+    base_to_full = {os.path.basename(p): os.path.abspath(p) for p in mgf_files}
+
+    def resolve_mgf_path(rid, loc):
+        base = msrun_location_name(loc)
+        full = base_to_full.get(base)
+        if full:
+            return full
+        if len(mgf_files) == 1:
+            fallback = os.path.abspath(mgf_files[0])
+            if warn:
+                print(f"WARNING: ms_run[{rid}] location '{base}' was not found in {mgf_dir}; using only MGF file '{os.path.basename(fallback)}'")
+            return fallback
+        if warn:
+            print(f"WARNING: ms_run[{rid}] location '{base}' was not found in {mgf_dir}. Available MGF files: {sorted(base_to_full.keys())}")
+        return None
+
+    return {rid: resolve_mgf_path(rid, loc) for rid, loc in msrun_to_path.items()}
+
+
+def attach_mgf_stage(psm_df, msrun_to_path, mgf_dir, spectral_store=None):
+    msrun_to_full = resolve_msrun_mgf_paths(msrun_to_path, mgf_dir)
+    
+    
+    # ms_run별로 필요한 mgf index 집합 (행 단위 루프 없이 groupby로 수집)
+    refs = psm_df[["ms_run_id","mgf_index"]].dropna().astype("int64")
+    need = {}
+    for rid, idxs in refs.groupby("ms_run_id")["mgf_index"].unique().items():
+        full = msrun_to_full.get(int(rid))
+        if full:
+            need.setdefault(full, set()).update(idxs.tolist())
+
+    # 필요한 스펙트럼의 header 메타데이터만 추출 (peak 배열은 읽지 않음)
+    mgf_meta = read_mgf_metadata(need, spectral_store)
+
+
+    psm_df = attach_mgf_metadata(psm_df, mgf_meta, msrun_to_full)
+    
+    psm_df = psm_df.rename(columns={
+        'sequence':'Peptide',
+        'search_engine_score[1]':'Casanovo score',
+        'charge':'z',
+        'exp_mass_to_charge':'m/z',
+        'rt_seconds':'RT',
+        'scan':'Scan',
+        'mgf_file':'run'
+    })
+    psm_df['z'] = pd.to_numeric(psm_df['z'], errors='coerce')
+    psm_df['run'] = psm_df['run'].astype('category')
+    print("PSM rows:", len(psm_df))
+    return psm_df
+
+
+def build_rank1_stage(psm_df):
+    pd_df = get_casanovo_changed_df(psm_df)
+
+    pd_rank1_df = pd_df[pd_df['rank_first']==1.0]
+    print("Rank1 PSM rows:",len(pd_rank1_df))
+    
+    rank1_peptides = composite_id_columns(pd_rank1_df, ["peptide"])['peptide']
+    print("Rank1 peptide rows:",rank1_peptides.nunique())
+
+    pd_psm_list = build_psm_list(pd_rank1_df)
+    return pd_rank1_df, pd_psm_list
+
+
+def run_stage(ckpt, keys, name, func):
+    """ckpt에 name stage 결과가 유효하면 읽어오고, 아니면 func() 실행 후 저장"""
+    with PROFILER.stage(name) as rec:
+        if ckpt is not None and name in keys and ckpt.is_valid(name, keys[name]):
+            print(f"checkpoint: reuse {name} ({ckpt.root})")
+            out = ckpt.load(name)
+            rec["checkpoint"] = "reused"
+        else:
+            out = func()
+            if ckpt is not None and name in keys:
+                ckpt.save(name, keys[name], out)
+        rec["rows"] = _row_count(out)
+    return out
+
+
+def compute_feature_stages(load_mztab, mgf_dir, pattern, keys=None, checkpoint_dir=None,
+                           ms2pip_processes=None, deeplc_processes=None, prediction_cache=None,
+                           feature_mode="lean", deeplc_calibration=None, spectral_store=None):
+    """
+    mzTab parse -> MGF metadata attach -> rank-1 PSMList -> basic -> MS2PIP -> DeepLC 순서로 feature 계산.
+    - load_mztab: (psm_df, msrun_to_path)를 반환하는 함수
+    - feature_mode="lean": PIN에 쓰는 abs_ms1_error_ppm, cos(-> SA), rt_diff만 배열로 계산
+      feature_mode="full": ms2rescore feature generator의 전체 feature
+    - deeplc_calibration(DeepLCCalibrationStore)이 주어지면 LC run별 DeepLC calibration을 저장/재사용
+    - spectral_store(디렉토리)가 주어지면 MGF를 binary spectral store로 한 번 변환해서 metadata attach와
+      MS2PIP 관측 스펙트럼 모두 store에서 읽음 (결과는 같으므로 checkpoint key에는 넣지 않음)
+    - checkpoint_dir가 주어지면 keys에 있는 stage 결과를 저장하고, 재실행 시 입력이 같은 stage는 건너뜀
+      (마지막으로 유효한 stage부터 이어서 계산)
+    - 반환 DataFrame의 index는 mzTab PSM 행 번호 (shard 결과를 원래 순서로 합칠 때 사용)
+    """
+    keys = keys or {}
+    ckpt = StageCheckpoint(checkpoint_dir) if checkpoint_dir else None
+    done = {}
+
+    def stage(name, func):
+        if name not in done:
+            done[name] = run_stage(ckpt, keys, name, func)
+        return done[name]
+
+    def mztab_out():
+        return stage("mztab", load_mztab)
+
+    def mgf_meta_out():
+        return stage("mgf_meta", lambda: attach_mgf_stage(*mztab_out(), mgf_dir, spectral_store))
+
+    def rank1_out():
+        return stage("rank1", lambda: build_rank1_stage(mgf_meta_out()))
+
+    def basic_out():
+        def run():
+            # general feateures
+            pd_psm_list = rank1_out()[1]
+            if feature_mode == "lean":
+                return {"abs_ms1_error_ppm": ms1_error_ppm(pd_psm_list)}
+            if len(pd_psm_list):
+                basic_fgen = feature_generator_class("BasicFeatureGenerator")()
+                basic_fgen.add_features(pd_psm_list)
+            return pd_psm_list
+        return stage("basic", run)
+
+    def ms2pip_out():
+        def run():
+            # cosine similarity
+            ms2pip_fgen = feature_generator_class("MS2PIPFeatureGenerator")(
+                spectrum_path=mgf_dir,
+                spectrum_id_pattern=pattern,
+                processes=ms2pip_processes or get_process_count("NOVOCERT_MS2PIP_PROCESSES"),
+                **MS2PIP_PARAMS,
+            )
+            if feature_mode == "lean":
+                return {"cos": ms2pip_cosine(ms2pip_fgen, rank1_out()[1], cache, spectral_store)}
+            pd_psm_list = basic_out()
+            add_ms2pip_features(ms2pip_fgen, pd_psm_list, cache, spectral_store)
+            return pd_psm_list
+        return stage("ms2pip", run)
+
+    def deeplc_out():
+        def run():
+            if feature_mode == "lean":
+                features = {**basic_out(), **ms2pip_out()}
+                pd_psm_list = rank1_out()[1]
+            else:
+                pd_psm_list = ms2pip_out()
+            if len(pd_psm_list) == 0:
+                return pd.DataFrame()
+            # deepLC
+            deeplc_fgen = feature_generator_class("DeepLCFeatureGenerator")(
+                spectrum_path=None,
+                processes=deeplc_processes or get_process_count("NOVOCERT_DEEPLC_PROCESSES"),
+                **DEEPLC_PARAMS,
+            )
+            if feature_mode == "lean":
+                features["rt_diff"] = deeplc_rt_diff(deeplc_fgen, pd_psm_list, cache, deeplc_calibration, mgf_dir)
+                return psm_list_to_df(pd_psm_list, rank1_out()[0], features)
+            add_deeplc_features(deeplc_fgen, pd_psm_list, cache, deeplc_calibration, mgf_dir)
+            return psm_list_to_df(pd_psm_list, rank1_out()[0])
+        return stage("deeplc", run)
+
+    # MS2PIP/DeepLC 예측값 cache (prediction_cache 경로가 주어진 경우)
+    cache = open_prediction_cache(prediction_cache)
+    try:
+        return deeplc_out()
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+_CHARGE_ONE_HOT_PAT = re.compile(r'charge_\d+$')
+
+
+def merge_shard_features(frames):
+    """
+    shard별 feature DataFrame을 mzTab 행 순서대로 합침.
+    BasicFeatureGenerator의 charge one-hot 컬럼(charge_<min>..charge_<max>)은 shard마다 범위가 다를 수
+    있으므로, 전체 범위로 맞추고 없는 값은 0으로 채움.
+    """
+    frames = [f for f in frames if len(f.columns)]
+    if not frames:
+        return pd.DataFrame()
+    merged = pd.concat(frames).sort_index(kind='stable').reset_index(drop=True)
+
+    columns = list(dict.fromkeys(chain.from_iterable(f.columns for f in frames)))
+    charge_cols = sorted((c for c in columns if _CHARGE_ONE_HOT_PAT.match(c)), key=lambda c: int(c[7:]))
+    if charge_cols:
+        other = [c for c in columns if not _CHARGE_ONE_HOT_PAT.match(c)]
+        at = other.index('charge_n') + 1 if 'charge_n' in other else len(other)
+        columns = other[:at] + charge_cols + other[at:]
+        merged[charge_cols] = merged[charge_cols].fillna(0).astype(np.int8)
+    return merged[columns]
+
+
+INCREMENTAL_SHARD_PREFIX = "msrun_"
+# run 내용 비교에 쓰는 PSM 컬럼 (spectra_ref/ms_run_id는 run이 추가되면 번호가 바뀌므로 제외)
+INCREMENTAL_ROW_COLUMNS = [c for c in MZTAB_PSM_COLUMNS if c != 'spectra_ref'] + ['mgf_index']
+
+
+def incremental_shard_keys(shard_df, location, mgf_path, pattern, streaming_rank1=False, feature_mode="lean",
+                           deeplc_calibration=None):
+    """
+    --incremental에서 ms_run 하나의 sub-stage key.
+    mzTab 전체 fingerprint 대신 ms_run location, 그 run의 PSM 행 내용, 그 run의 MGF fingerprint만 사용하므로
+    다른 run이 추가/변경되거나 ms_run 번호/mzTab 행 번호가 바뀌어도 key가 그대로임
+    """
+    rows = shard_df[[c for c in INCREMENTAL_ROW_COLUMNS if c in shard_df.columns]]
+    rows_hash = hashlib.sha256(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes()).hexdigest()
+    run_key = _stage_key(None, "ms_run", location, rows_hash, MZTAB_PSM_COLUMNS,
+                         "best-beam" if streaming_rank1 else "all-beams")
+    return _feature_keys_after_mztab(run_key, [file_fingerprint(mgf_path)] if mgf_path else [], pattern,
+                                     feature_mode, deeplc_calibration)
+
+
+def _shard_feature_job(shard_df, msrun_to_path, mgf_dir, pattern, keys, checkpoint_dir,
+                       ms2pip_processes, deeplc_processes, prediction_cache, feature_mode, deeplc_calibration,
+                       spectral_store):
+    return compute_feature_stages(lambda: (shard_df, msrun_to_path), mgf_dir, pattern,
+                                  keys=keys, checkpoint_dir=checkpoint_dir,
+                                  ms2pip_processes=ms2pip_processes,
+                                  deeplc_processes=deeplc_processes,
+                                  prediction_cache=prediction_cache,
+                                  feature_mode=feature_mode,
+                                  deeplc_calibration=deeplc_calibration,
+                                  spectral_store=spectral_store)
+
+
+def get_sharded_features_df(result_file, mgf_dir, pattern, shard_processes, ms2pip_processes=None,
+                            deeplc_processes=None, prediction_cache=None, checkpoint_dir=None,
+                            streaming_rank1=False, feature_mode="lean", deeplc_calibration=None,
+                            spectral_store=None, incremental=False):
+    """
+    mzTab은 한 번만 읽고, PSM을 ms_run_id(= MGF 파일) 단위 shard로 나눠 MGF metadata 추출부터
+    DeepLC까지 shard별로 계산한 뒤 합침.
+    - shard_processes개 프로세스에서 shard를 동시에 처리 (MS2PIP/DeepLC 프로세스 예산은 나눠 씀)
+    - 한 프로세스의 peak 메모리는 프로젝트 전체가 아니라 fraction 하나 기준
+    - checkpoint는 <checkpoint_dir>/run<ms_run_id>/ 에 shard별로 저장
+    - incremental이면 shard checkpoint를 <checkpoint_dir>/msrun_<MGF 이름>/ 에 run 단위 key로 저장
+      (incremental_shard_keys 참고). 새로 추가되었거나 바뀐 run만 계산하고 나머지는 저장된 feature 테이블을 읽음.
+      shard는 run 안의 행 번호로 계산하고 합칠 때 현재 mzTab 행 번호로 되돌림
+    """
+    ckpt = StageCheckpoint(checkpoint_dir) if checkpoint_dir else None
+    if incremental and ckpt is None:
+        raise ValueError("incremental feature calculation needs a checkpoint directory")
+    mztab_key = _mztab_stage_key(result_file, streaming_rank1) if ckpt else None
+    mgf_fps = _mgf_fingerprints(mgf_dir) if ckpt and not incremental else None
+
+    psm_df, msrun_to_path = run_stage(ckpt, {"mztab": mztab_key} if ckpt else {}, "mztab",
+                                      lambda: load_mztab_stage(result_file, streaming_rank1))
+    shards = list(psm_df.groupby('ms_run_id', sort=True, dropna=False))
+    del psm_df
+    msrun_to_full = resolve_msrun_mgf_paths(msrun_to_path, mgf_dir, warn=False) if incremental else {}
+
+    jobs = []
+    for rid, shard_df in shards:
+        row_index = None
+        if incremental:
+            loc = msrun_to_path.get(int(rid)) if pd.notna(rid) else None
+            location = msrun_location_name(loc) if loc else None
+            name = INCREMENTAL_SHARD_PREFIX + (location or "unknown")
+            if any(name == n for n, _, _ in jobs):
+                name += f"_{int(rid)}" if pd.notna(rid) else "_unknown"
+            keys = incremental_shard_keys(shard_df, location, msrun_to_full.get(int(rid)) if pd.notna(rid) else None,
+                                          pattern, streaming_rank1, feature_mode, deeplc_calibration)
+            row_index = shard_df.index.to_numpy()
+            shard_df = shard_df.reset_index(drop=True)
+        else:
+            name = f"run{int(rid)}" if pd.notna(rid) else "run_unknown"
+            keys = _feature_keys_after_mztab(_stage_key(mztab_key, "ms_run_id", name), mgf_fps, pattern,
+                                             feature_mode, deeplc_calibration) if ckpt else {}
+        shard_ckpt = os.path.join(checkpoint_dir, name) if ckpt else None
+        jobs.append((name, row_index, [shard_df, msrun_to_path, mgf_dir, pattern, keys, shard_ckpt,
+                                       None, None, prediction_cache, feature_mode, deeplc_calibration,
+                                       spectral_store]))
+
+    # 최종 stage가 유효한 shard는 프로세스를 띄우지 않고 저장된 결과만 읽음
+    stored = {name for name, _, job in jobs
+              if job[5] and StageCheckpoint(job[5]).is_valid("deeplc", job[4].get("deeplc"))}
+    n_compute = len(jobs) - len(stored)
+    n_workers = max(1, min(shard_processes, n_compute))
+    shard_ms2pip = max(1, (ms2pip_processes or get_process_count("NOVOCERT_MS2PIP_PROCESSES")) // n_workers)
+    shard_deeplc = max(1, (deeplc_processes or get_process_count("NOVOCERT_DEEPLC_PROCESSES")) // n_workers)
+    for _, _, job in jobs:
+        job[6], job[7] = shard_ms2pip, shard_deeplc
+    print(f"sharded feature calculation: {len(shards)} ms_run shards, {n_workers} processes "
+          f"(MS2PIP processes={shard_ms2pip}, DeepLC processes={shard_deeplc} per shard)")
+    if incremental:
+        print(f"incremental: {len(stored)} ms_runs reused from {checkpoint_dir}, {n_compute} new or changed ms_runs")
+
+    frames = {}
+    if n_workers == 1:
+        for name, _, job in jobs:
+            with PROFILER.scope(name):
+                frames[name] = _shard_feature_job(*job)
+    else:
+        for name, _, job in jobs:
+            if name in stored:
+                with PROFILER.scope(name):
+                    frames[name] = _shard_feature_job(*job)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+            futures = {name: executor.submit(_profiled_call, PROFILER.current_scope + (name,), _shard_feature_job,
+                                             *job)
+                       for name, _, job in jobs if name not in stored}
+            for name, f in futures.items():
+                frame, records = f.result()
+                frames[name] = frame
+                PROFILER.extend(records)
+    for name, row_index, _ in jobs:
+        if row_index is not None and len(frames[name]):
+            frames[name].index = row_index[frames[name].index.to_numpy()]
+    frames = [frames[name] for name, _, _ in jobs]
+
+    if incremental:
+        # mzTab에서 빠진 run의 저장된 feature는 삭제
+        current = {name for name, _, _ in jobs}
+        for entry in sorted(os.listdir(checkpoint_dir)):
+            path = os.path.join(checkpoint_dir, entry)
+            if entry.startswith(INCREMENTAL_SHARD_PREFIX) and entry not in current and os.path.isdir(path):
+                print(f"incremental: removing stored features of {entry} (no longer in {os.path.basename(result_file)})")
+                shutil.rmtree(path, ignore_errors=True)
+    with PROFILER.stage("merge_shards") as rec:
+        fea_df = merge_shard_features(frames)
+        rec["rows"] = len(fea_df)
+    return fea_df
+
+
+def get_feauters_df(result_file,mgf_dir, pattern, ms2pip_processes=None, deeplc_processes=None,
+                    prediction_cache=None, checkpoint_dir=None, shard_processes=None, streaming_rank1=False,
+                    feature_mode="lean", deeplc_calibration=None, spectral_store=None, incremental=False):
+    """
+    mzTab 하나(target 또는 decoy)의 feature DataFrame 계산 (compute_feature_stages 참고).
+    feature_mode="full"이면 PIN에 쓰지 않는 MS2PIP/DeepLC/basic feature까지 전부 계산.
+    shard_processes가 주어지면 ms_run 단위로 나눠서 계산 (get_sharded_features_df 참고).
+    incremental이면 ms_run 단위로 저장된 feature를 재사용하고 새로 추가되었거나 바뀐 run만 계산.
+    streaming_rank1이면 mzTab을 읽으면서 spectrum별 최고 beam만 남김 (read_mztab_rank1_candidates 참고).
+    """
+    if shard_processes or incremental:
+        fea_df = get_sharded_features_df(result_file, mgf_dir, pattern, shard_processes,
+                                         ms2pip_processes=ms2pip_processes,
+                                         deeplc_processes=deeplc_processes,
+                                         prediction_cache=prediction_cache,
+                                         checkpoint_dir=checkpoint_dir,
+                                         streaming_rank1=streaming_rank1,
+                                         feature_mode=feature_mode,
+                                         deeplc_calibration=deeplc_calibration,
+                                         spectral_store=spectral_store,
+                                         incremental=incremental)
+    else:
+        keys = feature_stage_keys(result_file, mgf_dir, pattern, streaming_rank1,
+                                  feature_mode, deeplc_calibration) if checkpoint_dir else {}
+        fea_df = compute_feature_stages(lambda: load_mztab_stage(result_file, streaming_rank1), mgf_dir, pattern,
+                                        keys=keys, checkpoint_dir=checkpoint_dir,
+                                        ms2pip_processes=ms2pip_processes,
+                                        deeplc_processes=deeplc_processes,
+                                        prediction_cache=prediction_cache,
+                                        feature_mode=feature_mode,
+                                        deeplc_calibration=deeplc_calibration,
+                                        spectral_store=spectral_store)
+        fea_df = fea_df.reset_index(drop=True)
+    print("Finally PSM rows:", len(fea_df))
+
+    return fea_df
+
+
+def get_finally_save_csv(pd_df,flag):
+    pd_tmp = pd_df[pd_df['Casanovo score']>=0]
+    print("Casanovo score >=0 rows: ",len(pd_tmp))
+    pd_tmp['Label'] = flag
+    pd_tmp['Proteins'] = 1
+    
+    pd_tmp = pd_tmp.rename(columns={'rt_diff':'absdRT','abs_ms1_error_ppm':'absdMppm','spectrum_id':'ScanNr'})
+    pd_tmp = pd_tmp[['SS','Label','ScanNr','SA','absdRT','absdMppm','Peptide','Proteins','z']]
+    
+    return pd_tmp
+
+FEATURE_OUTPUT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+
+
+def resolve_feature_formats(formats):
+    """
+    --output_format 값 정리. pyarrow가 없으면 parquet/arrow 대신 CSV로 저장.
+    """
+    formats = list(dict.fromkeys(formats))
+    if any(fmt != "csv" for fmt in formats):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print(f"WARNING: pyarrow is not installed; writing feature tables as CSV instead of {formats}")
+            return ["csv"]
+    return formats
+
+
+def feature_output_path(output_base, fmt):
+    return output_base + FEATURE_OUTPUT_FORMATS[fmt]
+
+
+def _numeric_feature_df(pd_df):
+    # rescoring_features에서 온 object 컬럼(numpy scalar 혼합 등)을 실제 숫자 dtype으로 변환
+    out = pd_df.copy()
+    for col in out.columns[out.dtypes == object]:
+        if pd.api.types.infer_dtype(out[col], skipna=True) in ("floating", "integer", "mixed-integer-float", "decimal"):
+            out[col] = pd.to_numeric(out[col])
+    return out
+
+
+def write_feature_table(pd_df, output_base, formats):
+    """
+    feature 테이블을 formats(parquet/arrow/csv) 별로 <output_base>.<ext> 에 저장.
+    - parquet: zstd 압축, column 단위로 읽기 가능
+    - arrow: Arrow IPC(Feather v2) 파일, lz4 압축
+    - csv: 기존과 동일한 DataFrame.to_csv 출력
+    """
+    paths = []
+    if any(fmt != "csv" for fmt in formats):
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        table = pa.Table.from_pandas(_numeric_feature_df(pd_df), preserve_index=False)
+    for fmt in formats:
+        path = feature_output_path(output_base, fmt)
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            pq.write_table(table, path, compression="zstd")
+        elif fmt == "arrow":
+            feather.write_feather(table, path, compression="lz4")
+        else:
+            pd_df.to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def read_feature_table(path, columns=None):
+    """
+    write_feature_table로 저장한 feature 테이블 읽기 (확장자로 형식 판단, columns만 읽음).
+    """
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    if path.endswith(".arrow"):
+        import pyarrow.feather as feather
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+def run_feature_job(result_path, mgf_dir, pattern, output_base, flag,
+                    ms2pip_processes=None, deeplc_processes=None, prediction_cache=None,
+                    checkpoint_dir=None, output_formats=("parquet",), shard_processes=None,
+                    streaming_rank1=False, feature_mode="lean", deeplc_calibration=None, spectral_store=None,
+                    incremental=False):
+    """
+    한 run(target 또는 decoy)의 feature 계산 후 전체 feature 테이블을 저장하고 PIN 입력용 테이블 반환.
+    --parallel 모드에서는 별도 프로세스에서 실행되므로 반환값(PIN 컬럼만)을 작게 유지.
+    """
+    pd_df = get_feauters_df(result_path, mgf_dir, pattern,
+                            ms2pip_processes=ms2pip_processes,
+                            deeplc_processes=deeplc_processes,
+                            prediction_cache=prediction_cache,
+                            checkpoint_dir=checkpoint_dir,
+                            shard_processes=shard_processes,
+                            streaming_rank1=streaming_rank1,
+                            feature_mode=feature_mode,
+                            deeplc_calibration=deeplc_calibration,
+                            spectral_store=spectral_store,
+                            incremental=incremental)
+    with PROFILER.stage("write_features", rows=len(pd_df)):
+        write_feature_table(pd_df, output_base, output_formats)
+    with PROFILER.stage("pin_input") as rec:
+        pin_df = get_finally_save_csv(pd_df, flag)
+        rec["rows"] = len(pin_df)
+    return pin_df
+
+
+PIN_COLUMNS = ['SpecId','Label','ScanNr','SA','absdRT','absdMppm','Peptide','Proteins']
+
+
+def pin_output_path(output_dir, compress=False):
+    return os.path.join(output_dir, 't_d.pin.gz' if compress else 't_d.pin')
+
+
+def percolator_dm_alc_output(t_df,d_df,output_dir, compress=False, chunksize=500_000):
+    """
+    target/decoy PIN 입력 테이블을 t_d.pin (compress=True이면 t_d.pin.gz)으로 저장.
+    - csv.writer(delimiter='\t')로 한 줄씩 쓰던 출력과 byte 단위로 동일 (CRLF 줄바꿈, NaN -> 'nan')
+    - target, decoy 순서로 chunksize 행씩 DataFrame.to_csv로 기록 (concat 없이 streaming)
+    """
+    pin_path = pin_output_path(output_dir, compress)
+    if compress:
+        f = gzip.open(pin_path, 'wt', newline='', compresslevel=6)
+    else:
+        f = open(pin_path, 'w', newline='')
+    with f:
+        for i, df in enumerate((t_df, d_df)):
+            out = df[PIN_COLUMNS[1:]]
+            out.insert(0, 'SpecId', combine_series(df['SS'], df['z'], '_'))
+            out.to_csv(f, sep='\t', index=False, header=(i == 0), lineterminator='\r\n',
+                       na_rep='nan', chunksize=chunksize)
+    return pin_path
+    
+    
+SPECTRUM_ID_PATTERN = r'(?:NativeID:".*scan=|.*?\.)(\d+)(?:\.\d+\.\d+)?'
+JOB_PATH_ARGS = ("target_mgf_dir", "target_result_path", "decoy_mgf_dir", "decoy_result_path", "output_dir")
+WORKER_ARGS = ("worker_queue", "worker_poll", "worker_idle_exit", "profile_dir")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="parameters")
+    parser.add_argument("--target_mgf_dir", type=str, help="target mgf directory")
+    parser.add_argument("--target_result_path", type=str, help="target casanovo result path")
+    parser.add_argument("--decoy_mgf_dir", type=str, help="decoy mgf directory")
+    parser.add_argument("--decoy_result_path", type=str, help="decoy casanovo result path")
+    parser.add_argument("--output_dir", type=str, help="output directory")
+    parser.add_argument("--parallel", action="store_true",
+                        default=os.getenv("NOVOCERT_PARALLEL_RUNS", "").lower() in ("1", "true", "yes"),
+                        help="run target and decoy feature calculation in parallel processes")
+    parser.add_argument("--prediction_cache", type=str, default=os.getenv("NOVOCERT_PREDICTION_CACHE"),
+                        help="SQLite file for caching MS2PIP/DeepLC predictions across runs")
+    parser.add_argument("--checkpoint_dir", type=str, default=os.getenv("NOVOCERT_CHECKPOINT_DIR"),
+                        help="write resumable sub-stage checkpoints here and reuse them on re-runs "
+                             "(off unless set)")
+    parser.add_argument("--no_checkpoint", action="store_true",
+                        help="ignore --checkpoint_dir / NOVOCERT_CHECKPOINT_DIR (no checkpoints are written or reused)")
+    parser.add_argument("--output_format", type=str, nargs="+", choices=sorted(FEATURE_OUTPUT_FORMATS),
+                        default=os.getenv("NOVOCERT_FEATURE_FORMAT", "parquet").split(","),
+                        help="feature table format(s): parquet, arrow and/or csv (e.g. --output_format parquet csv)")
+    parser.add_argument("--pin_gzip", action="store_true",
+                        default=os.getenv("NOVOCERT_PIN_GZIP", "").lower() in ("1", "true", "yes"),
+                        help="write gzip-compressed t_d.pin.gz instead of t_d.pin")
+    parser.add_argument("--shard_processes", type=int, default=int(os.getenv("NOVOCERT_SHARD_PROCESSES", "0")),
+                        help="process each ms_run (MGF file) as a separate shard using this many processes (0: off)")
+    parser.add_argument("--streaming_rank1", action="store_true",
+                        default=os.getenv("NOVOCERT_STREAMING_RANK1", "").lower() in ("1", "true", "yes"),
+                        help="keep only the best beam per spectrum while reading the mzTab (memory scales with spectra, not beams)")
+    parser.add_argument("--feature_mode", type=str, choices=FEATURE_MODES,
+                        default=os.getenv("NOVOCERT_FEATURE_MODE", "lean"),
+                        help="lean: compute only the PIN features (SA, absdRT, absdMppm); "
+                             "full: also export every basic/MS2PIP/DeepLC feature")
+    parser.add_argument("--deeplc_calibration_dir", type=str, default=os.getenv("NOVOCERT_DEEPLC_CALIBRATION_DIR"),
+                        help="store DeepLC calibrations per LC run (hash of the MGF TITLE/SCANS/RTINSECONDS) here "
+                             "and reuse them for the decoy run and later re-runs on the same LC run")
+    parser.add_argument("--recalibrate", action="store_true",
+                        default=os.getenv("NOVOCERT_DEEPLC_RECALIBRATE", "").lower() in ("1", "true", "yes"),
+                        help="refit DeepLC calibrations even if a stored one exists (overwrites the store)")
+    parser.add_argument("--spectral_store_dir", type=str, default=os.getenv("NOVOCERT_SPECTRAL_STORE_DIR"),
+                        help="convert each MGF once into a binary spectral store (float32 peaks, memory-mapped) "
+                             "here and read metadata and MS2PIP spectra from it instead of the MGF text")
+    parser.add_argument("--incremental", action="store_true",
+                        default=os.getenv("NOVOCERT_INCREMENTAL", "").lower() in ("1", "true", "yes"),
+                        help="store features per ms_run (keyed on MGF location, PSM rows and MGF fingerprint) in "
+                             "--checkpoint_dir, compute only new or changed runs and rebuild the outputs and "
+                             "t_d.pin from the stored runs")
+    parser.add_argument("--profile_dir", type=str, default=os.getenv("NOVOCERT_PROFILE_DIR"),
+                        help="dump a cProfile file per sub-stage into this directory (view with snakeviz/pstats)")
+    parser.add_argument("--worker_queue", type=str, default=os.getenv("NOVOCERT_WORKER_QUEUE"),
+                        help="run as a long-lived worker that keeps models loaded and processes job files "
+                             "(<name>.json) from this directory (see run_worker)")
+    parser.add_argument("--worker_poll", type=float, default=float(os.getenv("NOVOCERT_WORKER_POLL", "2")),
+                        help="seconds between queue scans while the worker is idle")
+    parser.add_argument("--worker_idle_exit", type=float, default=float(os.getenv("NOVOCERT_WORKER_IDLE_EXIT", "0")),
+                        help="stop the worker after this many idle seconds (0: run until SIGTERM/SIGINT)")
+    return parser
+
+
+def run_feature_calculation(args, command=None):
+    """
+    한 sample(target/decoy mzTab + MGF)의 feature 계산 -> feature 테이블과 t_d.pin 저장.
+    반환: PIN 경로 (checkpoint로 출력이 최신이면 계산 없이 바로 반환)
+    """
+    start_time, cpu_start = time.perf_counter(), _cpu_seconds()
+    PROFILER.drain()
+    checkpoint_root = None if args.no_checkpoint else args.checkpoint_dir
+    if args.incremental and not checkpoint_root:
+        raise ValueError("--incremental keeps the per-run features in the checkpoint directory; "
+                         "set --checkpoint_dir and do not combine it with --no_checkpoint")
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    spectrum_id_pattern = SPECTRUM_ID_PATTERN
+
+    jobs = [
+        ("target", args.target_result_path, args.target_mgf_dir, 'all_target_features_df', 1),
+        ("decoy", args.decoy_result_path, args.decoy_mgf_dir, 'all_decoy_features_df', -1),
+    ]
+    output_formats = resolve_feature_formats(args.output_format)
+    pin_path = pin_output_path(args.output_dir, args.pin_gzip)
+
+    if checkpoint_root:
+        os.makedirs(checkpoint_root, exist_ok=True)
+
+    def job_checkpoint_dir(name):
+        return os.path.join(checkpoint_root, name) if checkpoint_root else None
+
+    # --incremental은 ms_run 단위 shard로 계산 (--shard_processes가 없으면 한 프로세스에서 차례로)
+    shard_processes = args.shard_processes or (1 if args.incremental else 0)
+
+    # --recalibrate는 이번 실행 전에 저장된 calibration만 무시하므로 target/decoy store를 실행 시작 시점에 만듦
+    deeplc_calibrations = {
+        name: DeepLCCalibrationStore(args.deeplc_calibration_dir, label=name, force=args.recalibrate)
+        if args.deeplc_calibration_dir else None
+        for name, _, _, _, _ in jobs
+    }
+
+    def finish():
+        # checkpoint로 skip한 실행도 metrics.json을 이번 실행 기록으로 덮어씀 (이전 실행 수치가 남지 않도록)
+        metrics_path = PROFILER.write_metrics(os.path.join(args.output_dir, METRICS_FILE_NAME),
+                                              time.perf_counter() - start_time, command=command,
+                                              cpu_start=cpu_start)
+        print(f"stage metrics saved: {metrics_path}")
+        print("all done.")
+        return pin_path
+
+    # PIN write stage: target/decoy 최종 stage key가 그대로이고 출력 파일이 모두 있으면 전체 skip
+    # (key에 PIN 경로를 넣어서 --pin_gzip/output_dir가 다른 실행이 남긴 key로 예전 PIN을 반환하지 않음)
+    pin_ckpt, pin_key = None, None
+    output_files = [feature_output_path(os.path.join(args.output_dir, output_name), fmt)
+                    for _, _, _, output_name, _ in jobs for fmt in output_formats]
+    output_files.append(pin_path)
+    if checkpoint_root:
+        pin_ckpt = StageCheckpoint(checkpoint_root)
+        pin_key = _stage_key(None, [feature_stage_keys(result_path, mgf_dir, spectrum_id_pattern,
+                                                       args.streaming_rank1, args.feature_mode,
+                                                       deeplc_calibrations[name])["deeplc"]
+                                    for name, result_path, mgf_dir, _, _ in jobs], output_formats,
+                             bool(shard_processes), *(["incremental"] if args.incremental else []),
+                             os.path.abspath(pin_path))
+        if pin_ckpt.is_valid("pin", pin_key) and all(os.path.exists(p) for p in output_files):
+            with PROFILER.stage("pin") as rec:
+                rec["checkpoint"] = "reused"
+            print(f"checkpoint: reuse pin ({checkpoint_root}), outputs are up to date")
+            return finish()
+
+    if args.parallel:
+        # target/decoy를 별도 프로세스에서 동시에 실행, MS2PIP/DeepLC 프로세스 예산은 반씩 나눔
+        ms2pip_processes = split_process_count("NOVOCERT_MS2PIP_PROCESSES", len(jobs))
+        deeplc_processes = split_process_count("NOVOCERT_DEEPLC_PROCESSES", len(jobs))
+        print(f"start target/decoy in parallel (MS2PIP processes={ms2pip_processes}, DeepLC processes={deeplc_processes} per run)...")
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(jobs), mp_context=ctx) as executor:
+            futures = [
+                executor.submit(_profiled_call, (name,), run_feature_job, result_path, mgf_dir, spectrum_id_pattern,
+                                os.path.join(args.output_dir, output_name), flag,
+                                ms2pip_processes, deeplc_processes, args.prediction_cache,
+                                job_checkpoint_dir(name), output_formats, shard_processes,
+                                args.streaming_rank1, args.feature_mode, deeplc_calibrations[name],
+                                args.spectral_store_dir, args.incremental)
+                for name, result_path, mgf_dir, output_name, flag in jobs
+            ]
+            pin_inputs = []
+            for f in futures:
+                pin_df, records = f.result()
+                pin_inputs.append(pin_df)
+                PROFILER.extend(records)
+            t_pd_tmp, d_pd_tmp = pin_inputs
+    else:
+        pin_inputs = []
+        for name, result_path, mgf_dir, output_name, flag in jobs:
+            print(f"start {name}...")
+            with PROFILER.scope(name):
+                pin_inputs.append(run_feature_job(result_path, mgf_dir, spectrum_id_pattern,
+                                                  os.path.join(args.output_dir, output_name), flag,
+                                                  prediction_cache=args.prediction_cache,
+                                                  checkpoint_dir=job_checkpoint_dir(name),
+                                                  output_formats=output_formats,
+                                                  shard_processes=shard_processes,
+                                                  streaming_rank1=args.streaming_rank1,
+                                                  feature_mode=args.feature_mode,
+                                                  deeplc_calibration=deeplc_calibrations[name],
+                                                  spectral_store=args.spectral_store_dir,
+                                                  incremental=args.incremental))
+        t_pd_tmp, d_pd_tmp = pin_inputs
+
+    print("start percolator input generation")
+    
+    with PROFILER.stage("pin", rows=len(t_pd_tmp) + len(d_pd_tmp)):
+        percolator_dm_alc_output(t_pd_tmp,d_pd_tmp,args.output_dir, compress=args.pin_gzip)
+    if pin_ckpt is not None:
+        pin_ckpt.save("pin", pin_key, None)
+    return finish()
+
+
+def job_args(defaults, job):
+    """
+    worker job(JSON object) -> run_feature_calculation 인자.
+    key는 CLI 옵션 이름(--없이), job에 없는 옵션은 worker 실행 인자 값을 사용.
+    """
+    if not isinstance(job, dict):
+        raise ValueError("job file must contain a JSON object")
+    unknown = sorted(k for k in job if k not in vars(defaults) or k in WORKER_ARGS)
+    if unknown:
+        raise ValueError(f"unknown job options: {', '.join(unknown)}")
+    missing = [k for k in JOB_PATH_ARGS if not job.get(k)]
+    if missing:
+        raise ValueError(f"job is missing: {', '.join(missing)}")
+    if isinstance(job.get("output_format"), str):
+        job = {**job, "output_format": job["output_format"].split(",")}
+    return argparse.Namespace(**{**vars(defaults), **job})
+
+
+def _claim_job(queue_dir):
+    """
+    가장 먼저 들어온 <name>.json을 <name>.running으로 rename해서 가져옴.
+    rename은 atomic이므로 여러 worker가 같은 queue를 써도 job은 한 번만 실행됨.
+    """
+    pending = []
+    for entry in os.scandir(queue_dir):
+        if entry.name.endswith(".json") and entry.is_file():
+            try:
+                pending.append((entry.stat().st_mtime, entry.name))
+            except FileNotFoundError:
+                continue
+    for _, name in sorted(pending):
+        running = os.path.join(queue_dir, name[:-len(".json")] + ".running")
+        try:
+            os.rename(os.path.join(queue_dir, name), running)
+        except FileNotFoundError:
+            continue
+        return running
+    return None
+
+
+def _finish_job(running, status):
+    out = running[:-len(".running")] + (".done" if status["status"] == "ok" else ".failed")
+    with open(out + ".tmp", "w") as fh:
+        json.dump(status, fh, indent=2)
+    os.replace(out + ".tmp", out)
+    os.remove(running)
+
+
+def run_worker(defaults):
+    """
+    queue 디렉토리의 job을 차례로 처리하는 상주 worker.
+    import(ms2rescore/TensorFlow 등)와 MS2PIP/DeepLC 모델(keep_models_loaded)을 job 사이에 재사용하므로
+    작은 sample을 많이 처리할 때 sample마다 드는 시작 비용이 한 번으로 줄어듦.
+    - job: <queue>/<name>.json (job_args 참고). 다른 이름으로 쓴 뒤 .json으로 rename 해서 넣을 것
+      예: {"target_mgf_dir": "s1/target/mgf", "target_result_path": "s1/target/result.mztab",
+           "decoy_mgf_dir": "s1/decoy/mgf", "decoy_result_path": "s1/decoy/result.mztab",
+           "output_dir": "s1/output", "feature_mode": "full"}
+    - 처리 중에는 <name>.running, 끝나면 <name>.done, 실패하면 <name>.failed (상태 JSON)
+    - SIGTERM/SIGINT를 받으면 진행 중인 job을 끝낸 뒤 종료
+    - --parallel / --shard_processes job은 spawn된 프로세스에서 계산하므로 모델 재사용 효과는 없음
+    """
+    queue_dir = defaults.worker_queue
+    os.makedirs(queue_dir, exist_ok=True)
+    keep_models_loaded()
+
+    stop = []
+
+    def request_stop(signum, frame):
+        print(f"worker: received signal {signum}, exit after the current job")
+        stop.append(signum)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, request_stop)
+
+    print(f"worker: waiting for jobs in {queue_dir}")
+    idle_since = time.monotonic()
+    while not stop:
+        running = _claim_job(queue_dir)
+        if running is None:
+            if defaults.worker_idle_exit and time.monotonic() - idle_since >= defaults.worker_idle_exit:
+                print(f"worker: idle for {defaults.worker_idle_exit:g} s, exit")
+                break
+            time.sleep(defaults.worker_poll)
+            continue
+
+        name = os.path.basename(running)[:-len(".running")]
+        print(f"worker: start job {name}")
+        start = time.perf_counter()
+        status = {"job": name, "started": datetime.now().isoformat(timespec="seconds")}
+        try:
+            with open(running) as fh:
+                job = json.load(fh)
+            pin_path = run_feature_calculation(job_args(defaults, job), command=job)
+            status.update(status="ok", pin=pin_path)
+        except Exception as e:
+            traceback.print_exc()
+            status.update(status="error", error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+        status["wall_s"] = round(time.perf_counter() - start, 3)
+        _finish_job(running, status)
+        print(f"worker: job {name} {status['status']} ({status['wall_s']:.1f} s)")
+        idle_since = time.monotonic()
+    print("worker: stopped")
+
+
+if __name__ == "__main__":
+    
+    parser = build_arg_parser()
+    args = parser.parse_args()
+    print(args)
+    if args.profile_dir:
+        os.environ["NOVOCERT_PROFILE_DIR"] = args.profile_dir
+        PROFILER.profile_dir = args.profile_dir
+
+    if args.worker_queue:
+        run_worker(args)
+    else:
+        missing = [k for k in JOB_PATH_ARGS if not getattr(args, k)]
+        if missing:
+            parser.error("the following arguments are required: " + ", ".join(f"--{k}" for k in missing))
+        if args.incremental and (args.no_checkpoint or not args.checkpoint_dir):
+            parser.error("--incremental needs --checkpoint_dir (and cannot be combined with --no_checkpoint)")
+        run_feature_calculation(args)
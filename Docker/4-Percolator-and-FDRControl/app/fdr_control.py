@@ -0,0 +1,653 @@
+import numpy as np
+import pandas as pd
+import re
+import argparse
+import os
+
+def combine_columns(col_list,separate):
+    result = col_list[0]
+    for col in col_list[1:]:
+        if not pd.isna(col):
+            result += separate + str(col)
+    return result
+
+
+def change_percolator_peptide(pep):
+    result = pep
+    result = result.replace('I','L')
+    result = re.sub('[^a-zA-Z]', '', result)
+    return result
+    
+
+def combine_series(left,right,separate):
+    """combine_columns([left, right], separate)의 Series 버전 (right가 NaN인 행은 left 그대로)"""
+    return left.where(right.isna(), left + separate + right.astype(str))
+
+
+def change_percolator_series(peptide):
+    """change_percolator_peptide의 Series 버전 (I -> L, 알파벳 이외 문자 제거)"""
+    return peptide.str.replace('I','L',regex=False).str.replace('[^a-zA-Z]','',regex=True)
+
+
+def map_categories(values, func):
+    """
+    values를 categorical로 바꾼 뒤 func(문자열 Series -> 문자열 Series)를 category에만 적용.
+    행 수가 아니라 고유값 수만큼만 계산하고, 결과도 categorical로 반환 (서로 다른 값이 같은 값으로 바뀌어도 됨).
+    """
+    values = values.astype('category')
+    mapped = pd.Index(func(pd.Series(values.cat.categories.astype(object))))
+    categories = mapped.unique()
+    codes = categories.get_indexer(mapped)
+    old_codes = values.cat.codes.to_numpy()
+    new_codes = np.where(old_codes >= 0, codes[old_codes] if len(codes) else -1, -1)
+    return pd.Series(pd.Categorical.from_codes(new_codes, categories), index=values.index)
+
+
+def strip_psmid_suffix(psmid):
+    """x[0:x.rfind('_')] 의 Series 버전 (PIN SpecId의 마지막 '_charge' 제거)"""
+    has_sep = psmid.str.contains('_',regex=False)
+    return psmid.str.replace(r'_[^_]*$','',regex=True).where(has_sep, psmid.str[:-1])
+
+
+def change_percolator_df(tmp_df,col_1,col_2):
+    """
+    col_2(Percolator peptide)에서 pep 컬럼(categorical) 생성.
+    ID(<col_1>_<pep>)는 출력할 행에 대해서만 add_output_ids에서 만듦.
+    """
+    tmp_df['pep'] = map_categories(tmp_df[col_2], change_percolator_series)
+    return tmp_df
+
+
+def add_output_ids(fdr_t_df):
+    """출력할 FDR 결과 행에만 ID(<PSMId>_<pep>, pep 뒤)와 IDD(<PSMId>_<peptide>, 마지막) 컬럼 추가"""
+    fdr_t_df.insert(fdr_t_df.columns.get_loc('pep') + 1, 'ID',
+                    combine_series(fdr_t_df['PSMId'],fdr_t_df['pep'].astype(object),'_'))
+    fdr_t_df['IDD'] = combine_series(fdr_t_df['PSMId'],fdr_t_df['peptide'].astype(object),'_')
+    return fdr_t_df
+
+
+def target_decoy_fdr(score, is_target):
+    """score 내림차순(동점이면 target 먼저)으로 정렬된 배열의 (fdr, qvalue) 배열 (compute_fdr 참고)"""
+    n = len(score)
+    T = np.cumsum(is_target)
+    D = np.arange(1, n + 1) - T
+
+    group_end = np.flatnonzero(np.r_[score[1:] != score[:-1], True]) if n else np.empty(0, dtype=np.int64)
+    row_group_end = group_end[np.searchsorted(group_end, np.arange(n))]
+    T, D = T[row_group_end], D[row_group_end]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fdr = np.where(T > 0, D / np.maximum(T, 1), np.inf)
+    qvalue = np.minimum.accumulate(fdr[::-1])[::-1]
+    return fdr, qvalue
+
+
+def compute_fdr(peaks_tmp):
+    """
+    정렬된 target+decoy dataframe에 fdr/qvalue 컬럼 추가 (make_fdr 참고).
+    - 각 행의 FDR = (그 행까지의 decoy 수) / (target 수), cumsum으로 한 번에 계산
+    - score가 같은 행들은 동점 그룹의 마지막 행 기준 FDR을 공유 (cutoff가 동점 그룹 중간에서 잘리지 않음)
+    - target이 아직 없는 행(맨 앞이 decoy인 경우)은 FDR = inf
+    - qvalue = 해당 행 이후 FDR의 최솟값 (monotone)
+    """
+    fdr, qvalue = target_decoy_fdr(peaks_tmp['score'].to_numpy(), peaks_tmp['label'].to_numpy() == 1)
+    return peaks_tmp.assign(fdr=fdr, qvalue=qvalue)
+
+
+def make_fdr(peaks_tmp,fdr_val):
+    """FDR 하기
+    Args:
+        peaks_tmp (_type_): score 내림차순(동점이면 target 먼저)으로 정렬 후 index reset 된 target+decoy dataframe
+                            (compute_fdr 결과를 넘기면 fdr/qvalue를 다시 계산하지 않음)
+        fdr_val (_type_): fdr 값
+        
+    Returns:
+        _type_: fdr 결과 반환 (fdr/qvalue 컬럼 추가), last_index
+    
+    - qvalue <= fdr_val 인 행까지 반환 (last_index = 반환 행 수)
+    - qvalue는 위에서부터 단조 증가하고 동점 그룹 안에서 같으므로, cutoff는 통과하는 마지막 동점 그룹의 끝
+      (기존 row loop는 head(마지막 통과 행 위치 - 1)로 잘라서 통과한 마지막 두 행이 빠졌으므로 이 cutoff로 바꿈)
+    """
+    if 'fdr' not in peaks_tmp.columns:
+        peaks_tmp = compute_fdr(peaks_tmp)
+
+    passing = np.flatnonzero(peaks_tmp['qvalue'].to_numpy() <= fdr_val)
+    if len(passing) == 0:
+        print(f'WARNING: no rows pass FDR <= {fdr_val}')
+        last_index = 0
+    else:
+        last_index = int(passing[-1]) + 1
+    print('last_index = '+str(last_index))
+    result_file = peaks_tmp.head(last_index)
+    
+    return result_file,last_index
+
+
+PERCOLATOR_DTYPES = {
+    'PSMId': str,
+    'score': np.float64,
+    'q-value': np.float64,
+    'posterior_error_prob': np.float64,
+    'peptide': str,
+    'proteinIds': str,
+}
+PERCOLATOR_CACHE_NAME = 'percolator_normalized.pkl'
+PERCOLATOR_CACHE_VERSION = 2
+_LOADED = {}
+
+
+def read_percolator_result(path):
+    """
+    Percolator out.target/out.decoy 읽기 (필요한 컬럼만, dtype 지정) 후 PSMId 정리.
+    """
+    tmp_df = pd.read_csv(path,sep='\t',usecols=lambda c: c in PERCOLATOR_DTYPES,dtype=PERCOLATOR_DTYPES)
+    tmp_df['PSMId'] = strip_psmid_suffix(tmp_df['PSMId'])
+    return tmp_df
+
+
+def _percolator_cache_key(*paths,params=None):
+    key = [PERCOLATOR_CACHE_VERSION]
+    for path in paths:
+        st = os.stat(path)
+        key.append((os.path.abspath(path),st.st_size,st.st_mtime_ns))
+    if params is not None:
+        key.append(tuple(sorted(params.items())))
+    return tuple(key)
+
+
+def normalize_percolator_frames(t_df,d_df):
+    """
+    read_percolator_result 형태의 target/decoy 결과 -> 정규화한 dataframe (pep, label, rank_scan 포함)
+    """
+    # target/decoy를 합친 뒤 반복되는 문자열 컬럼을 categorical로 (category가 target/decoy 공통이 되도록)
+    ori_df = pd.concat([t_df,d_df])
+    for col in ('peptide','proteinIds'):
+        if col in ori_df.columns:
+            ori_df[col] = ori_df[col].astype('category')
+    ori_df = change_percolator_df(ori_df,'PSMId','peptide')
+    ori_df['label'] = np.repeat(np.array([1,-1],dtype=np.int64),[len(t_df),len(d_df)])
+    ori_df['rank_scan'] = ori_df.groupby(['PSMId'])['score'].rank(method='first', ascending=False)
+    return ori_df
+
+
+def _load_cached(key,cache_dir,build):
+    """
+    build()로 만든 정규화 dataframe을 key 기준으로 재사용.
+    - 같은 프로세스에서 같은 key면 메모리에 있는 결과 재사용
+    - cache_dir가 주어지면 <cache_dir>/percolator_normalized.pkl 에 저장하고 다음 실행에서 재사용
+      (opt-in: --cache_dir / NOVOCERT_FDR_CACHE_DIR. key가 입력 경로/크기/mtime이라 Percolator를 매번 다시 돌려
+       out.target/out.decoy가 새로 생기는 pipeline에서는 맞지 않으므로, 같은 결과로 여러 번 FDR을 돌릴 때만 사용)
+    """
+    if key in _LOADED:
+        return _LOADED[key]
+
+    cache_path = os.path.join(cache_dir, PERCOLATOR_CACHE_NAME) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            cached = pd.read_pickle(cache_path)
+            if cached.get('key') == key:
+                print(f"reuse normalized Percolator results: {cache_path}")
+                _LOADED[key] = cached['df']
+                return cached['df']
+        except Exception as e:
+            print(f"WARNING: ignoring unreadable cache '{cache_path}': {e}")
+
+    ori_df = build()
+    if cache_path:
+        try:
+            pd.to_pickle({'key': key, 'df': ori_df}, cache_path)
+        except OSError as e:
+            print(f"WARNING: could not write cache '{cache_path}': {e}")
+    _LOADED[key] = ori_df
+    return ori_df
+
+
+def load_percolator_df(target_path,decoy_path,cache_dir=None):
+    """
+    target/decoy Percolator 결과를 읽어 정규화한 dataframe (label, rank_scan 포함) 반환.
+    - 같은 입력(경로/크기/mtime)이면 메모리 또는 <cache_dir>/percolator_normalized.pkl 의 결과 재사용
+    반환된 dataframe은 공유되므로 호출하는 쪽에서 직접 수정하지 않음.
+    """
+    return _load_cached(_percolator_cache_key(target_path,decoy_path),cache_dir,
+                        lambda: normalize_percolator_frames(read_percolator_result(target_path),
+                                                            read_percolator_result(decoy_path)))
+
+
+# 내장 rescoring: Percolator 바이너리 대신 PIN feature로 같은 방식(semi-supervised, cross-validated
+# linear SVM)의 score를 numpy로 계산해 out.target/out.decoy 텍스트 없이 FDR 단계로 넘김
+PIN_COLUMNS = ['SpecId','Label','ScanNr','SA','absdRT','absdMppm','Peptide','Proteins']
+PIN_NON_FEATURES = {'SpecId','Label','ScanNr','ExpMass','Peptide','Proteins'}
+RESCORE_PARAMS = {'folds': 3, 'iterations': 10, 'train_fdr': 0.01, 'test_fdr': 0.01, 'seed': 1}
+SVM_CPOS = (10.0, 1.0, 0.1)
+SVM_CNEG_RATIOS = (1.0, 3.0, 10.0)
+PEP_BINS = 1000
+
+
+def read_pin(path):
+    """
+    t_d.pin(.gz) 읽기 (stage 3 출력처럼 Proteins가 컬럼 하나인 PIN)
+    - stage 3(ms2rescore image)과 stage 4(percolator image)는 별도 container이고 t_d.pin 파일로만 이어지므로
+      내장 rescoring도 Percolator 바이너리와 같은 입력인 t_d.pin을 읽음 (stage 3 결과를 in-process로 넘기지 않음)
+    """
+    return pd.read_csv(path,sep='\t',dtype={'SpecId': str,'Peptide': str,'Proteins': str})
+
+
+def pin_frame(t_df,d_df):
+    """
+    stage 3 get_finally_save_csv 형태(SS, Label, ScanNr, feature..., Peptide, Proteins, z)의 target/decoy
+    테이블 -> t_d.pin과 같은 컬럼의 dataframe (SpecId = <SS>_<z>)
+    - pipeline은 read_pin을 쓰고, 이 함수는 t_d.pin 쓰기/읽기 없이 rescore_pin_df 입력을 만드는 벤치마크용
+    """
+    pin_df = pd.concat([t_df,d_df],ignore_index=True)
+    pin_df.insert(0,'SpecId',combine_series(pin_df['SS'].astype(str),pin_df['z'],'_'))
+    pin_df['Proteins'] = pin_df['Proteins'].astype(str)
+    return pin_df[PIN_COLUMNS]
+
+
+def pin_feature_columns(pin_df):
+    return [c for c in pin_df.columns if c not in PIN_NON_FEATURES]
+
+
+def _qvalues(scores,is_target):
+    """정렬되지 않은 score의 target-decoy q-value (compute_fdr과 같은 정의)"""
+    # 동점 그룹은 FDR을 공유하므로 동점 안의 순서는 결과에 영향 없음
+    order = np.argsort(-scores)
+    _,qvalue = target_decoy_fdr(scores[order],is_target[order])
+    out = np.empty(len(scores))
+    out[order] = qvalue
+    return out
+
+
+def _count_passing(scores,is_target,fdr):
+    """q-value <= fdr 인 target 수 (= FDR <= fdr 인 마지막 동점 그룹 끝까지의 target 수)"""
+    order = np.argsort(-scores)
+    sorted_scores = scores[order]
+    T = np.cumsum(is_target[order])
+    D = np.arange(1,len(T) + 1) - T
+    group_end = np.r_[sorted_scores[1:] != sorted_scores[:-1],True] if len(T) else np.empty(0,dtype=bool)
+    passing = np.flatnonzero(group_end & (T > 0) & (D / np.maximum(T,1) <= fdr))
+    return int(T[passing[-1]]) if len(passing) else 0
+
+
+def _svm_line_search(w,step,out,delta,y,cost,reg):
+    # f(t) = 1/2 sum reg*(w+t*step)^2 + 1/2 sum cost*max(0, 1-y*(out+t*delta))^2 의 최솟점 (1차원 Newton)
+    a = float(reg @ (step * step))
+    b = float(reg @ (w * step))
+    r = 1 - y * out
+    sy = y * delta
+    cs = cost * sy
+    css = cs * sy
+    t = 1.0  # active set이 바뀌지 않으면 Newton step(t=1)이 최솟점
+    for _ in range(50):
+        margin = np.maximum(r - t * sy,0.0)
+        grad = b + t * a - cs @ margin
+        hess = a + css @ (margin > 0)
+        if hess <= 0:
+            break
+        t_new = t - grad / hess
+        if abs(t_new - t) < 1e-12:
+            return t_new
+        t = t_new
+    return t
+
+
+def svm_fit(X,y,cost,w0=None,max_iter=50,tol=1e-9):
+    """
+    L2-loss linear SVM (Percolator의 L2-SVM-MFN과 같은 목적함수)을 primal Newton으로 학습.
+    min_w 1/2 |w[:-1]|^2 + 1/2 sum_i cost_i * max(0, 1 - y_i * w.x_i)^2   (X 마지막 열은 bias=1, 정규화 안 함)
+    """
+    d = X.shape[1]
+    reg = np.ones(d)
+    reg[-1] = 0.0
+    w = np.zeros(d) if w0 is None else np.asarray(w0,dtype=np.float64).copy()
+    out = X @ w
+    for _ in range(max_iter):
+        active = y * out < 1
+        Xa = X[active]
+        ca = cost[active]
+        hess = Xa.T @ (Xa * ca[:,None]) + np.diag(reg + 1e-10)
+        step = np.linalg.solve(hess,Xa.T @ (ca * y[active])) - w
+        delta = X @ step
+        t = _svm_line_search(w,step,out,delta,y,cost,reg)
+        w = w + t * step
+        out = out + t * delta
+        # active set이 그대로면 현재 w가 최적 (L2-SVM-MFN 종료 조건)
+        if np.array_equal(active,y * out < 1) or np.abs(t * step).max() < tol:
+            break
+    return w
+
+
+def _initial_direction(X,is_target,fdr):
+    # Percolator처럼 단일 feature(부호 포함) 중 fdr에서 target을 가장 많이 통과시키는 방향으로 시작
+    best_n,best_w = -1,None
+    for j in range(X.shape[1] - 1):
+        for sign in (1.0,-1.0):
+            n = _count_passing(sign * X[:,j],is_target,fdr)
+            if n > best_n:
+                best_n,best_w = n,np.zeros(X.shape[1])
+                best_w[j] = sign
+    return best_w
+
+
+def _train_iteration(X,is_target,w,train_fdr,test_fdr):
+    """
+    현재 score에서 q <= train_fdr인 target(positive)과 모든 decoy(negative)로 SVM 학습.
+    (Cpos, Cneg) grid 중 학습 fold에서 q <= test_fdr target이 가장 많은 w 반환
+    """
+    q = _qvalues(X @ w,is_target)
+    positive = is_target & (q <= train_fdr)
+    train = positive | ~is_target
+    n_pos,n_neg = int(positive.sum()),int((~is_target).sum())
+    if n_pos == 0 or n_neg == 0:
+        return None
+    Xt = X[train]
+    yt = np.where(is_target[train],1.0,-1.0)
+    best_n,best_w = -1,None
+    for cpos in SVM_CPOS:
+        for ratio in SVM_CNEG_RATIOS:
+            cost = np.where(yt > 0,cpos,cpos * ratio * n_pos / n_neg)
+            w_new = svm_fit(Xt,yt,cost,w0=w)
+            n = _count_passing(X @ w_new,is_target,test_fdr)
+            if n > best_n:
+                best_n,best_w = n,w_new
+    return best_w
+
+
+def _normalize_fold_scores(scores,is_target,fdr):
+    # Percolator처럼 fold마다 q = fdr 경계 score를 0, decoy median을 -1로 맞춰서 fold 간 score를 합침
+    q = _qvalues(scores,is_target)
+    passing = scores[is_target & (q <= fdr)]
+    decoys = scores[~is_target]
+    if len(passing) == 0 or len(decoys) == 0:
+        return scores
+    cut,median = passing.min(),np.median(decoys)
+    if cut <= median:
+        return scores - cut
+    return (scores - cut) / (cut - median)
+
+
+def _isotonic_increasing(values,weights):
+    # pool adjacent violators (bin 수 만큼만 loop)
+    means,counts,sizes = [],[],[]
+    for v,w in zip(values,weights):
+        means.append(v)
+        counts.append(w)
+        sizes.append(1)
+        while len(means) > 1 and means[-2] > means[-1]:
+            mean,count,size = means.pop(),counts.pop(),sizes.pop()
+            means[-1] = (means[-1] * counts[-1] + mean * count) / (counts[-1] + count)
+            counts[-1] += count
+            sizes[-1] += size
+    return np.repeat(means,sizes)
+
+
+def posterior_error_probs(scores,is_target,n_bins=PEP_BINS):
+    """
+    score 내림차순 decoy 비율의 isotonic 회귀(같은 PSM 수 bin 단위)로 PEP 추정.
+    target-decoy 경쟁에서 decoy 하나는 false target 하나에 해당하므로 PEP = p_decoy / (1 - p_decoy)
+    """
+    n = len(scores)
+    if n == 0:
+        return np.empty(0)
+    order = np.lexsort((~is_target,-scores))
+    bins = np.minimum(np.arange(n) * n_bins // n,n_bins - 1)
+    counts = np.bincount(bins)
+    decoy_rate = np.bincount(bins,weights=~is_target[order]) / np.maximum(counts,1)
+    keep = counts > 0
+    p = _isotonic_increasing(decoy_rate[keep],counts[keep])
+    with np.errstate(divide='ignore'):
+        pep_bins = np.clip(np.where(p < 1,p / (1 - p),1.0),0.0,1.0)
+    out = np.empty(n)
+    out[order] = np.repeat(pep_bins,counts[keep])
+    return out
+
+
+def percolator_rescore(features,is_target,groups,folds=3,iterations=10,train_fdr=0.01,test_fdr=0.01,seed=1):
+    """
+    Percolator 방식의 semi-supervised linear SVM rescoring.
+    - feature는 전체 PSM 기준 표준화 (결측값은 0 = 평균)
+    - groups(spectrum) 단위로 folds개 fold에 무작위 배정, fold마다 나머지 fold로 학습:
+      단일 feature 방향에서 시작해 iterations번 (q <= train_fdr target vs decoy) SVM 재학습
+    - 각 fold의 test score를 fold별로 정규화 후 합침
+    반환: (score, q-value, PEP) 배열
+    """
+    X = np.asarray(features,dtype=np.float64)
+    mean = np.nanmean(X,axis=0)
+    std = np.nanstd(X,axis=0)
+    std[~(std > 0)] = 1.0
+    X = np.nan_to_num((X - mean) / std,nan=0.0,posinf=0.0,neginf=0.0)
+    X = np.hstack([X,np.ones((len(X),1))])
+
+    codes,uniques = pd.factorize(groups)
+    rng = np.random.default_rng(seed)
+    fold = (rng.permutation(len(uniques)) % folds)[codes]
+
+    scores = np.zeros(len(X))
+    for k in range(folds):
+        train,test = fold != k,fold == k
+        if not test.any():
+            continue
+        Xtr,ttr = X[train],is_target[train]
+        w = _initial_direction(Xtr,ttr,train_fdr)
+        for _ in range(iterations):
+            w_new = _train_iteration(Xtr,ttr,w,train_fdr,test_fdr)
+            if w_new is None:
+                break
+            # 학습 집합이 더 이상 바뀌지 않아 weight가 수렴하면 남은 iteration 생략
+            converged = np.allclose(w_new,w,rtol=1e-6,atol=1e-9)
+            w = w_new
+            if converged:
+                break
+        print(f"rescore fold {k + 1}/{folds}: weights {np.round(w,4).tolist()}, "
+              f"train PSMs at q<={test_fdr}: {_count_passing(Xtr @ w,ttr,test_fdr)}")
+        scores[test] = _normalize_fold_scores(X[test] @ w,is_target[test],test_fdr)
+    return scores,_qvalues(scores,is_target),posterior_error_probs(scores,is_target)
+
+
+def rescore_pin_df(pin_df,**params):
+    """
+    PIN dataframe을 내장 rescoring으로 점수화 -> read_percolator_result 형태의 (target, decoy) 결과
+    (PSMId(_charge 제거), score, q-value, posterior_error_prob, peptide, proteinIds; score 내림차순)
+    """
+    params = {**RESCORE_PARAMS,**params}
+    is_target = pin_df['Label'].to_numpy() == 1
+    psm_id = strip_psmid_suffix(pin_df['SpecId'].astype(str))
+    scores,qvalues,peps = percolator_rescore(pin_df[pin_feature_columns(pin_df)].to_numpy(),is_target,
+                                             psm_id.to_numpy(),**params)
+    out = pd.DataFrame({
+        'PSMId': psm_id.to_numpy(),
+        'score': scores,
+        'q-value': qvalues,
+        'posterior_error_prob': peps,
+        'peptide': pin_df['Peptide'].astype(str).to_numpy(),
+        'proteinIds': pin_df['Proteins'].astype(str).to_numpy(),
+    })
+    order = np.argsort(-scores,kind='stable')
+    return (out.iloc[order[is_target[order]]].reset_index(drop=True),
+            out.iloc[order[~is_target[order]]].reset_index(drop=True))
+
+
+def load_rescored_df(pin_path,cache_dir=None,**params):
+    """
+    t_d.pin을 내장 rescoring으로 점수화해서 load_percolator_df와 같은 정규화 dataframe 반환
+    (Percolator 실행과 out.target/out.decoy 읽기를 대체, cache는 load_percolator_df와 같음)
+    """
+    params = {**RESCORE_PARAMS,**params}
+    return _load_cached(_percolator_cache_key(pin_path,params=params),cache_dir,
+                        lambda: normalize_percolator_frames(*rescore_pin_df(read_pin(pin_path),**params)))
+
+
+def load_fdr_input(target_path,decoy_path,pin_path=None,cache_dir=None):
+    if pin_path:
+        return load_rescored_df(pin_path,cache_dir=cache_dir)
+    return load_percolator_df(target_path,decoy_path,cache_dir=cache_dir)
+
+
+def peptide_fdr_results(ori_df,fdr_rates):
+    """
+    load_percolator_df 결과에서 peptide 단위 FDR을 한 번 계산하고 fdr_rates 각각의 결과 반환 {fdr_rate: df}
+    """
+    ori_df = ori_df.assign(rank_first=ori_df.groupby(['pep'],observed=True)['score'].rank(method='first', ascending=False))
+    ori_pep_df = ori_df[ori_df['rank_first']==1.0]
+    #print(len(ori_pep_df))
+    
+    ori_sort = ori_pep_df.sort_values(by=['score','label'],ascending=[False,False])
+    ori_sort.reset_index(inplace=True,drop=True)
+    ori_sort = compute_fdr(ori_sort)
+
+    results = {}
+    for fdr_rate in fdr_rates:
+        fdr_df,_ = make_fdr(ori_sort,fdr_rate)
+        min_score = fdr_df['score'].min()
+        #print(min_score)
+
+        fdr_pep_df = ori_df.loc[ori_df['pep'].isin(fdr_df['pep'])]
+        #print(len(fdr_pep_df))
+        
+        fdr_t_df = fdr_pep_df[(fdr_pep_df['label'] == 1) & (fdr_pep_df['score'] >= min_score)].copy()
+        print(f"After Peptide FDR({fdr_rate}) estimated, PSM rows: ",len(fdr_t_df))
+
+        results[fdr_rate] = add_output_ids(fdr_t_df)
+
+    return results
+
+
+def psm_fdr_results(ori_df,fdr_rates):
+    """
+    load_percolator_df 결과에서 PSM 단위 FDR을 한 번 계산하고 fdr_rates 각각의 결과 반환 {fdr_rate: df}
+    """
+    ori_scan_df = ori_df[ori_df['rank_scan']==1.0]
+    
+    ori_sort = ori_scan_df.sort_values(by=['score','label'],ascending=[False,False])
+    ori_sort.reset_index(inplace=True,drop=True)
+    ori_sort = compute_fdr(ori_sort)
+
+    results = {}
+    for fdr_rate in fdr_rates:
+        fdr_df,_ = make_fdr(ori_sort,fdr_rate)
+
+        fdr_t_df = add_output_ids(fdr_df[fdr_df['label']==1].copy())
+        
+        print(f"After PSM FDR({fdr_rate}) estimated, PSM rows: ",len(fdr_t_df))
+        results[fdr_rate] = fdr_t_df
+    
+    return results
+
+
+def peptide_fdr(target_path,decoy_path,fdr_rate):
+    ori_df = load_percolator_df(target_path,decoy_path)
+    return peptide_fdr_results(ori_df,[fdr_rate])[fdr_rate]
+
+
+def psm_fdr(target_path,decoy_path,fdr_rate):
+    ori_df = load_percolator_df(target_path,decoy_path)
+    return psm_fdr_results(ori_df,[fdr_rate])[fdr_rate]
+
+
+FDR_RESULT_FUNCS = {'psm': psm_fdr_results, 'peptide': peptide_fdr_results}
+
+
+def split_arg_list(value):
+    """
+    comma-separated 인자를 list로 변환 (공백 제거, 빈 항목 제거, 중복은 처음 나온 순서대로 하나만 유지)
+    """
+    return list(dict.fromkeys(v.strip() for v in value.split(',') if v.strip()))
+
+
+def check_fdr_types(fdr_types):
+    """
+    FDR_RESULT_FUNCS에 없는 fdr_type이 있으면 ValueError (psm으로 바꿔서 계산하면 다른 결과가 조용히 저장됨)
+    """
+    unknown = [fdr_type for fdr_type in fdr_types if fdr_type not in FDR_RESULT_FUNCS]
+    if unknown:
+        raise ValueError(f"unknown FDR type(s): {', '.join(unknown)} (choose from {', '.join(FDR_RESULT_FUNCS)})")
+    return fdr_types
+
+
+def estimate_fdr(fdr_type,target_path,decoy_path,fdr,output_fdr,pin_path=None,cache_dir=None):
+    
+    fdr = float(fdr)
+    
+    ori_df = load_fdr_input(target_path,decoy_path,pin_path,cache_dir=cache_dir)
+    if fdr_type == 'peptide': #peptide fdr
+        fdr_df = peptide_fdr_results(ori_df,[fdr])[fdr]
+        fdr_df.to_csv(os.path.join(output_fdr, 'fdr_result.csv'), index=False)
+    else: # psm fdr
+        fdr_df = psm_fdr_results(ori_df,[fdr])[fdr]
+        fdr_df.to_csv(os.path.join(output_fdr, 'fdr_result.csv'), index=False)
+
+
+def sweep_fdr(fdr_types,target_path,decoy_path,fdr_rates,output_fdr,output_format='csv',pin_path=None,
+              cache_dir=None):
+    """
+    Percolator 결과를 한 번만 읽고, level(psm/peptide)별로 정렬/q-value 계산도 한 번만 한 뒤
+    모든 (level, fdr_rate) 결과 저장.
+    - csv: fdr_result_<level>_<fdr_rate>.csv
+    - parquet: fdr_result.parquet/fdr_type=<level>/fdr_rate=<fdr_rate>/part-0.parquet (hive partition, pyarrow 필요)
+    fdr_types의 중복은 한 번만 계산하고, FDR_RESULT_FUNCS에 없는 type이 있으면 ValueError.
+    """
+    if output_format == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print("WARNING: pyarrow is not installed; writing FDR sweep results as CSV")
+            output_format = 'csv'
+
+    fdr_types = check_fdr_types(list(dict.fromkeys(fdr_types)))
+    ori_df = load_fdr_input(target_path,decoy_path,pin_path,cache_dir=cache_dir)
+    rates = {fdr_rate: float(fdr_rate) for fdr_rate in fdr_rates}
+
+    for fdr_type in fdr_types:
+        results = FDR_RESULT_FUNCS[fdr_type](ori_df,list(dict.fromkeys(rates.values())))
+        for fdr_rate, rate in rates.items():
+            fdr_df = results[rate]
+            if output_format == 'parquet':
+                part_dir = os.path.join(output_fdr, 'fdr_result.parquet', f'fdr_type={fdr_type}', f'fdr_rate={fdr_rate}')
+                os.makedirs(part_dir, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(fdr_df, preserve_index=False),
+                               os.path.join(part_dir, 'part-0.parquet'))
+            else:
+                fdr_df.to_csv(os.path.join(output_fdr, f'fdr_result_{fdr_type}_{fdr_rate}.csv'), index=False)
+
+
+
+if __name__ == "__main__":
+    
+    parser = argparse.ArgumentParser(description="parameters")
+    parser.add_argument("--fdr_type", type=str, required=True, help="FDR type (psm, peptide or comma-separated list for a sweep)")
+    parser.add_argument("--target_path", type=str, help="percolator target result path")
+    parser.add_argument("--decoy_path", type=str, help="percolator decoy mgf path")
+    parser.add_argument("--pin_path", type=str, default=os.getenv("NOVOCERT_PIN_PATH"),
+                        help="rescore this t_d.pin with the built-in engine instead of reading Percolator results")
+    parser.add_argument("--fdr_rate", type=str, required=True, help="FDR rate (comma-separated list for a sweep, e.g. 0.001,0.01,0.05)")
+    parser.add_argument("--output_dir", type=str, required=True, help="output directory")
+    parser.add_argument("--sweep_format", type=str, choices=["csv", "parquet"],
+                        default=os.getenv("NOVOCERT_FDR_SWEEP_FORMAT", "csv"),
+                        help="output format when several FDR types/rates are given")
+    parser.add_argument("--cache_dir", type=str, default=os.getenv("NOVOCERT_FDR_CACHE_DIR"),
+                        help="keep the normalized Percolator/rescored table here and reuse it while the inputs "
+                             "are unchanged (for repeated FDR runs on the same results; off unless set)")
+    args = parser.parse_args()
+    if not args.pin_path and not (args.target_path and args.decoy_path):
+        parser.error("--target_path and --decoy_path are required unless --pin_path is given")
+    try:
+        check_fdr_types(split_arg_list(args.fdr_type))
+    except ValueError as e:
+        parser.error(f"--fdr_type: {e}")
+    print(args)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    print("start FDR estimation...")
+    
+    fdr_types = split_arg_list(args.fdr_type)
+    fdr_rates = split_arg_list(args.fdr_rate)
+    if len(fdr_types) == 1 and len(fdr_rates) == 1:
+        estimate_fdr(fdr_types[0],args.target_path,args.decoy_path,fdr_rates[0],args.output_dir,args.pin_path,
+                     args.cache_dir)
+    else:
+        sweep_fdr(fdr_types,args.target_path,args.decoy_path,fdr_rates,args.output_dir,args.sweep_format,
+                  args.pin_path,args.cache_dir)
+
+    print("all done.")
\ No newline at end of file
@@ -0,0 +1,27 @@
+#!/bin/bash
+# NOVOCERT_RESCORE_ENGINE=builtin: percolator 바이너리 없이 fdr_control.py 내장 rescoring 사용 (실험용)
+# 실제 Percolator 출력과의 비교는 아직 없음 (합성 PIN 기준 결과와의 비교만 Docker/tests에서 확인).
+# 사용 전에 같은 t_d.pin의 Percolator 결과와 Docker/benchmarks/compare_rescoring.py로 비교할 것.
+if [ "${NOVOCERT_RESCORE_ENGINE:-percolator}" = "builtin" ]; then
+    echo "WARNING: built-in rescoring has not been validated against Percolator output;" \
+         "compare with Docker/benchmarks/compare_rescoring.py before relying on it"
+    python3 fdr_control.py \
+        --fdr_type ${FDR_TYPE} \
+        --pin_path t_d.pin \
+        --fdr_rate ${FDR} \
+        --output_dir output
+    exit $?
+fi
+
+percolator t_d.pin \
+    -m output/out.target \
+    -M output/out.decoy \
+    -w output/out.weight \
+    -Y -U
+
+python3 fdr_control.py \
+    --fdr_type ${FDR_TYPE} \
+    --target_path output/out.target \
+    --decoy_path output/out.decoy \
+    --fdr_rate ${FDR} \
+    --output_dir output
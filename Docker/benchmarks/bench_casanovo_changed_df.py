@@ -0,0 +1,107 @@
+"""
+get_casanovo_changed_df 벤치마크: 기존 row-wise apply 구현 vs vectorized 구현.
+
+    python Docker/benchmarks/bench_casanovo_changed_df.py --rows 5000000
+
+합성 beam-search PSM 테이블(rows 행)을 만들어 두 구현의 실행 시간을 비교하고,
+--check 옵션이 있으면 두 결과가 동일한지 확인한다.
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '3-Feature-calculation', 'app'))
+
+import feature_calculation as fc  # noqa: E402
+from synthetic_data import random_peptides  # noqa: E402
+
+
+def get_casanovo_changed_df_rowwise(ori_df):
+    """변경 전 row-wise apply 구현 (비교 기준)"""
+    ori_df['Source File'] = ori_df.apply(lambda x: fc.get_sourcefile(x['SS']), axis=1)
+    ori_df['Tag length'] = ori_df.apply(lambda x: fc.get_pep_len(x['Peptide']), axis=1)
+    ori_df['z'] = ori_df['z'].apply(lambda x: int(x))
+    ori_df['Casanovo score'] = ori_df['Casanovo score'].apply(lambda x: float(x))
+
+    tmp_df = ori_df[['Source File','Scan','Peptide','Casanovo score','z','m/z','RT','Tag length','run']]
+    tmp_df['rank_first'] = tmp_df.groupby(['Source File','Scan'])['Casanovo score'].rank(method='first', ascending=False)
+    tmp_df['Peptide'] = tmp_df['Peptide'].apply(lambda x: x.replace('I','L').replace('(','').replace(')',''))
+    tmp_df['msp_pep'] = tmp_df.apply(lambda x: fc.get_ptm_peptide(x['Peptide']), axis=1)
+    tmp_df['peptide'] = tmp_df.apply(lambda x: fc.get_nonnum_peptide(x['Peptide']), axis=1)
+    tmp_df['peptidoform'] = tmp_df.apply(lambda x: fc.combine_columns([x['msp_pep'],x['z']],'/'), axis=1)
+    tmp_df['SS'] = tmp_df.apply(lambda x: fc.combine_columns([x['Source File'],x['Scan']],'_'), axis=1)
+    tmp_df['ID'] = tmp_df.apply(lambda x: fc.combine_columns([x['SS'],x['peptide']],'_'), axis=1)
+    tmp_df['IDD'] = tmp_df.apply(lambda x: fc.combine_columns([x['SS'],x['Peptide']],'_'), axis=1)
+    tmp_df = tmp_df[(tmp_df['Tag length']>=6)&(tmp_df['Tag length']<=60)]
+    tmp_df = tmp_df[tmp_df['z']<=6]
+    return tmp_df
+
+
+def materialize_changed_df(new_df):
+    """vectorized 결과에 문자열 ID 컬럼을 만들고 categorical을 풀어서 row-wise 결과와 같은 형태로 맞춤"""
+    ids = fc.composite_id_columns(new_df, ["peptide", "peptidoform", "SS", "ID", "IDD"])
+    out = pd.concat([new_df, ids], axis=1)
+    for col in ('Source File', 'run'):
+        out[col] = out[col].astype(object)
+    return out
+
+
+def make_synthetic_psm_df(n_rows, beams=5, n_runs=4, seed=0):
+    """read_mztab_psm + attach_mgf_metadata 이후와 같은 형태의 합성 PSM 테이블"""
+    rng = np.random.default_rng(seed)
+    peptides = random_peptides(rng, n_rows)
+
+    spectrum = np.arange(n_rows) // beams
+    run = np.char.add(np.char.add("run", (spectrum % n_runs).astype(str)), ".mgf")
+    scan = spectrum // n_runs + 1000
+
+    df = pd.DataFrame({
+        'Peptide': peptides,
+        'Casanovo score': np.char.mod('%.6f', rng.uniform(-1, 1, size=n_rows)).astype(object),
+        'z': rng.integers(1, 8, size=n_rows).astype(np.float64),
+        'm/z': np.char.mod('%.5f', rng.uniform(300, 1500, size=n_rows)).astype(object),
+        'RT': rng.uniform(0, 7200, size=n_rows),
+        'Scan': scan,
+        'run': run.astype(object),
+    })
+    df['SS'] = fc.combine_series(df['run'].str.split('.').str[0], df['Scan'], '_')
+    return df
+
+
+def _timed(label, func, df):
+    t0 = time.perf_counter()
+    out = func(df)
+    elapsed = time.perf_counter() - t0
+    print(f"{label:>10}: {elapsed:10.2f} s  ({len(df) / elapsed:,.0f} rows/s)")
+    return out, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="get_casanovo_changed_df benchmark")
+    parser.add_argument("--rows", type=int, default=5_000_000, help="number of synthetic PSM rows")
+    parser.add_argument("--beams", type=int, default=5, help="beams per spectrum")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--skip-rowwise", action="store_true", help="only time the vectorized path")
+    parser.add_argument("--check", action="store_true", help="assert both paths give identical output")
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")
+
+    t0 = time.perf_counter()
+    psm_df = make_synthetic_psm_df(args.rows, beams=args.beams, seed=args.seed)
+    print(f"synthetic table: {len(psm_df):,} rows ({time.perf_counter() - t0:.1f} s)")
+
+    new_df, new_t = _timed("vectorized", fc.get_casanovo_changed_df, psm_df.copy())
+    if not args.skip_rowwise:
+        old_df, old_t = _timed("row-wise", get_casanovo_changed_df_rowwise, psm_df.copy())
+        print(f"{'speedup':>10}: {old_t / new_t:10.1f} x")
+        if args.check:
+            pd.testing.assert_frame_equal(old_df.drop(columns=['msp_pep']),
+                                          materialize_changed_df(new_df)[old_df.columns.drop('msp_pep')])
+            print("outputs identical")
@@ -0,0 +1,393 @@
+"""
+feature 계산 / FDR 단계의 CPU hot path 벤치마크 (합성 데이터, 오프라인).
+
+    python Docker/benchmarks/bench_hot_paths.py --psms 1000000
+    python Docker/benchmarks/bench_hot_paths.py --psms 100000 --cases make_fdr psm_fdr --repeat 3
+
+- 입력은 synthetic_data.py로 <data_dir>에 한 번 생성하고 재사용 (같은 --psms/--seed면 같은 파일)
+- case마다 새 프로세스(spawn)에서 setup -> 측정을 하므로 이전 case의 메모리/캐시 영향이 없음
+- wall time(repeat 중 최솟값), 처리량(rows/s), 측정 구간의 peak 메모리 증가량(VmHWM - 시작 시 RSS) 기록
+- 결과는 git commit과 함께 --results(JSON lines)에 추가, 이전 commit 결과가 있으면 비율을 같이 출력
+- ML predictor(MS2PIP/DeepLC)는 쓰지 않음. feature_stages case는 predictor를 stub으로 바꿔서
+  mzTab -> DeepLC stage 전체 흐름을 측정
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FEATURE_APP = os.path.join(BENCH_DIR, '..', '3-Feature-calculation', 'app')
+FDR_APP = os.path.join(BENCH_DIR, '..', '4-Percolator-and-FDRControl', 'app')
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic_data  # noqa: E402
+
+FDR_RATE = 0.01
+
+
+def _import(app_dir, name):
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    return __import__(name)
+
+
+def _fc():
+    return _import(FEATURE_APP, 'feature_calculation')
+
+
+def _fdr():
+    return _import(FDR_APP, 'fdr_control')
+
+
+class StubMS2PIPFeatureGenerator:
+    """MS2PIPFeatureGenerator 대체: 모델 없이 peptidoform hash로 정해지는 값"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def add_features(self, psm_list):
+        for psm in psm_list:
+            h = zlib.crc32(str(psm.peptidoform).encode()) / 0xFFFFFFFF
+            psm.rescoring_features.update({'spec_pearson': h, 'cos': h, 'cos_norm': h, 'spec_mse': 1 - h})
+
+
+class StubDeepLCFeatureGenerator:
+    """DeepLCFeatureGenerator 대체: peptide hash로 정해지는 예측 RT"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def add_features(self, psm_list):
+        for psm in psm_list:
+            pred = zlib.crc32(psm.peptidoform.proforma.split('/')[0].encode()) / 0xFFFFFFFF * 7200
+            obs = psm.retention_time
+            psm.rescoring_features.update({'observed_retention_time': obs, 'predicted_retention_time': pred,
+                                           'rt_diff': abs(pred - obs)})
+
+
+# case 정의: setup(data) -> prepare, prepare() -> run 인자 (측정 제외), run(*args) -> 처리한 row 수
+def _setup_read_mztab(data):
+    fc = _fc()
+    return lambda: (fc, data['mztab'])
+
+
+def _run_read_mztab(fc, path):
+    return len(fc.read_mztab_psm(path))
+
+
+def _remove_mgf_index(mgf_dir):
+    for name in os.listdir(mgf_dir):
+        if name.endswith('.offsets.npz'):
+            os.remove(os.path.join(mgf_dir, name))
+
+
+def _setup_attach_mgf(data):
+    fc = _fc()
+    psm_df, msrun_to_path = fc.load_mztab_stage(data['mztab'])
+
+    def prepare():
+        # sidecar MGF index를 지워서 매번 cold scan 기준으로 측정
+        _remove_mgf_index(data['mgf_dir'])
+        return fc, psm_df.copy(), msrun_to_path, data['mgf_dir']
+    return prepare
+
+
+def _run_attach_mgf(fc, psm_df, msrun_to_path, mgf_dir):
+    return len(fc.attach_mgf_stage(psm_df, msrun_to_path, mgf_dir))
+
+
+def _mgf_files(mgf_dir):
+    return sorted(os.path.join(mgf_dir, name) for name in os.listdir(mgf_dir) if name.endswith('.mgf'))
+
+
+def _setup_spectral_store(data):
+    fc = _fc()
+    store_dir = tempfile.mkdtemp(prefix='bench_spectra_')
+
+    def prepare():
+        # 변환된 store를 지워서 매번 MGF -> binary store 변환부터 측정
+        shutil.rmtree(store_dir, ignore_errors=True)
+        fc._SPECTRAL_STORES.clear()
+        return fc, _mgf_files(data['mgf_dir']), store_dir
+    return prepare
+
+
+def _run_spectral_store(fc, mgf_files, store_dir):
+    return sum(len(fc.open_spectral_store(path, store_dir)) for path in mgf_files)
+
+
+def _setup_attach_mgf_store(data):
+    fc = _fc()
+    psm_df, msrun_to_path = fc.load_mztab_stage(data['mztab'])
+    store_dir = tempfile.mkdtemp(prefix='bench_spectra_')
+    for path in _mgf_files(data['mgf_dir']):
+        fc.open_spectral_store(path, store_dir)
+    return lambda: (fc, psm_df.copy(), msrun_to_path, data['mgf_dir'], store_dir)
+
+
+def _run_attach_mgf_store(fc, psm_df, msrun_to_path, mgf_dir, store_dir):
+    return len(fc.attach_mgf_stage(psm_df, msrun_to_path, mgf_dir, store_dir))
+
+
+def _setup_changed_df(data):
+    fc = _fc()
+    psm_df = fc.attach_mgf_stage(*fc.load_mztab_stage(data['mztab']), data['mgf_dir'])
+    return lambda: (fc, psm_df.copy())
+
+
+def _run_changed_df(fc, psm_df):
+    fc.get_casanovo_changed_df(psm_df)
+    return len(psm_df)
+
+
+def _setup_feature_stages(data):
+    fc = _fc()
+    fc.MS2PIPFeatureGenerator = StubMS2PIPFeatureGenerator
+    fc.DeepLCFeatureGenerator = StubDeepLCFeatureGenerator
+    return lambda: (fc, data['mztab'], data['mgf_dir'])
+
+
+def _run_feature_stages(fc, mztab_path, mgf_dir):
+    pattern = r'(?:NativeID:".*scan=|.*?\.)(\d+)(?:\.\d+\.\d+)?'
+    # stub은 ms2rescore feature generator를 대체하므로 full mode로 실행
+    return len(fc.compute_feature_stages(lambda: fc.load_mztab_stage(mztab_path), mgf_dir, pattern,
+                                         feature_mode='full'))
+
+
+def _setup_pin(data):
+    fc = _fc()
+    t_df, d_df = synthetic_data.make_pin_inputs(data['psms'], seed=data['seed'])
+    out_dir = tempfile.mkdtemp(prefix='bench_pin_')
+
+    def prepare():
+        return fc, t_df, d_df, out_dir
+    return prepare
+
+
+def _run_pin(fc, t_df, d_df, out_dir):
+    try:
+        fc.percolator_dm_alc_output(t_df, d_df, out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir, exist_ok=True)
+    return len(t_df) + len(d_df)
+
+
+def _setup_make_fdr(data):
+    fdr = _fdr()
+    ori_df = fdr.load_percolator_df(data['target'], data['decoy'])
+    ori_sort = ori_df[ori_df['rank_scan'] == 1.0].sort_values(by=['score', 'label'], ascending=[False, False])
+    ori_sort = ori_sort.reset_index(drop=True)
+    return lambda: (fdr, ori_sort)
+
+
+def _run_make_fdr(fdr, ori_sort):
+    fdr.make_fdr(ori_sort, FDR_RATE)
+    return len(ori_sort)
+
+
+def _setup_fdr(data):
+    fdr = _fdr()
+
+    def prepare():
+        # in-process Percolator 결과 cache를 비워서 파일 읽기부터 측정
+        fdr._LOADED.clear()
+        return fdr, data['target'], data['decoy']
+    return prepare
+
+
+def _run_peptide_fdr(fdr, target_path, decoy_path):
+    fdr.peptide_fdr(target_path, decoy_path, FDR_RATE)
+    return len(fdr.load_percolator_df(target_path, decoy_path))
+
+
+def _run_psm_fdr(fdr, target_path, decoy_path):
+    fdr.psm_fdr(target_path, decoy_path, FDR_RATE)
+    return len(fdr.load_percolator_df(target_path, decoy_path))
+
+
+def _setup_rescore_pin(data):
+    fdr = _fdr()
+    pin_df = fdr.pin_frame(*synthetic_data.make_pin_inputs(data['psms'], seed=data['seed']))
+    return lambda: (fdr, pin_df)
+
+
+def _run_rescore_pin(fdr, pin_df):
+    fdr.rescore_pin_df(pin_df)
+    return len(pin_df)
+
+
+CASES = {
+    'read_mztab_psm': (_setup_read_mztab, _run_read_mztab),
+    'attach_mgf_metadata': (_setup_attach_mgf, _run_attach_mgf),
+    'spectral_store': (_setup_spectral_store, _run_spectral_store),
+    'attach_mgf_store': (_setup_attach_mgf_store, _run_attach_mgf_store),
+    'get_casanovo_changed_df': (_setup_changed_df, _run_changed_df),
+    'percolator_dm_alc_output': (_setup_pin, _run_pin),
+    'make_fdr': (_setup_make_fdr, _run_make_fdr),
+    'peptide_fdr': (_setup_fdr, _run_peptide_fdr),
+    'psm_fdr': (_setup_fdr, _run_psm_fdr),
+    'rescore_pin': (_setup_rescore_pin, _run_rescore_pin),
+    'feature_stages': (_setup_feature_stages, _run_feature_stages),
+}
+DEFAULT_CASES = [name for name in CASES if name not in ('rescore_pin', 'feature_stages')]
+
+
+def _proc_status_mb(field):
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Linux: clear_refs에 5를 쓰면 VmHWM(peak RSS)이 현재 RSS로 초기화됨
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _run_case(name, data, repeat):
+    """spawn된 프로세스에서 case 하나 실행 후 측정값 반환"""
+    warnings.simplefilter('ignore')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return _measure_case(name, data, repeat)
+
+
+def _measure_case(name, data, repeat):
+    setup, run = CASES[name]
+    prepare = setup(data)
+
+    best, peak, rows = None, 0.0, None
+    for _ in range(repeat):
+        args = prepare()
+        can_reset = _reset_peak_rss()
+        rss0 = _proc_status_mb('VmRSS')
+        maxrss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        t0 = time.perf_counter()
+        rows = run(*args)
+        elapsed = time.perf_counter() - t0
+        if can_reset and rss0 is not None:
+            used = _proc_status_mb('VmHWM') - rss0
+        else:
+            used = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - maxrss0
+        best = elapsed if best is None else min(best, elapsed)
+        peak = max(peak, used)
+        del args
+    return {'case': name, 'rows': rows, 'wall_s': round(best, 4),
+            'rows_per_s': round(rows / best) if best else None, 'peak_mem_mb': round(peak, 1)}
+
+
+def prepare_data(data_dir, psms, beams, runs, peaks, seed):
+    """data_dir에 같은 인자로 만든 입력이 있으면 재사용, 없으면 생성"""
+    params = {'psms': psms, 'beams': beams, 'runs': runs, 'peaks': peaks, 'seed': seed}
+    marker = os.path.join(data_dir, 'params.json')
+    data = {
+        'mztab': os.path.join(data_dir, 'casanovo', 'result.mztab'),
+        'mgf_dir': os.path.join(data_dir, 'casanovo', 'mgf'),
+        'target': os.path.join(data_dir, 'percolator', 'out.target'),
+        'decoy': os.path.join(data_dir, 'percolator', 'out.decoy'),
+        'psms': psms,
+        'seed': seed,
+    }
+    if os.path.exists(marker):
+        with open(marker) as fh:
+            if json.load(fh) == params:
+                return data
+    shutil.rmtree(data_dir, ignore_errors=True)
+    t0 = time.perf_counter()
+    synthetic_data.write_mztab_and_mgf(os.path.join(data_dir, 'casanovo'), psms, beams=beams,
+                                       n_runs=runs, peaks=peaks, seed=seed)
+    synthetic_data.write_percolator_results(os.path.join(data_dir, 'percolator'), psms, n_runs=runs, seed=seed)
+    with open(marker, 'w') as fh:
+        json.dump(params, fh)
+    print(f"synthetic data written to {data_dir} ({time.perf_counter() - t0:.1f} s)")
+    return data
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BENCH_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return rev + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def previous_results(results_path, psms, commit):
+    """같은 --psms로 측정한 이전 commit의 마지막 결과 {case: record}"""
+    prev = {}
+    if not os.path.exists(results_path):
+        return prev
+    with open(results_path) as fh:
+        for line in fh:
+            rec = json.loads(line)
+            if rec.get('psms') == psms and rec.get('commit') != commit:
+                prev[rec['case']] = rec
+    return prev
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="feature/FDR hot path benchmark")
+    parser.add_argument("--psms", type=int, default=100_000, help="number of synthetic PSMs (10k - 10M)")
+    parser.add_argument("--beams", type=int, default=5, help="PSMs per spectrum in the mzTab")
+    parser.add_argument("--runs", type=int, default=4, help="number of MGF files / ms_runs")
+    parser.add_argument("--peaks", type=int, default=20, help="peaks per MGF spectrum")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--repeat", type=int, default=1, help="repetitions per case (best wall time is reported)")
+    parser.add_argument("--cases", type=str, nargs="+", choices=sorted(CASES), default=DEFAULT_CASES,
+                        help="cases to run (feature_stages runs the stage pipeline with stubbed predictors)")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="synthetic input directory (default: <tmp>/novocert_bench/<psms>_<seed>)")
+    parser.add_argument("--results", type=str, default=None,
+                        help="JSON lines file the results are appended to (default: <tmp>/novocert_bench/hot_paths.jsonl)")
+    args = parser.parse_args()
+
+    bench_root = os.path.join(tempfile.gettempdir(), 'novocert_bench')
+    data_dir = args.data_dir or os.path.join(bench_root, f"{args.psms}_{args.seed}")
+    args.results = args.results or os.path.join(bench_root, 'hot_paths.jsonl')
+    data = prepare_data(data_dir, args.psms, args.beams, args.runs, args.peaks, args.seed)
+
+    commit = git_revision()
+    prev = previous_results(args.results, args.psms, commit)
+    env = {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()}
+    created = datetime.now().isoformat(timespec='seconds')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    print(f"commit {commit}, {args.psms:,} PSMs, repeat {args.repeat}")
+    print(f"{'case':>26} {'rows':>11} {'wall s':>9} {'rows/s':>12} {'peak MB':>9}  vs prev")
+    ctx = multiprocessing.get_context("spawn")
+    for name in args.cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            rec = executor.submit(_run_case, name, data, args.repeat).result()
+        old = prev.get(name)
+        ratio = f"{old['wall_s'] / rec['wall_s']:.2f}x ({old['commit']})" if old and rec['wall_s'] else ""
+        print(f"{name:>26} {rec['rows']:>11,} {rec['wall_s']:>9.3f} {rec['rows_per_s']:>12,} "
+              f"{rec['peak_mem_mb']:>9.1f}  {ratio}")
+        rec.update(commit=commit, created=created, psms=args.psms, beams=args.beams, runs=args.runs,
+                   peaks=args.peaks, seed=args.seed, repeat=args.repeat, **env)
+        with open(args.results, 'a') as fh:
+            fh.write(json.dumps(rec) + '\n')
+    print(f"results appended to {args.results}")
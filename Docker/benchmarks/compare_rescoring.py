@@ -0,0 +1,93 @@
+"""
+내장 rescoring(fdr_control.rescore_pin_df)과 Percolator 바이너리 결과 비교 (같은 t_d.pin 기준).
+
+    percolator t_d.pin -m out.target -M out.decoy -Y -U
+    python Docker/benchmarks/compare_rescoring.py --pin t_d.pin --target out.target --decoy out.decoy
+
+- PSM(PSMId, target/decoy)별 score의 Pearson / Spearman 상관
+- 각 FDR에서 PSM / peptide level로 통과한 target PSM 수와 두 결과의 겹침(Jaccard)
+- --min_spearman / --min_jaccard 기준을 못 넘으면 exit status 1 (NOVOCERT_RESCORE_ENGINE=builtin 사용 전 확인용)
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '4-Percolator-and-FDRControl', 'app'))
+
+import fdr_control as fdr  # noqa: E402
+
+
+def _rank_corr(x, y):
+    return np.corrcoef(pd.Series(x).rank().to_numpy(), pd.Series(y).rank().to_numpy())[0, 1]
+
+
+def _accepted(ori_df, level, fdr_rate):
+    results = fdr.FDR_RESULT_FUNCS[level](ori_df, [fdr_rate])[fdr_rate]
+    return set(zip(results['PSMId'], results['peptide'].astype(str)))
+
+
+def compare_results(builtin, percolator, fdr_rates):
+    """
+    정규화한 두 결과(load_percolator_df 형태) 비교
+    -> {'matched', 'pearson', 'spearman', 'overlap': {(level, fdr_rate): (built-in 수, Percolator 수, 공통 수, Jaccard)}}
+    """
+    merged = pd.merge(builtin[['PSMId', 'label', 'score']], percolator[['PSMId', 'label', 'score']],
+                      on=['PSMId', 'label'], suffixes=('_builtin', '_percolator'))
+    x, y = merged['score_builtin'].to_numpy(), merged['score_percolator'].to_numpy()
+    report = {'matched': len(merged), 'pearson': np.corrcoef(x, y)[0, 1], 'spearman': _rank_corr(x, y),
+              'overlap': {}}
+    for fdr_rate in fdr_rates:
+        for level in ('psm', 'peptide'):
+            a, b = _accepted(builtin, level, fdr_rate), _accepted(percolator, level, fdr_rate)
+            jaccard = len(a & b) / len(a | b) if a | b else 1.0
+            report['overlap'][(level, fdr_rate)] = (len(a), len(b), len(a & b), jaccard)
+    return report
+
+
+def agreement_failures(report, min_spearman, min_jaccard):
+    """compare_results 결과에서 기준(Spearman rho, 통과 PSM Jaccard 최솟값)을 못 넘은 항목 설명 list (빈 list = 통과)"""
+    failures = []
+    if not report['spearman'] >= min_spearman:
+        failures.append(f"Spearman rho {report['spearman']:.4f} < {min_spearman}")
+    for (level, fdr_rate), (_, _, _, jaccard) in report['overlap'].items():
+        if jaccard < min_jaccard:
+            failures.append(f"{level} FDR {fdr_rate}: Jaccard {jaccard:.3f} < {min_jaccard}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare built-in rescoring with Percolator results")
+    parser.add_argument("--pin", type=str, required=True, help="t_d.pin given to Percolator")
+    parser.add_argument("--target", type=str, required=True, help="Percolator out.target")
+    parser.add_argument("--decoy", type=str, required=True, help="Percolator out.decoy")
+    parser.add_argument("--fdr", type=str, default="0.01,0.05", help="comma-separated FDR rates")
+    parser.add_argument("--min_spearman", type=float, default=0.95,
+                        help="exit with status 1 if the score Spearman rho is below this")
+    parser.add_argument("--min_jaccard", type=float, default=0.9,
+                        help="exit with status 1 if the accepted-PSM Jaccard at any FDR/level is below this")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    builtin = fdr.normalize_percolator_frames(*fdr.rescore_pin_df(fdr.read_pin(args.pin)))
+    print(f"built-in rescoring: {time.perf_counter() - t0:.1f} s")
+    t0 = time.perf_counter()
+    percolator = fdr.load_percolator_df(args.target, args.decoy)
+    print(f"read Percolator results: {time.perf_counter() - t0:.1f} s")
+
+    report = compare_results(builtin, percolator, [float(r) for r in args.fdr.split(',') if r.strip()])
+    print(f"matched PSMs: {report['matched']:,} (built-in {len(builtin):,}, Percolator {len(percolator):,})")
+    print(f"score Pearson r = {report['pearson']:.4f}, Spearman rho = {report['spearman']:.4f}")
+    for (level, fdr_rate), (n_a, n_b, shared, jaccard) in report['overlap'].items():
+        print(f"{level:>7} FDR {fdr_rate}: built-in {n_a:,}, Percolator {n_b:,}, "
+              f"shared {shared:,} (Jaccard {jaccard:.3f})")
+
+    failures = agreement_failures(report, args.min_spearman, args.min_jaccard)
+    for failure in failures:
+        print(f"WARNING: {failure}")
+    print("agreement: " + ("FAILED" if failures else "ok"))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,185 @@
+"""
+벤치마크용 합성 입력 생성: Casanovo mzTab + MGF, Percolator out.target/out.decoy, PIN 입력 테이블.
+
+    python Docker/benchmarks/synthetic_data.py --psms 1000000 --output_dir /tmp/novocert_bench
+
+- 모든 값은 seed로 재현 가능 (같은 인자 -> 같은 파일)
+- mzTab/MGF는 feature_calculation.py가 읽는 형식 그대로 (ms_run[k]-location, spectra_ref=ms_run[k]:index=i,
+  TITLE/SCANS/RTINSECONDS), Percolator 출력은 fdr_control.py가 읽는 컬럼 그대로
+- 10M PSM 규모도 만들 수 있도록 chunk 단위로 씀
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+
+AA = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+MOD_TOKENS = np.array(["M+15.995", "C+57.021", "N+0.984", "Q+0.984"])
+NTERM_TOKENS = np.array(["+42.011", "+43.006", "-17.027"])
+
+MZTAB_PSH = ["sequence", "PSM_ID", "accession", "unique", "database", "database_version",
+             "search_engine", "search_engine_score[1]", "modifications", "retention_time",
+             "charge", "exp_mass_to_charge", "calc_mass_to_charge", "spectra_ref", "pre",
+             "post", "start", "end", "opt_ms_run[1]_aa_scores"]
+
+CHUNK = 200_000
+
+
+def random_peptides(rng, n, min_len=4, max_len=30, mod_rate=0.08, nterm_rate=0.05):
+    """Casanovo 형식 peptide 문자열 n개 (M+15.995 같은 mass-shift 표기, N-term mod 포함)"""
+    lengths = rng.integers(min_len, max_len, size=n)
+    total = int(lengths.sum())
+    tokens = AA[rng.integers(0, len(AA), size=total)].astype(object)
+    is_mod = rng.random(total) < mod_rate
+    tokens[is_mod] = MOD_TOKENS[rng.integers(0, len(MOD_TOKENS), size=int(is_mod.sum()))]
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    peptides = ["".join(tokens[bounds[i]:bounds[i + 1]]) for i in range(n)]
+    for i in np.flatnonzero(rng.random(n) < nterm_rate):
+        peptides[i] = NTERM_TOKENS[rng.integers(0, len(NTERM_TOKENS))] + peptides[i]
+    return peptides
+
+
+def _write_mgf(path, run_name, n_spec, peaks, rng):
+    with open(path, "w") as fh:
+        fh.write("MASS=Monoisotopic\n\n")
+        for start in range(0, n_spec, CHUNK):
+            idx = np.arange(start, min(n_spec, start + CHUNK))
+            scans = idx + 1000
+            charge = rng.integers(2, 5, size=len(idx))
+            pepmass = rng.uniform(300, 1500, size=len(idx))
+            rt = np.sort(rng.uniform(0, 7200, size=len(idx))) if n_spec <= CHUNK else \
+                (idx + rng.random(len(idx))) * (7200 / n_spec)
+            mz = np.char.mod("%.5f", rng.uniform(100, 2000, size=(len(idx), peaks)))
+            inten = np.char.mod("%.1f", rng.uniform(1, 1e5, size=(len(idx), peaks)))
+            peak_lines = np.char.add(np.char.add(mz, " "), inten)
+            fh.write("".join(
+                f"BEGIN IONS\n"
+                f"TITLE={run_name}.{s}.{s}.{z} File:\"{run_name}.raw\", NativeID:\"controllerType=0 controllerNumber=1 scan={s}\"\n"
+                f"PEPMASS={pm:.5f}\nCHARGE={z}+\nSCANS={s}\nRTINSECONDS={r:.4f}\n"
+                + "\n".join(p) + "\nEND IONS\n\n"
+                for s, z, pm, r, p in zip(scans, charge, pepmass, rt, peak_lines)
+            ))
+
+
+def write_mztab_and_mgf(output_dir, n_psms, beams=5, n_runs=4, peaks=20, seed=0):
+    """
+    n_psms개 PSM (spectrum당 beams개 후보)의 Casanovo mzTab과 run별 MGF 생성.
+    반환: (mztab 경로, mgf 디렉토리)
+    """
+    rng = np.random.default_rng(seed)
+    mgf_dir = os.path.join(output_dir, "mgf")
+    os.makedirs(mgf_dir, exist_ok=True)
+
+    n_spec = -(-n_psms // beams)
+    spec_per_run = np.full(n_runs, n_spec // n_runs)
+    spec_per_run[: n_spec % n_runs] += 1
+    run_names = [f"run{r}" for r in range(n_runs)]
+    for name, n in zip(run_names, spec_per_run):
+        _write_mgf(os.path.join(mgf_dir, f"{name}.mgf"), name, int(n), peaks, rng)
+
+    # spectrum i -> (run, index), 각 spectrum에 beams개 PSM
+    run_of_spec = np.repeat(np.arange(n_runs), spec_per_run)
+    index_of_spec = np.arange(n_spec) - np.repeat(np.cumsum(spec_per_run) - spec_per_run, spec_per_run)
+
+    mztab_path = os.path.join(output_dir, "result.mztab")
+    with open(mztab_path, "w") as fh:
+        fh.write("MTD\tmzTab-version\t1.0.0\n")
+        fh.write("MTD\tmzTab-mode\tSummary\n")
+        for r, name in enumerate(run_names):
+            fh.write(f"MTD\tms_run[{r + 1}]-location\tfile:///data/{name}.mgf\n")
+        fh.write("PSH\t" + "\t".join(MZTAB_PSH) + "\n")
+        for start in range(0, n_psms, CHUNK):
+            rows = np.arange(start, min(n_psms, start + CHUNK))
+            spec = rows // beams
+            n = len(rows)
+            df = pd.DataFrame({"PSM": "PSM"}, index=range(n))
+            df["sequence"] = random_peptides(rng, n)
+            df["PSM_ID"] = rows + 1
+            for col in ("accession", "unique", "database", "database_version"):
+                df[col] = "null"
+            df["search_engine"] = "[MS, MS:1003281, Casanovo, 4.2.0]"
+            df["search_engine_score[1]"] = np.char.mod("%.6f", rng.uniform(-1, 1, size=n))
+            df["modifications"] = "null"
+            df["retention_time"] = "null"
+            df["charge"] = rng.integers(1, 8, size=n)
+            df["exp_mass_to_charge"] = np.char.mod("%.5f", rng.uniform(300, 1500, size=n))
+            df["calc_mass_to_charge"] = np.char.mod("%.5f", rng.uniform(300, 1500, size=n))
+            df["spectra_ref"] = [f"ms_run[{r + 1}]:index={i}"
+                                 for r, i in zip(run_of_spec[spec], index_of_spec[spec])]
+            for col in ("pre", "post", "start", "end"):
+                df[col] = "null"
+            df["opt_ms_run[1]_aa_scores"] = "0.5,0.5"
+            df.to_csv(fh, sep="\t", header=False, index=False, lineterminator="\n")
+    return mztab_path, mgf_dir
+
+
+def write_percolator_results(output_dir, n_psms, n_runs=4, seed=0):
+    """
+    Percolator out.target/out.decoy (score 내림차순) 생성, target/decoy 각각 n_psms // 2 행.
+    반환: (target 경로, decoy 경로)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    n = max(n_psms // 2, 1)
+    pool = np.array(random_peptides(rng, max(n // 3, 1), min_len=6, max_len=25), dtype=object)
+    paths = []
+    for name, mu in (("out.target", 1.0), ("out.decoy", -0.5)):
+        run = rng.integers(0, n_runs, size=n)
+        scan = rng.integers(1000, 1000 + max(n // n_runs, 1), size=n)
+        charge = rng.integers(1, 7, size=n)
+        psm_id = pd.Series(np.char.add("run", run.astype(str)), dtype=object) + "_" + \
+            pd.Series(scan).astype(str) + "_" + pd.Series(charge).astype(str)
+        df = pd.DataFrame({
+            "PSMId": psm_id,
+            "score": np.round(rng.normal(mu, 1, size=n), 5),
+            "q-value": rng.random(n),
+            "posterior_error_prob": rng.random(n),
+            "peptide": "-." + pd.Series(pool[rng.integers(0, len(pool), size=n)]) + ".-",
+            "proteinIds": "1",
+        })
+        df = df.sort_values("score", ascending=False, kind="stable")
+        path = os.path.join(output_dir, name)
+        df.to_csv(path, sep="\t", index=False, chunksize=CHUNK)
+        paths.append(path)
+    return tuple(paths)
+
+
+def make_pin_inputs(n_psms, n_runs=4, seed=0):
+    """get_finally_save_csv 결과와 같은 형태의 target/decoy PIN 입력 테이블 (각각 n_psms // 2 행)"""
+    rng = np.random.default_rng(seed)
+    n = max(n_psms // 2, 1)
+    frames = []
+    for label in (1, -1):
+        run = rng.integers(0, n_runs, size=n)
+        scan = rng.integers(1000, 1000 + n, size=n)
+        frames.append(pd.DataFrame({
+            "SS": pd.Series(np.char.add("run", run.astype(str)), dtype=object) + "_" + pd.Series(scan).astype(str),
+            "Label": label,
+            "ScanNr": scan,
+            "SA": rng.random(n),
+            "absdRT": rng.exponential(300, size=n),
+            "absdMppm": rng.exponential(5, size=n),
+            "Peptide": pd.Series(random_peptides(rng, n), dtype=object),
+            "Proteins": 1,
+            "z": rng.integers(1, 7, size=n),
+        }))
+    return tuple(frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write synthetic benchmark inputs")
+    parser.add_argument("--psms", type=int, default=100_000, help="number of PSMs (mzTab rows, Percolator target+decoy rows)")
+    parser.add_argument("--beams", type=int, default=5, help="PSMs per spectrum in the mzTab")
+    parser.add_argument("--runs", type=int, default=4, help="number of MGF files / ms_runs")
+    parser.add_argument("--peaks", type=int, default=20, help="peaks per MGF spectrum")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output_dir", type=str, required=True, help="output directory")
+    args = parser.parse_args()
+
+    mztab_path, mgf_dir = write_mztab_and_mgf(os.path.join(args.output_dir, "casanovo"), args.psms,
+                                              beams=args.beams, n_runs=args.runs, peaks=args.peaks, seed=args.seed)
+    target_path, decoy_path = write_percolator_results(os.path.join(args.output_dir, "percolator"), args.psms,
+                                                       n_runs=args.runs, seed=args.seed)
+    print(mztab_path, mgf_dir, target_path, decoy_path, sep="\n")
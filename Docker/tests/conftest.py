@@ -0,0 +1,17 @@
+"""
+Docker stage 스크립트 단위 테스트 공통 설정.
+
+    python -m pytest -q Docker/tests
+
+- 각 stage의 app/ 디렉토리를 sys.path에 추가해서 feature_calculation / fdr_control을 바로 import
+- 무거운 의존성(ms2rescore/psm_utils/TensorFlow)은 import 하지 않는 순수 helper만 테스트
+"""
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+for app_dir in (os.path.join(TESTS_DIR, '..', '3-Feature-calculation', 'app'),
+                os.path.join(TESTS_DIR, '..', '4-Percolator-and-FDRControl', 'app')):
+    app_dir = os.path.normpath(app_dir)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
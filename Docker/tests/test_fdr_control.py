@@ -0,0 +1,267 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import fdr_control as fdr
+
+
+def _sorted_peaks(scores, labels):
+    return pd.DataFrame({'score': np.asarray(scores, dtype=float), 'label': labels})
+
+
+# --- target_decoy_fdr / compute_fdr ---
+
+def test_target_decoy_fdr_ties_share_group_end_fdr():
+    score = np.array([10, 9, 9, 9, 5], dtype=float)
+    is_target = np.array([True, True, False, True, True])
+    fdr_values, qvalue = fdr.target_decoy_fdr(score, is_target)
+    # 9점 동점 그룹은 그룹 끝(T=3, D=1) 기준 FDR을 공유
+    np.testing.assert_allclose(fdr_values, [0.0, 1 / 3, 1 / 3, 1 / 3, 1 / 4])
+    np.testing.assert_allclose(qvalue, [0.0, 1 / 4, 1 / 4, 1 / 4, 1 / 4])
+
+
+def test_target_decoy_fdr_leading_decoy_and_empty():
+    fdr_values, qvalue = fdr.target_decoy_fdr(np.array([3.0, 2.0, 1.0]), np.array([False, True, True]))
+    assert np.isinf(fdr_values[0])
+    np.testing.assert_allclose(qvalue, [0.5, 0.5, 0.5])
+    fdr_values, qvalue = fdr.target_decoy_fdr(np.empty(0), np.empty(0, dtype=bool))
+    assert len(fdr_values) == len(qvalue) == 0
+
+
+# --- make_fdr cutoff ---
+
+def test_make_fdr_keeps_whole_passing_tie_group():
+    peaks = _sorted_peaks([10, 9, 9, 9, 9, 5, 4], [1, 1, 1, 1, 1, -1, 1])
+    result, last_index = fdr.make_fdr(peaks, 0.01)
+    assert last_index == 5
+    assert result['label'].tolist() == [1] * 5
+
+
+def test_make_fdr_does_not_split_tie_with_decoy():
+    # 9점 동점 그룹 안에 decoy가 있으면 그룹 전체가 같은 FDR이라 같이 통과하거나 같이 빠짐
+    peaks = _sorted_peaks([10, 10, 10, 10, 9, 9, 9, 8], [1, 1, 1, 1, 1, -1, 1, 1])
+    assert fdr.make_fdr(peaks, 0.1)[1] == 4
+    assert fdr.make_fdr(peaks, 0.2)[1] == 8
+
+
+def test_make_fdr_all_targets_returns_every_row():
+    peaks = _sorted_peaks(np.arange(20, 0, -1), [1] * 20)
+    result, last_index = fdr.make_fdr(peaks, 0.01)
+    assert last_index == len(result) == 20
+
+
+def test_make_fdr_leading_decoy():
+    peaks = _sorted_peaks([10, 9, 8, 7, 6, 5], [-1, 1, 1, 1, -1, -1])
+    result, last_index = fdr.make_fdr(peaks, 0.5)
+    # 맨 앞 decoy(FDR inf)도 q-value 0.33이라 포함, 뒤쪽 decoy 두 행(q-value 0.67, 1.0)은 제외
+    assert last_index == 4
+    assert (result['qvalue'] <= 0.5).all()
+    assert result.loc[result['label'] == 1, 'score'].tolist() == [9.0, 8.0, 7.0]
+
+
+def test_make_fdr_nothing_passes():
+    peaks = _sorted_peaks([10, 9], [-1, 1])
+    result, last_index = fdr.make_fdr(peaks, 0.01)
+    assert last_index == 0 and result.empty
+
+
+def test_make_fdr_matches_count_passing():
+    rng = np.random.default_rng(7)
+    scores = np.round(np.r_[rng.normal(2, 1, 400), rng.normal(0, 1, 400)], 1)
+    labels = np.r_[np.ones(400, dtype=int), -np.ones(400, dtype=int)]
+    peaks = _sorted_peaks(scores, labels).sort_values(['score', 'label'], ascending=[False, False])
+    peaks = peaks.reset_index(drop=True)
+    for rate in (0.01, 0.05, 0.1):
+        result, _ = fdr.make_fdr(peaks, rate)
+        assert (result['label'] == 1).sum() == fdr._count_passing(scores, labels == 1, rate)
+
+
+# --- Percolator 결과 disk cache (opt-in) ---
+
+def _write_percolator(path, rows):
+    pd.DataFrame(rows, columns=['PSMId', 'score', 'q-value', 'posterior_error_prob', 'peptide', 'proteinIds']) \
+        .to_csv(path, sep='\t', index=False)
+    return str(path)
+
+
+@pytest.fixture
+def percolator_paths(tmp_path):
+    target = _write_percolator(tmp_path / 'out.target', [
+        ['run0_1001_2', 3.0, 0.0, 0.0, '-.PEPTIDEK.-', '1'],
+        ['run0_1002_2', 2.5, 0.0, 0.0, '-.LLLLLLK.-', '1'],
+        ['run1_1001_3', 2.0, 0.0, 0.0, '-.AAAAAAK.-', '1'],
+    ])
+    decoy = _write_percolator(tmp_path / 'out.decoy', [
+        ['run1_1005_2', 1.0, 0.5, 0.5, '-.KEDITPEP.-', '1'],
+    ])
+    fdr._LOADED.clear()
+    yield target, decoy
+    fdr._LOADED.clear()
+
+
+def test_estimate_fdr_writes_no_cache_by_default(tmp_path, percolator_paths):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    fdr.estimate_fdr('psm', *percolator_paths, '0.01', str(out_dir))
+    assert sorted(p.name for p in out_dir.iterdir()) == ['fdr_result.csv']
+    assert len(pd.read_csv(out_dir / 'fdr_result.csv')) == 3
+
+
+def test_estimate_fdr_reuses_opt_in_cache(tmp_path, percolator_paths, capsys):
+    out_dir, cache_dir = tmp_path / 'out', tmp_path / 'cache'
+    out_dir.mkdir()
+    cache_dir.mkdir()
+    fdr.estimate_fdr('psm', *percolator_paths, '0.01', str(out_dir), cache_dir=str(cache_dir))
+    assert (cache_dir / fdr.PERCOLATOR_CACHE_NAME).exists()
+
+    fdr._LOADED.clear()
+    fdr.estimate_fdr('peptide', *percolator_paths, '0.01', str(out_dir), cache_dir=str(cache_dir))
+    assert 'reuse normalized Percolator results' in capsys.readouterr().out
+
+
+# --- 내장 rescoring ---
+
+def _separable_pin(seed=0, n_good=400, n_bad=200, n_decoy=600):
+    """
+    SA만으로 good target > decoy > bad target 순서로 완전히 분리되는 PIN (absdRT/absdMppm은 잡음).
+    1% FDR에서 통과하는 target은 정확히 good target n_good개.
+    """
+    rng = np.random.default_rng(seed)
+    sa = np.r_[rng.uniform(0.85, 0.95, n_good), rng.uniform(0.0, 0.15, n_bad), rng.uniform(0.35, 0.55, n_decoy)]
+    n = len(sa)
+    label = np.r_[np.ones(n_good + n_bad, dtype=int), -np.ones(n_decoy, dtype=int)]
+    return pd.DataFrame({
+        'SpecId': [f'run{i % 3}_{1000 + i}_2' for i in range(n)],
+        'Label': label,
+        'ScanNr': np.arange(n),
+        'SA': sa,
+        'absdRT': rng.normal(0, 1, n),
+        'absdMppm': rng.normal(0, 1, n),
+        'Peptide': [f'-.PEPTIDE{"ACDEFGHKLMNPQRSTVWY"[i % 19]}K.-' for i in range(n)],
+        'Proteins': '1',
+    })
+
+
+def test_rescore_pin_df_separable_pin_passes_exactly_the_good_targets():
+    target, decoy = fdr.rescore_pin_df(_separable_pin())
+    assert len(target) == 600 and len(decoy) == 600
+    assert (target['q-value'] <= 0.01).sum() == 400
+    # 결과는 score 내림차순이고 PSMId는 charge suffix 제거
+    assert target['score'].is_monotonic_decreasing
+    assert not target['PSMId'].str.endswith('_2').any()
+
+
+def test_rescore_pin_df_is_deterministic_for_a_seed():
+    pin_df = _separable_pin(seed=3)
+    first = fdr.rescore_pin_df(pin_df, seed=5)
+    second = fdr.rescore_pin_df(pin_df, seed=5)
+    for a, b in zip(first, second):
+        pd.testing.assert_frame_equal(a, b)
+
+
+def test_load_rescored_df_psm_fdr_from_pin_file(tmp_path):
+    pin_path = tmp_path / 't_d.pin'
+    _separable_pin(seed=1).to_csv(pin_path, sep='\t', index=False)
+    fdr._LOADED.clear()
+    try:
+        ori_df = fdr.load_fdr_input(None, None, pin_path=str(pin_path))
+        result = fdr.psm_fdr_results(ori_df, [0.01])[0.01]
+    finally:
+        fdr._LOADED.clear()
+    assert len(result) == 400
+    assert (result['label'] == 1).all()
+
+
+# --- 내장 rescoring vs 기준 결과 (Docker/benchmarks/compare_rescoring.py) ---
+
+COMPARE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'compare_rescoring.py')
+
+
+def _overlapping_pin(seed=0, n_target=3000, n_decoy=3000):
+    """
+    SA/absdRT/absdMppm가 모두 조금씩 정보를 가진(어느 feature 하나로는 분리되지 않는) PIN과
+    그 생성 모델의 기준 linear score (Percolator 결과 대신 쓰는 reference)
+    """
+    rng = np.random.default_rng(seed)
+    n = n_target + n_decoy
+    good = np.r_[rng.random(n_target) < 0.5, np.zeros(n_decoy, dtype=bool)]
+    sa = np.where(good, rng.normal(0.7, 0.12, n), rng.normal(0.4, 0.12, n))
+    abs_drt = np.abs(np.where(good, rng.normal(0, 1, n), rng.normal(0, 4, n)))
+    abs_dmppm = np.abs(np.where(good, rng.normal(0, 3, n), rng.normal(0, 10, n)))
+    letters = np.array(list('ACDEFGHKMNPQRSTVWY'))
+    pin_df = pd.DataFrame({
+        'SpecId': [f'run{i % 3}_{1000 + i}_2' for i in range(n)],
+        'Label': np.r_[np.ones(n_target, dtype=int), -np.ones(n_decoy, dtype=int)],
+        'ScanNr': np.arange(n),
+        'SA': sa,
+        'absdRT': abs_drt,
+        'absdMppm': abs_dmppm,
+        'Peptide': ['-.' + ''.join(letters[rng.integers(0, len(letters), 10)]) + 'K.-' for _ in range(n)],
+        'Proteins': '1',
+    })
+    return pin_df, sa / 0.12 - abs_drt * 0.4 - abs_dmppm * 0.1
+
+
+def _write_reference(tmp_path, pin_df, score):
+    paths = []
+    for name, is_target in (('out.target', True), ('out.decoy', False)):
+        mask = (pin_df['Label'] == 1) == is_target
+        rows = pd.DataFrame({'PSMId': pin_df['SpecId'][mask], 'score': score[mask], 'q-value': 0.0,
+                             'posterior_error_prob': 0.0, 'peptide': pin_df['Peptide'][mask], 'proteinIds': '1'})
+        paths.append(_write_percolator(tmp_path / name, rows.sort_values('score', ascending=False).to_numpy()))
+    return paths
+
+
+def _compare(tmp_path, pin_df, score):
+    pin_path = tmp_path / 't_d.pin'
+    pin_df.to_csv(pin_path, sep='\t', index=False)
+    target, decoy = _write_reference(tmp_path, pin_df, score)
+    return subprocess.run([sys.executable, COMPARE_SCRIPT, '--pin', str(pin_path), '--target', target,
+                           '--decoy', decoy], capture_output=True, text=True)
+
+
+def test_compare_rescoring_builtin_agrees_with_reference(tmp_path):
+    pin_df, score = _overlapping_pin()
+    proc = _compare(tmp_path, pin_df, score)
+    assert proc.returncode == 0, proc.stdout + proc.stderr
+    assert 'agreement: ok' in proc.stdout
+
+
+def test_compare_rescoring_fails_on_disagreeing_results(tmp_path):
+    pin_df, score = _overlapping_pin()
+    proc = _compare(tmp_path, pin_df, -score)
+    assert proc.returncode == 1
+    assert 'agreement: FAILED' in proc.stdout
+
+
+# --- FDR sweep 인자 ---
+
+def test_split_arg_list_strips_and_deduplicates():
+    assert fdr.split_arg_list(' psm, peptide,,psm ') == ['psm', 'peptide']
+
+
+def test_sweep_fdr_rejects_unknown_type(tmp_path, percolator_paths):
+    with pytest.raises(ValueError, match='peptides'):
+        fdr.sweep_fdr(['psm', 'peptides'], *percolator_paths, ['0.01'], str(tmp_path))
+    assert not list(tmp_path.glob('fdr_result_*.csv'))
+
+
+def test_sweep_fdr_writes_each_type_once(tmp_path, percolator_paths):
+    fdr.sweep_fdr(['peptide', 'psm', 'peptide'], *percolator_paths, ['0.01', '0.05'], str(tmp_path))
+    assert sorted(p.name for p in tmp_path.glob('fdr_result_*.csv')) == [
+        'fdr_result_peptide_0.01.csv', 'fdr_result_peptide_0.05.csv',
+        'fdr_result_psm_0.01.csv', 'fdr_result_psm_0.05.csv']
+
+
+def test_cli_rejects_unknown_fdr_type(tmp_path):
+    script = os.path.join(os.path.dirname(fdr.__file__), 'fdr_control.py')
+    proc = subprocess.run([sys.executable, script, '--fdr_type', 'psm,pep', '--fdr_rate', '0.01',
+                           '--target_path', 'x', '--decoy_path', 'y', '--output_dir', str(tmp_path / 'out')],
+                          capture_output=True, text=True)
+    assert proc.returncode == 2
+    assert 'unknown FDR type(s): pep' in proc.stderr
+    assert not (tmp_path / 'out').exists()
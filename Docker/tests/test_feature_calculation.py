@@ -0,0 +1,426 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import feature_calculation as fc
+
+
+MGF_TEXT = (
+    "CHARGE=2+\n"
+    "BEGIN IONS\n"
+    "TITLE=run0.1.1.2 scan=11\n"
+    "RTINSECONDS=60.5\n"
+    "PEPMASS=500.25\n"
+    "100.0 10.0\n"
+    "200.0 20.0\n"
+    "END IONS\n"
+    "\n"
+    "  BEGIN IONS\n"
+    "TITLE=run0 index=7\n"
+    "SCANS=12\n"
+    "RTINSECONDS=61.0\n"
+    "300.0 30.0\n"
+    "END IONS\n"
+    "BEGIN IONS\n"
+    "TITLE=no scan here\n"
+    "150.0 5.0\n"
+    "END IONS\n"
+)
+
+
+@pytest.fixture
+def mgf_path(tmp_path):
+    path = tmp_path / "run0.mgf"
+    path.write_text(MGF_TEXT)
+    return str(path)
+
+
+# --- MGF offset index ---
+
+def test_build_mgf_index_points_at_begin_ions_lines(mgf_path):
+    offsets = fc.build_mgf_index(mgf_path)
+    data = open(mgf_path, 'rb').read()
+    assert offsets.dtype == np.int64
+    assert len(offsets) == 3
+    for off in offsets:
+        assert data[off:].lstrip(b' \t').startswith(b'BEGIN IONS')
+
+
+def test_build_mgf_index_empty_file(tmp_path):
+    path = tmp_path / "empty.mgf"
+    path.write_bytes(b"")
+    assert len(fc.build_mgf_index(str(path))) == 0
+
+
+def test_load_mgf_index_writes_sidecar_and_rebuilds_on_change(mgf_path):
+    first = fc.load_mgf_index(mgf_path)
+    assert os.path.exists(fc._mgf_index_path(mgf_path))
+    np.testing.assert_array_equal(fc.load_mgf_index(mgf_path), first)
+
+    with open(mgf_path, 'a') as fh:
+        fh.write("BEGIN IONS\nTITLE=appended\n1.0 1.0\nEND IONS\n")
+    assert len(fc.load_mgf_index(mgf_path)) == len(first) + 1
+
+
+# --- MGF header 메타데이터 ---
+
+def test_read_mgf_metadata_reads_headers_only(mgf_path):
+    meta = fc.read_mgf_metadata({mgf_path: {2, 0, 1, 99}})
+    assert meta['mgf_index'].tolist() == [0, 1, 2]
+    # SCANS 우선, 없으면 TITLE의 scan=/index= 에서 추출
+    assert meta['scan'].tolist() == [11, 12, pd.NA]
+    np.testing.assert_allclose(meta['rt_seconds'].to_numpy(), [60.5, 61.0, np.nan])
+    assert meta['title'].tolist() == ["run0.1.1.2 scan=11", "run0 index=7", "no scan here"]
+
+
+# --- get_casanovo_changed_df / composite_id_columns ---
+
+def _casanovo_df():
+    return pd.DataFrame({
+        'run': ['a.mgf', 'a.mgf', 'a.mgf', 'b.x.mgf', 'b.x.mgf', 'a.mgf'],
+        'Scan': [1, 1, 1, 1, 2, 3],
+        'Peptide': ['PEPTIDEK', 'PEPTLDEK', 'SHORT', 'M+15.995(C+57.021)AAAIK', '+42.011GGGGGR', 'LONGPEPTIDE'],
+        'Casanovo score': ['0.5', '0.9', '0.95', '0.7', '0.1', '0.3'],
+        'z': [2.0, 2.0, 2.0, 3.0, 2.0, 7.0],
+        'm/z': [400.0, 400.0, 300.0, 500.0, 250.0, 600.0],
+        'RT': [10.0, 10.0, 10.0, 20.0, 30.0, 40.0],
+    })
+
+
+def test_get_casanovo_changed_df_ranks_before_filtering():
+    out = fc.get_casanovo_changed_df(_casanovo_df())
+    # SHORT(길이 5)와 z=7 행은 제외되지만 rank는 필터 전 beam 기준 (SHORT가 rank 1)
+    assert out.index.tolist() == [0, 1, 3, 4]
+    assert out['rank_first'].tolist() == [3.0, 2.0, 1.0, 1.0]
+    assert out['Source File'].astype(str).tolist() == ['a', 'a', 'b', 'b']
+    assert out['Peptide'].tolist() == ['PEPTLDEK', 'PEPTLDEK', 'M+15.995C+57.021AAALK', '+42.011GGGGGR']
+    assert out['Tag length'].tolist() == [8, 8, 23, 13]
+    assert out['z'].dtype == np.int64
+
+
+def test_composite_id_columns_match_row_helpers():
+    out = fc.get_casanovo_changed_df(_casanovo_df())
+    ids = fc.composite_id_columns(out, ["SS", "ID", "IDD", "peptide", "peptidoform"])
+    for i, row in out.iterrows():
+        ss = fc.combine_columns([str(row['Source File']), row['Scan']], '_')
+        peptide = fc.get_nonnum_peptide(row['Peptide'])
+        assert ids.at[i, 'SS'] == ss
+        assert ids.at[i, 'peptide'] == peptide
+        assert ids.at[i, 'ID'] == fc.combine_columns([ss, peptide], '_')
+        assert ids.at[i, 'IDD'] == fc.combine_columns([ss, row['Peptide']], '_')
+        assert ids.at[i, 'peptidoform'] == fc.combine_columns([fc.get_ptm_peptide(row['Peptide']), row['z']], '/')
+    assert ids.at[3, 'peptidoform'] == 'M[ox]CAAALK/3'
+    assert ids.at[4, 'peptidoform'] == '[ac]-GGGGGR/2'
+    with pytest.raises(ValueError):
+        fc.composite_id_columns(out, ["nope"])
+
+
+# --- mzTab PSM chunk 파싱 ---
+
+MZTAB_TEXT = (
+    "MTD\tmzTab-version\t1.0.0\n"
+    "MTD\tms_run[1]-location\tfile:///data/run0.mgf\n"
+    "MTD\tms_run[2]-location\tfile:///data/run1.mgf\n"
+    "PSH\tsequence\tPSM_ID\tsearch_engine_score[1]\tcharge\texp_mass_to_charge\tspectra_ref\n"
+    "PSM\tPEPTIDEK\t1\t0.9\t2\t400.5\tms_run[1]:index=0\n"
+    "PSM\tLLLLLLK\t2\t-0.25\t3\t300.25\tms_run[2]:index=4\n"
+    "PSM\tAAAAAAK\t3\t0.5\t2\t350.0\tms_run[1]:index=1\n"
+)
+
+
+def _write(tmp_path, text, name="result.mztab"):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_read_mztab_types_columns_and_msrun_locations(tmp_path):
+    psm_df, msrun_to_path = fc.read_mztab(_write(tmp_path, MZTAB_TEXT), fc.MZTAB_PSM_COLUMNS)
+    assert msrun_to_path == {1: "file:///data/run0.mgf", 2: "file:///data/run1.mgf"}
+    assert psm_df.columns.tolist() == fc.MZTAB_PSM_COLUMNS
+    assert psm_df['sequence'].tolist() == ['PEPTIDEK', 'LLLLLLK', 'AAAAAAK']
+    assert psm_df['charge'].dtype == np.int8
+    assert psm_df['search_engine_score[1]'].dtype == np.float32
+    assert psm_df['exp_mass_to_charge'].tolist() == [400.5, 300.25, 350.0]
+
+
+def test_iter_mztab_psm_chunks_match_single_read(tmp_path):
+    path = _write(tmp_path, MZTAB_TEXT)
+    chunks = list(fc.iter_mztab_psm(path, fc.MZTAB_PSM_COLUMNS, chunksize=2))
+    assert [len(c) for c in chunks] == [2, 1]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True),
+                                  fc.read_mztab_psm(path, fc.MZTAB_PSM_COLUMNS))
+
+
+@pytest.mark.parametrize("first_ragged", [False, True])
+def test_parse_mztab_psm_chunk_pads_and_truncates_ragged_lines(tmp_path, first_ragged):
+    lines = [
+        "PSM\tPEPTIDEK\t1\t0.9\t2\t400.5\tms_run[1]:index=0\textra\tfields\n",
+        "PSM\tLLLLLLK\t2\t0.1\n",
+        "PSM\tAAAAAAK\t3\t0.5\t2\t350.0\tms_run[1]:index=1\n",
+    ]
+    if not first_ragged:
+        lines = lines[::-1]
+    body = "".join(lines)
+    text = MZTAB_TEXT.split("PSM\t", 1)[0] + body
+    psm_df = fc.read_mztab_psm(_write(tmp_path, text), fc.MZTAB_PSM_COLUMNS).set_index('sequence')
+
+    # 긴 라인은 PSH 컬럼 수에서 자르고, 짧은 라인의 없는 필드는 빈 값 (숫자 컬럼은 NaN)
+    assert psm_df.loc['PEPTIDEK', 'spectra_ref'] == 'ms_run[1]:index=0'
+    assert psm_df.loc['LLLLLLK', 'spectra_ref'] == ''
+    assert np.isnan(psm_df.loc['LLLLLLK', 'exp_mass_to_charge'])
+    assert psm_df.loc['LLLLLLK', 'search_engine_score[1]'] == np.float32(0.1)
+    assert psm_df.loc['AAAAAAK', 'spectra_ref'] == 'ms_run[1]:index=1'
+
+
+def test_iter_mztab_psm_errors(tmp_path):
+    with pytest.raises(ValueError, match="PSH"):
+        list(fc.iter_mztab_psm(_write(tmp_path, "PSM\tA\t1\n")))
+    with pytest.raises(ValueError, match="PSM"):
+        list(fc.iter_mztab_psm(_write(tmp_path, MZTAB_TEXT.split("PSM\t", 1)[0])))
+
+
+# --- sub-stage checkpoint ---
+
+def test_stage_checkpoint_is_valid_only_for_saved_key(tmp_path):
+    ckpt = fc.StageCheckpoint(str(tmp_path / "ckpt"))
+    assert not ckpt.is_valid("mztab", "k1")
+    ckpt.save("mztab", "k1", {"rows": [1, 2]})
+    assert ckpt.is_valid("mztab", "k1")
+    assert not ckpt.is_valid("mztab", "k2")
+    assert ckpt.load("mztab") == {"rows": [1, 2]}
+
+
+def test_file_fingerprint_tracks_size_mtime_and_sampled_bytes(mgf_path):
+    before = fc.file_fingerprint(mgf_path)
+    assert fc.file_fingerprint(mgf_path) == before
+    st = os.stat(mgf_path)
+    os.utime(mgf_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert fc.file_fingerprint(mgf_path) != before
+
+    # 크기/mtime을 그대로 두고 sample 범위(앞/뒤 sample_bytes) 밖만 바꾸면 감지하지 못함 (docstring의 한계)
+    data = bytearray(open(mgf_path, 'rb').read())
+    sample = 16
+    middle = len(data) // 2
+    fixed = fc.file_fingerprint(mgf_path, sample_bytes=sample)
+    st = os.stat(mgf_path)
+    data[middle] = ord('9') if data[middle] != ord('9') else ord('8')
+    open(mgf_path, 'wb').write(bytes(data))
+    os.utime(mgf_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert fc.file_fingerprint(mgf_path, sample_bytes=sample) == fixed
+
+
+# --- DeepLC calibration store key (LC run identity) ---
+
+def _precursor_swapped(text):
+    """PrecursorSwap decoy처럼 PEPMASS/CHARGE와 peak만 바꾼 MGF 텍스트"""
+    out = []
+    for line in text.splitlines(keepends=True):
+        if line.startswith("PEPMASS="):
+            line = "PEPMASS=777.77\n"
+        elif line[:1].isdigit():
+            line = "123.4 5.0\n"
+        out.append(line)
+    return "".join(out)
+
+
+@pytest.fixture
+def target_decoy_mgf(tmp_path):
+    (tmp_path / "target").mkdir()
+    (tmp_path / "decoy").mkdir()
+    target = tmp_path / "target" / "run0.mgf"
+    decoy = tmp_path / "decoy" / "run0.mgf"
+    target.write_text(MGF_TEXT)
+    decoy.write_text(_precursor_swapped(MGF_TEXT))
+    return str(target), str(decoy)
+
+
+def test_mgf_run_identity_is_shared_by_target_and_decoy(target_decoy_mgf, tmp_path):
+    target, decoy = target_decoy_mgf
+    assert open(target, 'rb').read() != open(decoy, 'rb').read()
+    assert fc.mgf_run_identity(target) == fc.mgf_run_identity(decoy)
+
+    other = tmp_path / "other.mgf"
+    other.write_text(MGF_TEXT.replace("RTINSECONDS=61.0", "RTINSECONDS=62.0"))
+    assert fc.mgf_run_identity(str(other)) != fc.mgf_run_identity(target)
+
+
+def test_mgf_run_identity_is_read_from_the_sidecar(mgf_path, monkeypatch):
+    identity = fc.mgf_run_identity(mgf_path)
+
+    def no_scan(path):
+        raise AssertionError("MGF was scanned again")
+
+    monkeypatch.setattr(fc, "_scan_mgf", no_scan)
+    assert fc.mgf_run_identity(mgf_path) == identity
+    assert len(fc.load_mgf_index(mgf_path)) == 3
+
+
+def test_old_sidecar_without_identity_is_rebuilt(mgf_path):
+    st = os.stat(mgf_path)
+    offsets = fc.build_mgf_index(mgf_path)
+    with open(fc._mgf_index_path(mgf_path), 'wb') as out:
+        np.savez(out, offsets=offsets, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    assert fc.mgf_run_identity(mgf_path) == fc._scan_mgf(mgf_path)[1]
+    with np.load(fc._mgf_index_path(mgf_path)) as z:
+        assert 'run_identity' in z.files
+
+
+class _CountingDeepLC:
+    """calibrate_deeplc가 쓰는 DeepLC predictor 인터페이스만 가진 대역 (fitting 횟수만 셈)"""
+    fits = 0
+
+    def __init__(self, n_jobs=None, verbose=None, path_model=None, **kwargs):
+        self.model = {_CountingDeepLC.model_path: _CountingDeepLC.model_path}
+        self.calibrate_dict, self.calibrate_min, self.calibrate_max = {}, 0.0, 0.0
+
+    def calibrate_preds(self, psm_list):
+        type(self).fits += 1
+        self.calibrate_dict, self.calibrate_min, self.calibrate_max = {"n": len(psm_list)}, 1.0, 2.0
+
+
+class _DeepLCGenerator:
+    DeepLC = _CountingDeepLC
+    processes = 1
+    _verbose = False
+    user_model = None
+
+    def __init__(self):
+        self.deeplc_kwargs = {}
+        self.selected_model = None
+
+    def _get_calibration_psms(self, psm_list):
+        return psm_list
+
+
+def test_target_decoy_pair_calibrates_once(target_decoy_mgf, tmp_path):
+    target, decoy = target_decoy_mgf
+    _CountingDeepLC.fits = 0
+    _CountingDeepLC.model_path = str(tmp_path / "model.keras")
+    open(_CountingDeepLC.model_path, 'w').close()
+    root = str(tmp_path / "calibrations")
+
+    fitted = fc.calibrate_deeplc(_DeepLCGenerator(), [1, 2, 3],
+                                 fc.DeepLCCalibrationStore(root, label="target"), target)
+    reused = fc.calibrate_deeplc(_DeepLCGenerator(), [1, 2, 3, 4],
+                                 fc.DeepLCCalibrationStore(root, label="decoy"), decoy)
+    assert _CountingDeepLC.fits == 1
+    assert reused.calibrate_dict == fitted.calibrate_dict == {"n": 3}
+    assert os.listdir(root) == [fc.mgf_run_identity(target) + ".pkl"]
+
+
+# --- --incremental ms_run shard key ---
+
+def _shard_rows(ms_run_id=1, scores=(0.9, 0.5), index=(0, 1)):
+    return pd.DataFrame({
+        'sequence': ['PEPTIDEK', 'LLLLLLK'],
+        'spectra_ref': [f'ms_run[{ms_run_id}]:index={i}' for i in (0, 1)],
+        'search_engine_score[1]': np.asarray(scores, dtype=np.float32),
+        'charge': np.asarray([2, 3], dtype=np.int8),
+        'exp_mass_to_charge': [400.5, 300.25],
+        'ms_run_id': [float(ms_run_id)] * 2,
+        'mgf_index': [0.0, 1.0],
+    }, index=list(index))
+
+
+def test_incremental_shard_keys_ignore_run_numbering(mgf_path):
+    loc = "file:///data/run0.mgf"
+    base = fc.incremental_shard_keys(_shard_rows(), loc, mgf_path, fc.SPECTRUM_ID_PATTERN)
+    # 다른 run이 추가되어 ms_run 번호와 mzTab 행 위치가 바뀌어도 같은 key
+    moved = fc.incremental_shard_keys(_shard_rows(ms_run_id=3, index=(10, 11)), loc, mgf_path,
+                                      fc.SPECTRUM_ID_PATTERN)
+    assert moved == base
+    assert set(base) == {"mgf_meta", "rank1", "basic", "ms2pip", "deeplc"}
+
+
+def test_incremental_shard_keys_follow_rows_location_mgf_and_mode(mgf_path):
+    loc = "file:///data/run0.mgf"
+    base = fc.incremental_shard_keys(_shard_rows(), loc, mgf_path, fc.SPECTRUM_ID_PATTERN)
+
+    rescored = fc.incremental_shard_keys(_shard_rows(scores=(0.9, 0.6)), loc, mgf_path, fc.SPECTRUM_ID_PATTERN)
+    other_loc = fc.incremental_shard_keys(_shard_rows(), "file:///data/run1.mgf", mgf_path, fc.SPECTRUM_ID_PATTERN)
+    best_beam = fc.incremental_shard_keys(_shard_rows(), loc, mgf_path, fc.SPECTRUM_ID_PATTERN,
+                                          streaming_rank1=True)
+    for keys in (rescored, other_loc, best_beam):
+        assert all(keys[k] != base[k] for k in base)
+
+    full = fc.incremental_shard_keys(_shard_rows(), loc, mgf_path, fc.SPECTRUM_ID_PATTERN, feature_mode="full")
+    assert full["rank1"] == base["rank1"] and full["basic"] != base["basic"]
+
+    st = os.stat(mgf_path)
+    os.utime(mgf_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    touched = fc.incremental_shard_keys(_shard_rows(), loc, mgf_path, fc.SPECTRUM_ID_PATTERN)
+    assert touched["mgf_meta"] != base["mgf_meta"]
+
+
+# --- PIN checkpoint (run_feature_calculation 전체 skip) ---
+
+@pytest.fixture
+def pin_sample(tmp_path, monkeypatch):
+    """
+    feature 계산/PIN 쓰기를 mzTab 내용만 PIN에 옮겨 쓰는 함수로 바꾼 sample.
+    반환: (mzTab 경로, 인자 생성 함수, 계산 호출 기록)
+    """
+    for side in ("target", "decoy"):
+        (tmp_path / side / "mgf").mkdir(parents=True)
+        (tmp_path / side / "mgf" / "run0.mgf").write_text(MGF_TEXT)
+    mztab = tmp_path / "result.mztab"
+    calls = []
+
+    def fake_job(result_path, mgf_dir, pattern, output_base, flag, **kwargs):
+        calls.append(result_path)
+        for fmt in kwargs["output_formats"]:
+            open(fc.feature_output_path(output_base, fmt), 'w').close()
+        return pd.DataFrame({'inputs': [open(result_path).read()]})
+
+    def fake_pin(t_df, d_df, output_dir, compress=False):
+        with open(fc.pin_output_path(output_dir, compress), 'w') as fh:
+            fh.write(t_df['inputs'].iloc[0])
+
+    monkeypatch.setattr(fc, "run_feature_job", fake_job)
+    monkeypatch.setattr(fc, "percolator_dm_alc_output", fake_pin)
+
+    def make_args(*extra):
+        return fc.build_arg_parser().parse_args([
+            "--target_mgf_dir", str(tmp_path / "target" / "mgf"), "--target_result_path", str(mztab),
+            "--decoy_mgf_dir", str(tmp_path / "decoy" / "mgf"), "--decoy_result_path", str(mztab),
+            "--output_dir", str(tmp_path / "out"), "--checkpoint_dir", str(tmp_path / "ckpt"),
+            *extra])
+
+    return mztab, make_args, calls
+
+
+def test_pin_checkpoint_is_not_reused_across_pin_gzip(pin_sample):
+    mztab, make_args, calls = pin_sample
+    mztab.write_text("inputs A")
+    fc.run_feature_calculation(make_args())
+    mztab.write_text("inputs C, changed")
+    fc.run_feature_calculation(make_args("--pin_gzip"))
+    assert len(calls) == 4
+
+    # gzip 실행이 남긴 key로 inputs A의 t_d.pin을 반환하지 않고 다시 계산
+    pin_path = fc.run_feature_calculation(make_args())
+    assert len(calls) == 6
+    assert open(pin_path).read() == "inputs C, changed"
+
+    # 같은 설정으로 다시 실행하면 skip
+    assert fc.run_feature_calculation(make_args()) == pin_path
+    assert len(calls) == 6
+
+
+def test_pin_checkpoint_skip_writes_metrics(pin_sample):
+    mztab, make_args, calls = pin_sample
+    mztab.write_text("inputs A")
+    args = make_args()
+    fc.run_feature_calculation(args)
+    metrics_path = os.path.join(args.output_dir, fc.METRICS_FILE_NAME)
+    os.remove(metrics_path)
+
+    fc.run_feature_calculation(args)
+    assert len(calls) == 2
+    with open(metrics_path) as fh:
+        stages = json.load(fh)["stages"]
+    assert [(s["stage"], s.get("checkpoint")) for s in stages] == [("pin", "reused")]